@@ -4,16 +4,60 @@
 """
 
 import os
-from openai import OpenAI
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator, Optional, Tuple
 import json
+import time
+import asyncio
+import inspect
+import functools
+import uuid
+import weakref
+
+# 共享的 DeepSeek 客户端连接池
+from llm_client import (
+    DEEPSEEK_BASE_URL,
+    PROMPT_CACHE_STATS,
+    get_async_client,
+    run_sync,
+    shutdown_clients,
+    upstream_semaphore
+)
+
+# 上游调用容错（超时、重试、对冲、熔断）
+from resilience import ResilientCaller, UpstreamError
+
+# 多端点 / 多模型路由
+from routing import DEFAULT_POLICY, RoutingPolicy
+
+# 按 token 预算压缩发送给模型的历史
+from history import HistoryManager
+
+# 常见问题的回复缓存
+from response_cache import ResponseCache
+
+# 只读工具的结果缓存
+from tool_cache import ToolResultCache, normalize_args
+
+# 车牌归一化（车位查询结果的缓存键与失效）
+from parking_index import normalize_plate
+
+# 常见单一意图问题的本地快速路由
+from intent_router import IntentRouter, render_reply
+
+# 请求追踪（span、指标）与调试输出开关
+from tracing import METRICS, TRACER, Span, debug, debug_enabled
 
 # 导入模拟数据和工具函数
 from mock_data import (
     find_parking,
+    get_parking_occupancy,
     get_shop_info,
+    find_nearby,
     add_points,
     redeem_coupon,
+    subscribe_shops,
+    SHOP_INDEX,
+    PARKING_INDEX,
     USER_STATE
 )
 
@@ -55,9 +99,11 @@ You are **The Concierge** - Dubai Mall's exclusive AI-powered personal assistant
 You have access to these powerful tools to serve guests:
 
 1. **find_parking** - Locate parked vehicles by plate number
-2. **get_shop_info** - Provide detailed shop locations, floors, and descriptions
-3. **add_points** - Award loyalty points for activities and engagement
-4. **redeem_coupon** - Convert points into exclusive shopping and dining vouchers
+2. **get_parking_occupancy** - Check free parking spaces per level
+3. **get_shop_info** - Provide detailed shop locations, floors, and descriptions
+4. **find_nearby** - Find the nearest shops of a category (or list a floor) with walking directions
+5. **add_points** - Award loyalty points for activities and engagement
+6. **redeem_coupon** - Convert points into exclusive shopping and dining vouchers
 
 **IMPORTANT:** Always use these tools when relevant! Don't just describe what you could do - actually DO IT.
 
@@ -102,8 +148,10 @@ You have access to these powerful tools to serve guests:
 
 **When Users Ask About:**
 
-- **Parking** → Use `find_parking()` immediately with their plate number
+- **Parking** → Use `find_parking()` immediately with their plate number exactly as they wrote it (no need to reformat or retry other spellings)
+- **Free parking spaces** → Use `get_parking_occupancy()`
 - **Shop Locations** → Use `get_shop_info()` to give exact floor and directions
+- **"Nearest X" / "What's on this floor"** → Use `find_nearby()` instead of listing shops yourself
 - **Things to Do** → Suggest luxury shopping, dining, Dubai Aquarium, or start a game
 - **Points/Rewards** → Check their balance and suggest redemptions or ways to earn more
 - **Languages** → Seamlessly switch to match their preference
@@ -146,7 +194,7 @@ TOOL_DEFINITIONS = [
         "type": "function",
         "function": {
             "name": "find_parking",
-            "description": "查找用户车辆的停车位置。当用户询问 '我的车停在哪里' 或提供车牌号时调用此工具。支持迪拜常见车牌格式（如 DXB-1234）。",
+            "description": "查找用户车辆的停车位置。当用户询问 '我的车停在哪里' 或提供车牌号时调用此工具。支持迪拜常见车牌格式（如 DXB-1234），大小写、空格和分隔符不限，可直接传入用户原话中的车牌。",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -159,23 +207,69 @@ TOOL_DEFINITIONS = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_parking_occupancy",
+            "description": "查询停车场各层的已占用、总车位和空余车位数。当用户问 '哪层还有车位'、'停车场满了吗' 时调用。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "level": {
+                        "type": "string",
+                        "description": "停车层，例如 'B1'、'B2'；不填返回全部楼层"
+                    }
+                },
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
             "name": "get_shop_info",
-            "description": "获取商场内店铺的位置、楼层和详细信息。当用户询问某个品牌或店铺的位置时调用。支持模糊匹配店铺名称。",
+            "description": "获取商场内店铺的位置、楼层和详细信息。当用户询问某个品牌或店铺的位置时调用。支持模糊匹配店铺名称，也支持阿拉伯文和中文店名。",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "shop_name": {
                         "type": "string",
-                        "description": "店铺名称，例如 'Hermès'、'Apple Store'、'% Arabica' 等"
+                        "description": "店铺名称（可直接使用用户输入的写法，无需翻译），例如 'Hermès'、'هيرميس'、'爱马仕'、'Apple Store' 等"
                     }
                 },
                 "required": ["shop_name"]
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_nearby",
+            "description": "查找离用户当前位置最近的某类店铺或设施，或列出某一楼层的店铺。当用户问 '最近的咖啡馆在哪'、'2 楼有什么' 时调用，结果已按步行距离排序并附带路线。",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "category": {
+                        "type": "string",
+                        "description": "类别，例如 'coffee'、'luxury'、'fashion'、'electronics'、'prayer'、'咖啡'；不填表示全部类别"
+                    },
+                    "from_location": {
+                        "type": "string",
+                        "description": "用户当前位置，例如 'Zone B'、'1st Floor, Zone C'、停车位 'B2-A05' 或店铺名 'Zara'；不填默认正门"
+                    },
+                    "k": {
+                        "type": "integer",
+                        "description": "返回数量（1~10），默认 3"
+                    },
+                    "floor": {
+                        "type": "string",
+                        "description": "只查看某一楼层，例如 '2nd Floor'"
+                    }
+                },
+                "required": []
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -231,32 +325,611 @@ TOOL_DEFINITIONS = [
 
 # ==================== 工具调用映射 ====================
 
-TOOL_FUNCTION_MAP = {
-    "find_parking": find_parking,
-    "get_shop_info": get_shop_info,
-    "add_points": add_points,
-    "redeem_coupon": redeem_coupon
-}
+# 工具注册表：
+#   function        - 工具实现（同步函数或协程函数）
+#   read_only       - 只读工具可在同一轮内并发执行；修改状态的工具按用户串行执行
+#   inject_user_id  - 是否由服务端注入当前 user_id（不信任模型给出的 user_id）
+#   response_cacheable - 调用了该工具的轮次能否进入回复缓存（结果随时间/车辆变化的工具不能）
+#   cache_ttl       - 工具结果缓存的秒数（0 表示不缓存；修改状态的工具始终为 0）
+#   cache_key       - 参数 → 缓存键（默认 normalize_args：键排序、忽略大小写与多余空白）
+TOOL_REGISTRY: Dict[str, Dict[str, Any]] = {}
+
+# 名称 -> 函数（保留旧接口）
+TOOL_FUNCTION_MAP: Dict[str, Callable[..., Any]] = {}
+
+
+def register_tool(
+    name: str,
+    function: Callable[..., Any],
+    read_only: bool,
+    inject_user_id: bool = False,
+    response_cacheable: Optional[bool] = None,
+    cache_ttl: float = 0,
+    cache_key: Optional[Callable[[Dict[str, Any]], Any]] = None
+):
+    """注册（或替换）一个工具实现，例如用真实后端替换 mock_data 中的函数"""
+    TOOL_REGISTRY[name] = {
+        "function": function,
+        "read_only": read_only,
+        "inject_user_id": inject_user_id,
+        # 默认：只读工具可缓存，修改状态的工具一律不可缓存
+        "response_cacheable": read_only and response_cacheable is not False,
+        "cache_ttl": cache_ttl if read_only else 0,
+        "cache_key": cache_key or normalize_args
+    }
+    TOOL_FUNCTION_MAP[name] = function
+    # 实现被替换后，旧实现的缓存结果不再有效
+    TOOL_CACHE.invalidate(name)
+
+
+# 只读工具的结果缓存（条目上限见 TOOL_CACHE_SIZE）
+TOOL_CACHE = ToolResultCache()
+
+
+def _parking_cache_key(args: Dict[str, Any]):
+    """车位查询的缓存键：规范车牌 (酋长国或 None, 号码)，"dxb 1234" 与 "DXB-1234" 相同"""
+    return normalize_plate(str(args["plate_number"]))
+
+
+register_tool("find_parking", find_parking, read_only=True, response_cacheable=False,
+              cache_ttl=60, cache_key=_parking_cache_key)
+register_tool("get_parking_occupancy", get_parking_occupancy, read_only=True, response_cacheable=False,
+              cache_ttl=5)
+register_tool("get_shop_info", get_shop_info, read_only=True, cache_ttl=600)
+register_tool("find_nearby", find_nearby, read_only=True, cache_ttl=600)
+register_tool("add_points", add_points, read_only=False, inject_user_id=True)
+register_tool("redeem_coupon", redeem_coupon, read_only=False, inject_user_id=True)
+
+
+def _on_parking_event(event: Dict[str, Any]):
+    """
+    闸机事件 → 使受影响的车位查询结果失效
+
+    同一号码的完整车牌查询 (酋长国, 号码) 与只给号码的查询 (None, 号码)
+    （号码是否唯一可能因这辆车而改变）；各层占用统计整体失效。
+    """
+    emirate, number = normalize_plate(str(event.get("plate", "")))
+    TOOL_CACHE.invalidate("find_parking", (emirate, number))
+    TOOL_CACHE.invalidate("find_parking", (None, number))
+    TOOL_CACHE.invalidate("get_parking_occupancy")
+
+
+def _on_shops_changed(shop_name: str):
+    """店铺增删改 → 店铺相关的工具结果与缓存的回复全部失效"""
+    TOOL_CACHE.invalidate("get_shop_info")
+    TOOL_CACHE.invalidate("find_nearby")
+    RESPONSE_CACHE.clear()
+
+
+PARKING_INDEX.subscribe(_on_parking_event)
+subscribe_shops(_on_shops_changed)
+
+
+# ==================== 请求构建与工具执行 ====================
+
+def _resolve_api_key(api_key: Optional[str]) -> str:
+    """获取 DeepSeek API Key（未传入时读取环境变量）"""
+    if api_key is None:
+        api_key = os.environ.get("DEEPSEEK_API_KEY")
+
+    if not api_key:
+        raise ValueError(
+            "未找到 DeepSeek API Key。请设置环境变量 DEEPSEEK_API_KEY "
+            "或在调用函数时传入 api_key 参数。"
+        )
+    return api_key
+
+
+# 历史压缩（预算见 HISTORY_TOKEN_BUDGET / HISTORY_KEEP_TURNS）
+HISTORY_MANAGER = HistoryManager()
+
+# 规范化后的工具定义缓存：(TOOL_DEFINITIONS 的规范序列化, 规范化列表)
+_CANONICAL_TOOLS: tuple = ("", [])
+
+
+def _canonical_tools() -> List[Dict[str, Any]]:
+    """
+    工具定义的规范形式：按工具名排序、所有字典按键排序
+
+    请求体中的 tools 因此逐字节稳定（与注册顺序、字典构造顺序无关），可以命中上游前缀缓存。
+    TOOL_DEFINITIONS 被修改时自动重新生成。
+    """
+    global _CANONICAL_TOOLS
+    serialized = json.dumps(
+        sorted(TOOL_DEFINITIONS, key=lambda tool: tool["function"]["name"]),
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    if serialized != _CANONICAL_TOOLS[0]:
+        _CANONICAL_TOOLS = (serialized, json.loads(serialized))
+    return _CANONICAL_TOOLS[1]
+
+
+def _render_context(context: Optional[Dict[str, Any]]) -> Optional[str]:
+    """把会话级动态上下文（如 kiosk 位置、会员等级）渲染为确定性的文本"""
+    if not context:
+        return None
+    lines = [f"- {key}: {context[key]}" for key in sorted(context)]
+    return "Session context:\n" + "\n".join(lines)
+
+
+def _build_messages(
+    chat_history: List[Dict[str, Any]],
+    context: Optional[Dict[str, Any]] = None
+) -> List[Dict[str, Any]]:
+    """
+    构建消息列表
+
+    布局（从稳定到多变）：
+        1. SYSTEM_PROMPT —— 所有用户、所有轮次完全相同，是前缀缓存的主体
+        2. 会话上下文 —— 同一会话内不变
+        3. 历史（超出预算时为压缩后的视图，chat_history 本身不变）—— 只在末尾追加
+    任何动态内容都不得写入 SYSTEM_PROMPT，否则每个请求的前缀都不同。
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    rendered = _render_context(context)
+    if rendered:
+        messages.append({"role": "system", "content": rendered})
+    return messages + HISTORY_MANAGER.compact(chat_history)
+
+
+def _build_request(
+    model: str,
+    chat_history: List[Dict[str, Any]],
+    context: Optional[Dict[str, Any]] = None,
+    stream: bool = False
+) -> Dict[str, Any]:
+    """构建 chat.completions.create 的参数（固定顺序：tools、messages 前缀稳定）"""
+    request: Dict[str, Any] = {
+        "model": model,
+        "messages": _build_messages(chat_history, context),
+        "tools": _canonical_tools(),
+        "temperature": 0.7
+    }
+    if stream:
+        request["stream"] = True
+        request["stream_options"] = {"include_usage": True}
+    return request
+
+
+# 上游调用容错策略（见 LLM_ATTEMPT_TIMEOUT / LLM_DEADLINE / LLM_MAX_RETRIES / LLM_HEDGE / LLM_BREAKER_*）
+UPSTREAM = ResilientCaller()
+
+
+def _record_usage(usage: Any, span: Optional[Span] = None):
+    """记录并打印本次请求的前缀缓存命中情况，token 用量写入 LLM 调用的 span"""
+    parsed = PROMPT_CACHE_STATS.record(usage)
+    if parsed is not None:
+        debug(f"[DeepSeek API] Prompt tokens: {parsed['prompt_tokens']} "
+              f"(cache hit {parsed['hit_tokens']}, miss {parsed['miss_tokens']})")
+        if span is not None:
+            span.set(prompt_tokens=parsed["prompt_tokens"], cached_tokens=parsed["hit_tokens"],
+                     completion_tokens=getattr(usage, "completion_tokens", None) or 0)
+
+
+async def _execute_tool_call(
+    tool_call_id: str,
+    tool_name: str,
+    raw_arguments: str,
+    user_id: str,
+    parent: Optional[Span] = None
+) -> Dict[str, Any]:
+    """
+    执行单个工具调用
+
+    同步工具放到线程池中执行，避免阻塞事件循环；协程工具直接 await。
+
+    Args:
+        tool_call_id: 工具调用 ID
+        tool_name: 工具名称
+        raw_arguments: 模型给出的 JSON 参数字符串
+        user_id: 当前用户 ID（注入到需要用户身份的工具）
+        parent: 所属对话轮次的 span
+
+    Returns:
+        dict: 可直接追加到对话历史的 tool 消息
+    """
+    debug(f"📞 调用工具: {tool_name}")
+    span = TRACER.start("tool", parent, tool=tool_name, cached=False)
+
+    if tool_name in TOOL_REGISTRY:
+        try:
+            tool_args = json.loads(raw_arguments or "{}")
+            if debug_enabled():
+                print(f"   参数: {json.dumps(tool_args, ensure_ascii=False, indent=2)}")
+
+            # 调用对应的工具函数
+            tool_spec = TOOL_REGISTRY[tool_name]
+            tool_function = tool_spec["function"]
+
+            # 只读工具先查结果缓存（参数无法生成缓存键时直接执行）
+            cache_key = None
+            if tool_spec["cache_ttl"] > 0 and TOOL_CACHE.enabled:
+                try:
+                    cache_key = tool_spec["cache_key"](tool_args)
+                    hash(cache_key)
+                except Exception:
+                    cache_key = None
+
+            content = TOOL_CACHE.get(tool_name, cache_key) if cache_key is not None else None
+            if content is not None:
+                span.set(cached=True)
+                debug(f"   ♻️ 缓存结果: {content}\n")
+            else:
+                generation = TOOL_CACHE.generation(tool_name)
+
+                # 需要用户身份的工具（如 add_points、redeem_coupon）注入 user_id
+                if tool_spec["inject_user_id"]:
+                    tool_args["user_id"] = user_id
+
+                # 执行函数
+                if inspect.iscoroutinefunction(tool_function):
+                    tool_result = await tool_function(**tool_args)
+                else:
+                    # 同步工具放到默认线程池执行（asyncio.to_thread 需要 Python 3.9）
+                    loop = asyncio.get_running_loop()
+                    tool_result = await loop.run_in_executor(None, functools.partial(tool_function, **tool_args))
+
+                content = json.dumps(tool_result, ensure_ascii=False)
+                debug(f"   ✅ 结果: {content}\n")
+                if cache_key is not None:
+                    TOOL_CACHE.put(tool_name, cache_key, content, tool_spec["cache_ttl"], generation)
+
+        except Exception as e:
+            error_message = f"工具执行错误: {str(e)}"
+            print(f"   ❌ {error_message}\n")
+            span.status, span.error = "error", error_message
+            content = json.dumps({
+                "success": False,
+                "error": error_message
+            }, ensure_ascii=False)
+        except BaseException as e:
+            TRACER.finish(span, e)
+            raise
+    else:
+        error_message = f"未知工具: {tool_name}"
+        print(f"   ❌ {error_message}\n")
+        span.status, span.error = "error", error_message
+        content = json.dumps({
+            "success": False,
+            "error": error_message
+        }, ensure_ascii=False)
+
+    TRACER.finish(span)
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call_id,
+        "name": tool_name,
+        "content": content
+    }
+
+
+# 每个事件循环上按 user_id 分配的写锁（无人持有时自动回收）
+_USER_LOCKS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, weakref.WeakValueDictionary]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _user_lock(user_id: str) -> asyncio.Lock:
+    """获取当前事件循环上该用户的写锁（不同用户互不阻塞）"""
+    locks = _USER_LOCKS.setdefault(asyncio.get_running_loop(), weakref.WeakValueDictionary())
+    lock = locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[user_id] = lock
+    return lock
+
+
+async def _run_tool_calls(
+    content: Optional[str],
+    tool_calls: List[Dict[str, Any]],
+    chat_history: List[Dict[str, Any]],
+    user_id: str,
+    parent: Optional[Span] = None
+):
+    """
+    保存带工具调用的助手消息，执行工具并追加结果
+
+    只读工具并发执行；修改状态的工具持有该用户的锁，按模型给出的顺序串行执行。
+    结果始终按原始 tool_call 顺序追加到历史中。
+    """
+    debug(f"\n{'🔧 工具调用检测到':-^60}\n")
+
+    # 保存助手消息（包含工具调用请求）
+    chat_history.append({
+        "role": "assistant",
+        "content": content or "",
+        "tool_calls": tool_calls
+    })
+
+    async def run(tool_call: Dict[str, Any]) -> Dict[str, Any]:
+        tool_name = tool_call["function"]["name"]
+        call = _execute_tool_call(
+            tool_call["id"],
+            tool_name,
+            tool_call["function"]["arguments"],
+            user_id,
+            parent
+        )
+        tool_spec = TOOL_REGISTRY.get(tool_name)
+        if tool_spec is None or tool_spec["read_only"]:
+            return await call
+        # asyncio.Lock 按等待顺序唤醒，因此同一用户的写操作保持原始顺序
+        async with _user_lock(user_id):
+            return await call
+
+    # 处理每个工具调用（gather 按传入顺序返回结果）
+    results = await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+    chat_history.extend(results)
+
+    debug(f"{'🔄 继续对话以获取自然语言回复':-^60}\n")
+
+
+def _start_turn(user_input: str, chat_history: List[Dict[str, Any]]) -> int:
+    """将用户输入添加到对话历史，返回本轮开始前的历史长度（用于取消时回滚）"""
+    turn_start = len(chat_history)
+
+    chat_history.append({
+        "role": "user",
+        "content": user_input
+    })
+
+    debug(f"\n{'='*60}")
+    debug(f"用户: {user_input}")
+    debug(f"{'='*60}\n")
+
+    return turn_start
+
+
+def _finish_turn(final_response: str, chat_history: List[Dict[str, Any]]):
+    """将最终文本响应添加到历史"""
+    debug(f"\n{'✅ 对话完成':-^60}\n")
+
+    chat_history.append({
+        "role": "assistant",
+        "content": final_response
+    })
+
+    debug(f"[Concierge]: {final_response}\n")
+    debug(f"{'='*60}\n")
+
+
+# 回复缓存（见 RESPONSE_CACHE_TTL / RESPONSE_CACHE_SIZE / RESPONSE_CACHE_SIMILARITY）
+RESPONSE_CACHE = ResponseCache()
+
+
+def _cached_reply(
+    user_input: str,
+    chat_history: List[Dict[str, Any]],
+    policy: RoutingPolicy,
+    context: Optional[Dict[str, Any]]
+) -> Optional[str]:
+    """
+    查找回复缓存
+
+    只有会话的第一轮（回复不依赖历史）才会查找；路由策略（端点与模型）和会话上下文不同的回复互不命中。
+    """
+    if chat_history:
+        return None
+    reply = RESPONSE_CACHE.get(user_input, namespace=(policy.namespace, _render_context(context)))
+    if reply is not None:
+        debug("⚡ 命中回复缓存，跳过 LLM 调用")
+    return reply
+
+
+def _store_reply(
+    user_input: str,
+    chat_history: List[Dict[str, Any]],
+    turn_start: int,
+    policy: RoutingPolicy,
+    context: Optional[Dict[str, Any]]
+):
+    """
+    本轮可缓存时写入回复缓存
+
+    不缓存：依赖历史的轮次（非会话第一轮）、调用了不可缓存工具（修改状态的工具、
+    停车等实时数据）的轮次、没有正常结束的轮次。
+    """
+    turn = chat_history[turn_start:]
+    if turn_start != 0 or not turn or turn[-1]["role"] != "assistant" or turn[-1].get("tool_calls"):
+        RESPONSE_CACHE.skip()
+        return
+
+    for message in turn:
+        for tool_call in message.get("tool_calls") or []:
+            tool_spec = TOOL_REGISTRY.get(tool_call["function"]["name"])
+            if tool_spec is None or not tool_spec["response_cacheable"]:
+                RESPONSE_CACHE.skip()
+                return
+
+    RESPONSE_CACHE.put(user_input, turn[-1]["content"], namespace=(policy.namespace, _render_context(context)))
+
+
+# 意图快速路由（见 INTENT_ROUTER / INTENT_ROUTER_MIN_CONFIDENCE）
+INTENT_ROUTER = IntentRouter(SHOP_INDEX.search)
+
+
+def _collect_metrics() -> Dict[str, float]:
+    """缓存命中率、上游重试与熔断等进程内统计（渲染 /metrics 时读取）"""
+    upstream = UPSTREAM.snapshot()
+    return {
+        "concierge_prompt_cache_hit_rate": PROMPT_CACHE_STATS.hit_rate,
+        "concierge_response_cache_hit_rate": RESPONSE_CACHE.snapshot()["hit_rate"],
+        "concierge_tool_cache_hit_rate": TOOL_CACHE.snapshot()["hit_rate"],
+        "concierge_intent_router_hits": INTENT_ROUTER.stats["routed"],
+        "concierge_upstream_retries": upstream["retries"],
+        "concierge_upstream_hedges": upstream["hedges"],
+        "concierge_upstream_failures": upstream["failures"],
+        "concierge_upstream_open_breakers": sum(state == "open" for state in upstream["breakers"].values())
+    }
+
+
+METRICS.collectors.append(_collect_metrics)
+
+
+async def _fast_path(
+    user_input: str,
+    user_id: str,
+    parent: Optional[Span] = None
+) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    意图快速路由：高置信度的车位查询、店铺位置问题直接调用工具并按模板回复，不调用 LLM
+
+    Returns:
+        tuple: (模板回复, 本轮的工具调用消息与结果消息)，与 LLM 路径写入历史的形式相同，
+               后续轮次的模型能看到工具结果；不走快速路由时返回 None
+    """
+    route = INTENT_ROUTER.classify(user_input)
+    if route is None or route["tool"] not in TOOL_REGISTRY:
+        return None
+
+    tool_call = {
+        "id": f"fast_{uuid.uuid4().hex[:16]}",
+        "type": "function",
+        "function": {
+            "name": route["tool"],
+            "arguments": json.dumps(route["arguments"], ensure_ascii=False)
+        }
+    }
+    tool_message = await _execute_tool_call(
+        tool_call["id"], route["tool"], tool_call["function"]["arguments"], user_id, parent
+    )
+
+    # 结果不适合模板（例如店铺未找到、工具出错）时仍交给 LLM
+    reply = render_reply(route, json.loads(tool_message["content"]))
+    if reply is None:
+        return None
+
+    debug(f"⚡ 意图快速路由: {route['tool']}（置信度 {route['confidence']:.2f}），跳过 LLM 调用")
+    return reply, [
+        {"role": "assistant", "content": "", "tool_calls": [tool_call]},
+        tool_message
+    ]
+
+
+def _rollback_turn(chat_history: List[Dict[str, Any]], turn_start: int, reason: str = "本轮对话已取消"):
+    """
+    会话断开/任务被取消/上游调用失败时回滚本轮消息
+
+    避免历史中残留没有对应 tool 结果的 tool_call_id（下一次请求会被 API 拒绝）。
+    注意：已执行的工具副作用（如积分变动）不会被撤销。
+    """
+    del chat_history[turn_start:]
+    print(f"⚠️ {reason}，历史记录已回滚")
+
+
+# ==================== 路由 ====================
+
+# 未传入路由策略时按 (base_url, model) 复用的单端点策略（保留各自的滚动统计）
+_SINGLE_POLICIES: Dict[tuple, RoutingPolicy] = {}
+
+
+def _resolve_policy(
+    routing: Optional[RoutingPolicy],
+    model: Optional[str],
+    base_url: Optional[str],
+    api_key: Optional[str]
+) -> Tuple[RoutingPolicy, Optional[str]]:
+    """
+    确定本轮的路由策略
+
+    优先级：显式传入的 routing > LLM_ENDPOINTS 配置的全局策略（未指定 model / base_url 时）
+    > 由 model + base_url 构成的单端点策略（与旧接口行为相同）。
+
+    Returns:
+        tuple: (路由策略, 调用方 API Key)；有端点没有自己的 Key 时调用方 Key 必须存在
+    """
+    policy = routing
+    if policy is None and DEFAULT_POLICY is not None and model is None and base_url is None:
+        policy = DEFAULT_POLICY
+    if policy is None:
+        policy = _SINGLE_POLICIES.get((base_url, model))
+        if policy is None:
+            policy = _SINGLE_POLICIES.setdefault((base_url, model), RoutingPolicy.single(base_url, model))
+
+    if any(endpoint.api_key is None for endpoint in policy.endpoints):
+        api_key = _resolve_api_key(api_key)
+    return policy, api_key
+
+
+async def _create_completion(
+    policy: RoutingPolicy,
+    chat_history: List[Dict[str, Any]],
+    context: Optional[Dict[str, Any]],
+    api_key: Optional[str],
+    stream: bool = False,
+    span: Optional[Span] = None
+) -> Any:
+    """
+    按路由策略发起一次补全请求
+
+    端点按 policy.rank() 的顺序尝试：当前端点重试用尽、超时或熔断（UpstreamError）时换下一个；
+    每个端点的首包延迟与成败计入其滚动统计。请求体只构建一次，换端点时只替换 model。
+    最终使用的端点、模型、轮次类型与首包延迟写入 span。
+    """
+    kind = policy.turn_kind(chat_history)
+    request = _build_request("", chat_history, context, stream)
+    error: Optional[UpstreamError] = None
+
+    for endpoint in policy.rank(lambda e: UPSTREAM.breaker(e.base_url or DEEPSEEK_BASE_URL).available()):
+        client = get_async_client(endpoint.api_key or api_key, endpoint.base_url)
+        endpoint_request = dict(request, model=endpoint.model_for(kind))
+        started = time.monotonic()
+        try:
+            result = await UPSTREAM.call(
+                lambda: client.chat.completions.create(**endpoint_request),
+                key=endpoint.base_url or DEEPSEEK_BASE_URL
+            )
+        except UpstreamError as e:
+            endpoint.record(None, ok=False)
+            print(f"⚠️ 端点 {endpoint.name} 不可用（{e}），尝试下一个端点")
+            error = e
+            continue
+
+        latency = time.monotonic() - started
+        endpoint.record(latency, ok=True)
+        debug(f"[Routing] {endpoint.name} / {endpoint_request['model']}（{kind}）")
+        if span is not None:
+            span.set(endpoint=endpoint.name, model=endpoint_request["model"], kind=kind,
+                     first_byte_ms=round(latency * 1000, 1))
+        return result
+
+    raise error
 
 
 # ==================== 核心 Chat 函数 ====================
 
-def chat_with_concierge(
+MAX_ITERATIONS = 5  # 防止无限循环
+
+
+async def achat_with_concierge(
     user_input: str,
     chat_history: List[Dict[str, Any]],
     user_id: str = "demo_user",
     api_key: Optional[str] = None,
-    model: str = "deepseek-chat"
-) -> tuple[str, List[Dict[str, Any]]]:
+    model: Optional[str] = None,
+    base_url: Optional[str] = None,
+    context: Optional[Dict[str, Any]] = None,
+    routing: Optional[RoutingPolicy] = None
+) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    与 Dubai Mall Concierge Agent 进行对话
+    与 Dubai Mall Concierge Agent 进行对话（asyncio 版本）
+
+    上游请求受 upstream_semaphore() 限制同时在途数量；任务被取消（如访客断开连接）时，
+    本轮写入 chat_history 的消息会被回滚并重新抛出 CancelledError。
 
     Args:
         user_input: 用户输入的消息
         chat_history: 历史对话记录（OpenAI API 格式）
         user_id: 用户唯一标识符
         api_key: DeepSeek API Key（如未提供则从环境变量读取）
-        model: 使用的模型（默认：deepseek-chat）
+        model: 固定使用的模型（默认读取 DEEPSEEK_MODEL，即 deepseek-chat）；保留用于兼容，
+               新代码请使用 routing
+        base_url: API 地址（默认读取 DEEPSEEK_BASE_URL，可指向本地桩服务器）
+        context: 会话级动态上下文（如 {"kiosk_location": "Ground Floor, Zone B"}），
+                 放在稳定的 system prompt 之后，不影响前缀缓存
+        routing: 路由策略（多个端点、简单轮次使用轻量模型）；为空时使用 LLM_ENDPOINTS 配置，
+                 未配置时由 model + base_url 构成单端点策略
 
     Returns:
         tuple: (assistant_response, updated_chat_history)
@@ -264,163 +937,327 @@ def chat_with_concierge(
             - updated_chat_history: 更新后的对话历史
     """
 
-    # 初始化 OpenAI 客户端（DeepSeek API）
-    if api_key is None:
-        api_key = os.environ.get("DEEPSEEK_API_KEY")
+    # 客户端从连接池按端点复用，避免每轮对话重新建立 TLS 连接
+    policy, api_key = _resolve_policy(routing, model, base_url, api_key)
 
-    if not api_key:
-        raise ValueError(
-            "未找到 DeepSeek API Key。请设置环境变量 DEEPSEEK_API_KEY "
-            "或在调用函数时传入 api_key 参数。"
-        )
+    with TRACER.span("turn", user_id=user_id, stream=False) as turn:
+        fast = await _fast_path(user_input, user_id, turn)
+        if fast is not None:
+            reply, tool_messages = fast
+            turn.set(path="fast_path")
+            _start_turn(user_input, chat_history)
+            chat_history.extend(tool_messages)
+            _finish_turn(reply, chat_history)
+            return reply, chat_history
 
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://api.deepseek.com"
-    )
+        cached = _cached_reply(user_input, chat_history, policy, context)
+        if cached is not None:
+            turn.set(path="response_cache")
+            _start_turn(user_input, chat_history)
+            _finish_turn(cached, chat_history)
+            return cached, chat_history
 
-    # 将用户输入添加到对话历史
-    chat_history.append({
-        "role": "user",
-        "content": user_input
-    })
+        turn.set(path="llm")
+        turn_start = _start_turn(user_input, chat_history)
 
-    print(f"\n{'='*60}")
-    print(f"用户: {user_input}")
-    print(f"{'='*60}\n")
+        # 初始化响应文本
+        final_response = ""
 
-    # 初始化响应文本
-    final_response = ""
+        # 开始对话循环（处理可能的多轮工具调用）
+        iteration = 0
 
-    # 开始对话循环（处理可能的多轮工具调用）
-    max_iterations = 5  # 防止无限循环
-    iteration = 0
+        try:
+            while iteration < MAX_ITERATIONS:
+                iteration += 1
+                turn.set(iterations=iteration)
+
+                with TRACER.span("llm_call", turn, iteration=iteration, stream=False) as call:
+                    # 调用上游（按路由策略选择端点与模型；失败时按 UPSTREAM 策略重试或换端点）
+                    async with upstream_semaphore():
+                        response = await _create_completion(policy, chat_history, context, api_key, span=call)
+
+                    _record_usage(response.usage, call)
+                    assistant_message = response.choices[0].message
+                    finish_reason = response.choices[0].finish_reason
+                    call.set(finish_reason=finish_reason)
+
+                debug(f"[DeepSeek API] Finish Reason: {finish_reason}")
+
+                # 检查是否需要工具调用
+                if finish_reason == "tool_calls" and assistant_message.tool_calls:
+                    await _run_tool_calls(
+                        assistant_message.content,
+                        [
+                            {
+                                "id": tc.id,
+                                "type": tc.type,
+                                "function": {
+                                    "name": tc.function.name,
+                                    "arguments": tc.function.arguments
+                                }
+                            } for tc in assistant_message.tool_calls
+                        ],
+                        chat_history,
+                        user_id,
+                        turn
+                    )
+
+                    # 继续循环，让模型基于工具结果生成自然语言回复
+                    continue
+
+                # finish_reason 是 "stop"，对话结束
+                final_response = assistant_message.content or ""
+                _finish_turn(final_response, chat_history)
+                _store_reply(user_input, chat_history, turn_start, policy, context)
+                break
+            else:
+                turn.set(max_iterations_hit=True)
+                print(f"⚠️ 警告: 达到最大迭代次数 ({MAX_ITERATIONS})")
+
+        except asyncio.CancelledError:
+            _rollback_turn(chat_history, turn_start)
+            raise
+        except Exception:
+            # 上游不可用等错误：回滚后访客可以直接重试同一个问题
+            _rollback_turn(chat_history, turn_start, "本轮对话失败")
+            raise
 
-    while iteration < max_iterations:
-        iteration += 1
+    return final_response, chat_history
 
-        # 构建消息列表（添加 system prompt）
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + chat_history
 
-        # 调用 DeepSeek API
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            tools=TOOL_DEFINITIONS,
-            temperature=0.7
-        )
+def chat_with_concierge(
+    user_input: str,
+    chat_history: List[Dict[str, Any]],
+    user_id: str = "demo_user",
+    api_key: Optional[str] = None,
+    model: Optional[str] = None,
+    base_url: Optional[str] = None,
+    context: Optional[Dict[str, Any]] = None,
+    routing: Optional[RoutingPolicy] = None
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    与 Dubai Mall Concierge Agent 进行对话
 
-        assistant_message = response.choices[0].message
-        finish_reason = response.choices[0].finish_reason
-
-        print(f"[DeepSeek API] Finish Reason: {finish_reason}")
-
-        # 检查是否需要工具调用
-        if finish_reason == "tool_calls" and assistant_message.tool_calls:
-            print(f"\n{'🔧 工具调用检测到':-^60}\n")
-
-            # 保存助手消息（包含工具调用请求）
-            chat_history.append({
-                "role": "assistant",
-                "content": assistant_message.content or "",
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": tc.type,
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    } for tc in assistant_message.tool_calls
-                ]
-            })
-
-            # 处理每个工具调用
-            for tool_call in assistant_message.tool_calls:
-                tool_name = tool_call.function.name
-                tool_args = json.loads(tool_call.function.arguments)
-                tool_call_id = tool_call.id
-
-                print(f"📞 调用工具: {tool_name}")
-                print(f"   参数: {json.dumps(tool_args, ensure_ascii=False, indent=2)}")
+    同步封装：在共享的后台事件循环上运行 achat_with_concierge。
 
-                # 执行工具函数
-                if tool_name in TOOL_FUNCTION_MAP:
-                    try:
-                        # 调用对应的工具函数
-                        tool_function = TOOL_FUNCTION_MAP[tool_name]
-
-                        # 特殊处理 add_points 和 redeem_coupon（需要注入 user_id）
-                        if tool_name in ["add_points", "redeem_coupon"]:
-                            tool_args["user_id"] = user_id
-
-                        # 执行函数
-                        tool_result = tool_function(**tool_args)
-
-                        print(f"   ✅ 结果: {json.dumps(tool_result, ensure_ascii=False)}\n")
-
-                        # 将工具结果添加到对话历史
-                        chat_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call_id,
-                            "name": tool_name,
-                            "content": json.dumps(tool_result, ensure_ascii=False)
-                        })
-
-                    except Exception as e:
-                        error_message = f"工具执行错误: {str(e)}"
-                        print(f"   ❌ {error_message}\n")
-
-                        chat_history.append({
-                            "role": "tool",
-                            "tool_call_id": tool_call_id,
-                            "name": tool_name,
-                            "content": json.dumps({
-                                "success": False,
-                                "error": error_message
-                            }, ensure_ascii=False)
-                        })
-                else:
-                    error_message = f"未知工具: {tool_name}"
-                    print(f"   ❌ {error_message}\n")
-
-                    chat_history.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call_id,
-                        "name": tool_name,
-                        "content": json.dumps({
-                            "success": False,
-                            "error": error_message
-                        }, ensure_ascii=False)
-                    })
-
-            print(f"{'🔄 继续对话以获取自然语言回复':-^60}\n")
-
-            # 继续循环，让模型基于工具结果生成自然语言回复
-            continue
+    Args:
+        user_input: 用户输入的消息
+        chat_history: 历史对话记录（OpenAI API 格式）
+        user_id: 用户唯一标识符
+        api_key: DeepSeek API Key（如未提供则从环境变量读取）
+        model: 固定使用的模型（默认读取 DEEPSEEK_MODEL，即 deepseek-chat）；保留用于兼容，
+               新代码请使用 routing
+        base_url: API 地址（默认读取 DEEPSEEK_BASE_URL，可指向本地桩服务器）
+        context: 会话级动态上下文（如 {"kiosk_location": "Ground Floor, Zone B"}），
+                 放在稳定的 system prompt 之后，不影响前缀缓存
+        routing: 路由策略（多个端点、简单轮次使用轻量模型）；为空时使用 LLM_ENDPOINTS 配置，
+                 未配置时由 model + base_url 构成单端点策略
+
+    Returns:
+        tuple: (assistant_response, updated_chat_history)
+            - assistant_response: Agent 的文本回复
+            - updated_chat_history: 更新后的对话历史
+    """
+    return run_sync(achat_with_concierge(
+        user_input=user_input,
+        chat_history=chat_history,
+        user_id=user_id,
+        api_key=api_key,
+        model=model,
+        base_url=base_url,
+        context=context,
+        routing=routing
+    ))
 
-        else:
-            # finish_reason 是 "stop"，对话结束
-            print(f"\n{'✅ 对话完成':-^60}\n")
 
-            # 提取最终文本响应
-            final_response = assistant_message.content or ""
+def _merge_tool_call_deltas(pending: Dict[int, Dict[str, Any]], deltas) -> None:
+    """
+    按 index 合并流式返回的 tool_calls 分片
 
-            # 将最终响应添加到历史
-            chat_history.append({
-                "role": "assistant",
-                "content": final_response
-            })
+    第一个分片携带 id / name，后续分片只追加 arguments 字符串。
+    """
+    for delta in deltas:
+        slot = pending.setdefault(delta.index, {
+            "id": "",
+            "type": "function",
+            "function": {"name": "", "arguments": ""}
+        })
+        if delta.id:
+            slot["id"] = delta.id
+        if delta.type:
+            slot["type"] = delta.type
+        if delta.function is not None:
+            if delta.function.name:
+                slot["function"]["name"] += delta.function.name
+            if delta.function.arguments:
+                slot["function"]["arguments"] += delta.function.arguments
+
+
+async def astream_concierge(
+    user_input: str,
+    chat_history: List[Dict[str, Any]],
+    user_id: str = "demo_user",
+    api_key: Optional[str] = None,
+    model: Optional[str] = None,
+    base_url: Optional[str] = None,
+    context: Optional[Dict[str, Any]] = None,
+    routing: Optional[RoutingPolicy] = None
+) -> AsyncIterator[str]:
+    """
+    流式版本的 achat_with_concierge：逐段 yield 文本增量
 
-            print(f"[Concierge]: {final_response}\n")
-            print(f"{'='*60}\n")
+    工具调用会在流中途组装并执行，随后继续流式输出模型的自然语言回复。
+    生成器结束时 chat_history 已被原地更新；中途被取消或关闭时本轮消息会被回滚。
 
-            break
+    Args:
+        与 achat_with_concierge 相同
+
+    Yields:
+        str: 助手回复的文本增量
+    """
 
-    if iteration >= max_iterations:
-        print(f"⚠️ 警告: 达到最大迭代次数 ({max_iterations})")
+    policy, api_key = _resolve_policy(routing, model, base_url, api_key)
+
+    with TRACER.span("turn", user_id=user_id, stream=True) as turn:
+        fast = await _fast_path(user_input, user_id, turn)
+        if fast is not None:
+            reply, tool_messages = fast
+            turn.set(path="fast_path")
+            turn_start = _start_turn(user_input, chat_history)
+            chat_history.extend(tool_messages)
+            try:
+                yield reply
+            except (asyncio.CancelledError, GeneratorExit):
+                _rollback_turn(chat_history, turn_start)
+                raise
+            _finish_turn(reply, chat_history)
+            return
+
+        cached = _cached_reply(user_input, chat_history, policy, context)
+        if cached is not None:
+            turn.set(path="response_cache")
+            turn_start = _start_turn(user_input, chat_history)
+            try:
+                yield cached
+            except (asyncio.CancelledError, GeneratorExit):
+                _rollback_turn(chat_history, turn_start)
+                raise
+            _finish_turn(cached, chat_history)
+            return
+
+        turn.set(path="llm")
+        turn_start = _start_turn(user_input, chat_history)
+        iteration = 0
 
-    return final_response, chat_history
+        try:
+            while iteration < MAX_ITERATIONS:
+                iteration += 1
+                turn.set(iterations=iteration)
+
+                content_parts: List[str] = []
+                pending_tool_calls: Dict[int, Dict[str, Any]] = {}
+                finish_reason = None
+
+                with TRACER.span("llm_call", turn, iteration=iteration, stream=True) as call:
+                    async with upstream_semaphore():
+                        stream = await _create_completion(policy, chat_history, context, api_key,
+                                                          stream=True, span=call)
+
+                        async for chunk in UPSTREAM.guard_stream(stream):
+                            if chunk.usage is not None:
+                                _record_usage(chunk.usage, call)
+                            if not chunk.choices:
+                                continue
+                            choice = chunk.choices[0]
+                            delta = choice.delta
+
+                            if delta.content:
+                                if not content_parts:
+                                    call.set(first_token_ms=call.elapsed_ms())
+                                content_parts.append(delta.content)
+                                yield delta.content
+
+                            if delta.tool_calls:
+                                _merge_tool_call_deltas(pending_tool_calls, delta.tool_calls)
+
+                            if choice.finish_reason:
+                                finish_reason = choice.finish_reason
+
+                    call.set(finish_reason=finish_reason)
+
+                debug(f"[DeepSeek API] Finish Reason: {finish_reason}")
+
+                if finish_reason == "tool_calls" and pending_tool_calls:
+                    await _run_tool_calls(
+                        "".join(content_parts),
+                        [pending_tool_calls[i] for i in sorted(pending_tool_calls)],
+                        chat_history,
+                        user_id,
+                        turn
+                    )
+                    continue
+
+                _finish_turn("".join(content_parts), chat_history)
+                _store_reply(user_input, chat_history, turn_start, policy, context)
+                break
+            else:
+                turn.set(max_iterations_hit=True)
+                print(f"⚠️ 警告: 达到最大迭代次数 ({MAX_ITERATIONS})")
+
+        except (asyncio.CancelledError, GeneratorExit):
+            _rollback_turn(chat_history, turn_start)
+            raise
+        except Exception:
+            _rollback_turn(chat_history, turn_start, "本轮对话失败")
+            raise
+
+
+def stream_concierge(
+    user_input: str,
+    chat_history: List[Dict[str, Any]],
+    user_id: str = "demo_user",
+    api_key: Optional[str] = None,
+    model: Optional[str] = None,
+    base_url: Optional[str] = None,
+    context: Optional[Dict[str, Any]] = None,
+    routing: Optional[RoutingPolicy] = None
+) -> Iterator[str]:
+    """
+    流式版本的 chat_with_concierge（同步生成器）
+
+    同步封装：在共享的后台事件循环上逐段驱动 astream_concierge。
+    生成器结束时 chat_history 已被原地更新，最终完整回复作为生成器返回值。
+
+    Yields:
+        str: 助手回复的文本增量
+    """
+    turn_start = len(chat_history)
+    agen = astream_concierge(
+        user_input=user_input,
+        chat_history=chat_history,
+        user_id=user_id,
+        api_key=api_key,
+        model=model,
+        base_url=base_url,
+        context=context,
+        routing=routing
+    )
+
+    try:
+        while True:
+            try:
+                delta = run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                break
+            yield delta
+    finally:
+        run_sync(agen.aclose())
+
+    # 最终回复：本轮最后一条不含工具调用的助手消息
+    for message in reversed(chat_history[turn_start:]):
+        if message["role"] == "assistant" and not message.get("tool_calls"):
+            return message["content"]
+    return ""
 
 
 # ==================== 辅助函数 ====================
@@ -437,9 +1274,7 @@ def get_user_coupons(user_id: str = "demo_user") -> List[Dict]:
 
 def reset_user_state(user_id: str = "demo_user"):
     """重置用户状态（用于测试）"""
-    if user_id in USER_STATE.users:
-        del USER_STATE.users[user_id]
-        USER_STATE.save()  # 保存重置后的状态
+    USER_STATE.reset_user(user_id)
     print(f"✅ 用户 {user_id} 状态已重置")
 
 
@@ -508,3 +1343,6 @@ if __name__ == "__main__":
             print(f"\n❌ 错误: {str(e)}\n")
             import traceback
             traceback.print_exc()
+
+    # 关闭连接池
+    shutdown_clients()
@@ -5,16 +5,19 @@ Dubai Mall Intelligent Concierge - Streamlit Demo
 
 import streamlit as st
 import os
+import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Any, Dict, Optional
 from dotenv import load_dotenv
 
 # 加载.env文件中的环境变量
 load_dotenv()
 
 # 导入核心模块
-from agent_core import chat_with_concierge, get_user_points, get_user_coupons, reset_user_state
+from agent_core import stream_concierge, get_user_points, get_user_coupons, reset_user_state
 from mock_data import USER_STATE
+from resilience import UpstreamError
+from session_store import SESSION_STORE
 
 
 # ==================== 页面配置 ====================
@@ -198,18 +201,15 @@ st.markdown("""
 
 def init_session_state():
     """初始化 Streamlit Session State"""
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
-
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    if "session_id" not in st.session_state:
+        # 会话 ID 放在 URL 中（?session=...），刷新页面或被分配到另一个工作进程时都能恢复对话
+        session_id = st.query_params.get("session") or uuid.uuid4().hex
+        st.query_params["session"] = session_id
+        st.session_state.session_id = session_id
 
     if "user_id" not in st.session_state:
         st.session_state.user_id = "demo_user"
 
-    if "parking_info" not in st.session_state:
-        st.session_state.parking_info = None
-
     if "api_key" not in st.session_state:
         st.session_state.api_key = os.environ.get("DEEPSEEK_API_KEY", "")
 
@@ -222,13 +222,29 @@ def init_session_state():
     if "pending_input" not in st.session_state:
         st.session_state.pending_input = None
 
-    if "waiting_for_response" not in st.session_state:
-        st.session_state.waiting_for_response = False
+
+def current_session() -> Dict[str, Any]:
+    """
+    从会话存储取当前会话（对话历史不常驻 Streamlit 进程内存，见 session_store.py）
+
+    - history:      传给 Agent 的 chat_history
+    - messages:     聊天区显示的消息（带时间戳）
+    - parking_info: 侧边栏显示的停车信息
+    """
+    session = SESSION_STORE.get(st.session_state.session_id)
+    if session is None:
+        session = {"history": [], "messages": [], "parking_info": None}
+    return session
+
+
+def save_session(session: Dict[str, Any]):
+    """保存当前会话"""
+    SESSION_STORE.put(st.session_state.session_id, session)
 
 
 # ==================== 侧边栏 ====================
 
-def render_sidebar():
+def render_sidebar(session: Dict[str, Any]):
     """渲染侧边栏 - 用户状态面板"""
     with st.sidebar:
         # 标题
@@ -280,9 +296,9 @@ def render_sidebar():
         # 停车状态
         st.markdown('<div class="sidebar-section">', unsafe_allow_html=True)
         st.markdown("#### 🚗 Parking Status")
-        if st.session_state.parking_info:
-            st.success(f"**{st.session_state.parking_info['plate']}**")
-            st.write(f"📍 Location: **{st.session_state.parking_info['spot']}**")
+        if session["parking_info"]:
+            st.success(f"**{session['parking_info']['plate']}**")
+            st.write(f"📍 Location: **{session['parking_info']['spot']}**")
         else:
             st.info("No parking info yet")
         st.markdown('</div>', unsafe_allow_html=True)
@@ -292,11 +308,8 @@ def render_sidebar():
         # 重置按钮
         if st.button("🔄 Reset Demo", type="secondary", use_container_width=True):
             reset_user_state(user_id)
-            st.session_state.chat_history = []
-            st.session_state.messages = []
-            st.session_state.parking_info = None
+            SESSION_STORE.delete(st.session_state.session_id)
             st.session_state.first_load = True
-            st.session_state.waiting_for_response = False
             st.rerun()
 
         # API Key 设置（折叠）
@@ -319,15 +332,15 @@ def render_sidebar():
 
 # ==================== 主聊天界面 ====================
 
-def render_chat_message(role: str, content: str, timestamp: Optional[str] = None):
-    """渲染单条聊天消息"""
+def render_chat_message(role: str, content: str, timestamp: Optional[str] = None, target=None):
+    """渲染单条聊天消息（target 为 st.empty() 占位符时可反复覆盖，用于流式输出）"""
     role_name = "You" if role == "user" else "Concierge"
     role_emoji = "👤" if role == "user" else "🤖"
 
     if timestamp is None:
         timestamp = datetime.now().strftime("%H:%M")
 
-    st.markdown(f"""
+    (target or st).markdown(f"""
     <div class="chat-message {role}">
         <div class="role">{role_emoji} {role_name}</div>
         <div class="content">{content}</div>
@@ -346,21 +359,90 @@ def render_welcome_banner():
     """, unsafe_allow_html=True)
 
 
+def handle_user_input(user_input: str, chat_container, session: Dict[str, Any]):
+    """显示用户消息，并将 Concierge 的回复逐段流式渲染到聊天区（结束后保存会话）"""
+    # 记录时间戳
+    timestamp = datetime.now().strftime("%H:%M")
+
+    # 添加用户消息到显示列表
+    session["messages"].append({
+        "role": "user",
+        "content": user_input,
+        "timestamp": timestamp
+    })
+
+    with chat_container:
+        render_chat_message("user", user_input, timestamp)
+        placeholder = st.empty()
+
+    # 首个文本片段到达前（包括工具执行期间）显示思考提示
+    render_chat_message("assistant", "💭 Concierge is thinking...", target=placeholder)
+
+    try:
+        # 调用 Agent 核心函数（流式），chat_history 会被原地更新
+        response = ""
+        for delta in stream_concierge(
+            user_input=user_input,
+            chat_history=session["history"],
+            user_id=st.session_state.user_id,
+            api_key=st.session_state.api_key
+        ):
+            response += delta
+            render_chat_message("assistant", response + " ▌", target=placeholder)
+
+        render_chat_message("assistant", response, target=placeholder)
+
+        # 添加 Assistant 回复到显示列表
+        session["messages"].append({
+            "role": "assistant",
+            "content": response,
+            "timestamp": datetime.now().strftime("%H:%M")
+        })
+
+        # 检查是否查询了停车信息（解析响应中的停车位）
+        if "DXB-" in user_input or "parking" in user_input.lower():
+            # 尝试从用户输入中提取车牌号
+            import re
+            plate_match = re.search(r'[A-Z]{2,3}-\d{4}', user_input.upper())
+            if plate_match and ("B1-" in response or "B2-" in response):
+                plate = plate_match.group()
+                spot_match = re.search(r'B[12]-[A-Z]\d{2}', response)
+                if spot_match:
+                    session["parking_info"] = {
+                        "plate": plate,
+                        "spot": spot_match.group()
+                    }
+
+    except UpstreamError as e:
+        # 上游超时或熔断中：本轮已回滚，稍后重新发送同一个问题即可
+        placeholder.empty()
+        st.warning(f"⏳ The concierge is busy right now, please try again in a moment. ({str(e)})")
+
+    except Exception as e:
+        placeholder.empty()
+        st.error(f"❌ Error: {str(e)}")
+        st.info("💡 Tip: Make sure your API key is valid and you have internet connection.")
+
+    # 失败的轮次已从 history 回滚，但用户消息仍保留在显示列表中
+    save_session(session)
+
+    # 更新版本号，确保侧边栏重新渲染
+    st.session_state.points_version += 1
+
+
 def main():
     """主应用程序"""
 
     # 初始化
     init_session_state()
-
-    # 渲染侧边栏
-    render_sidebar()
+    session = current_session()
 
     # 主标题
     st.markdown('<h1 class="main-title">🛍️ Dubai Mall Intelligent Concierge</h1>', unsafe_allow_html=True)
     st.markdown('<p class="subtitle">Your AI-Powered Shopping Companion</p>', unsafe_allow_html=True)
 
     # 如果是首次加载，显示欢迎消息
-    if st.session_state.first_load and len(st.session_state.messages) == 0:
+    if st.session_state.first_load and len(session["messages"]) == 0:
         render_welcome_banner()
         st.session_state.first_load = False
 
@@ -369,7 +451,7 @@ def main():
 
     # 显示历史消息
     with chat_container:
-        for message in st.session_state.messages:
+        for message in session["messages"]:
             render_chat_message(
                 role=message["role"],
                 content=message["content"],
@@ -384,91 +466,16 @@ def main():
         user_input = st.session_state.pending_input
         st.session_state.pending_input = None  # 清除待处理输入
 
-    # 步骤1：处理新的用户输入（立即显示用户消息）
-    if user_input and not st.session_state.waiting_for_response:
+    # 处理新的用户输入：立即显示用户消息，并流式渲染助手回复（无需额外 rerun）
+    if user_input:
         # 检查 API Key
         if not st.session_state.api_key:
             st.error("⚠️ Please set your DeepSeek API Key in the sidebar settings.")
-            st.stop()
-
-        # 记录时间戳
-        timestamp = datetime.now().strftime("%H:%M")
-
-        # 添加用户消息到显示列表
-        st.session_state.messages.append({
-            "role": "user",
-            "content": user_input,
-            "timestamp": timestamp
-        })
-
-        # 设置等待响应状态
-        st.session_state.waiting_for_response = True
-
-        # 立即刷新界面，显示用户消息
-        st.rerun()
-
-    # 步骤2：如果正在等待响应，调用AI API
-    if st.session_state.waiting_for_response:
-        # 获取最后一条用户消息
-        last_user_message = None
-        for msg in reversed(st.session_state.messages):
-            if msg["role"] == "user":
-                last_user_message = msg["content"]
-                break
-
-        if last_user_message:
-            # 显示加载状态
-            with st.spinner("Concierge is thinking..."):
-                try:
-                    # 调用 Agent 核心函数
-                    response, updated_history = chat_with_concierge(
-                        user_input=last_user_message,
-                        chat_history=st.session_state.chat_history,
-                        user_id=st.session_state.user_id,
-                        api_key=st.session_state.api_key
-                    )
-
-                    # 更新聊天历史
-                    st.session_state.chat_history = updated_history
-
-                    # 添加 Assistant 回复到显示列表
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": response,
-                        "timestamp": datetime.now().strftime("%H:%M")
-                    })
-
-                    # 检查是否查询了停车信息（解析响应中的停车位）
-                    if "DXB-" in last_user_message or "parking" in last_user_message.lower():
-                        # 尝试从用户输入中提取车牌号
-                        import re
-                        plate_match = re.search(r'[A-Z]{2,3}-\d{4}', last_user_message.upper())
-                        if plate_match and ("B1-" in response or "B2-" in response):
-                            plate = plate_match.group()
-                            spot_match = re.search(r'B[12]-[A-Z]\d{2}', response)
-                            if spot_match:
-                                st.session_state.parking_info = {
-                                    "plate": plate,
-                                    "spot": spot_match.group()
-                                }
-
-                    # 更新版本号，确保侧边栏重新渲染
-                    st.session_state.points_version += 1
-
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
-                    st.info("💡 Tip: Make sure your API key is valid and you have internet connection.")
-                    # 即使出错也增加版本号
-                    st.session_state.points_version += 1
-
-        # 清除等待状态
-        st.session_state.waiting_for_response = False
-
-        # 刷新界面，显示AI回复
-        st.rerun()
+        else:
+            handle_user_input(user_input, chat_container, session)
 
     # 快捷建议按钮（仅在空白时显示）
-    if len(st.session_state.messages) == 0:
+    if len(session["messages"]) == 0:
         st.markdown("### 💡 Quick Start Suggestions")
         col1, col2, col3 = st.columns(3)
 
@@ -487,6 +494,9 @@ def main():
                 st.session_state.pending_input = "I'm bored, entertain me!"
                 st.rerun()
 
+    # 最后渲染侧边栏，确保显示本轮工具调用后的积分与优惠券
+    render_sidebar(session)
+
 
 # ==================== 应用入口 ====================
 
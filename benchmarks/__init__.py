@@ -0,0 +1,134 @@
+"""
+迪拜商场互动服务 Agent - 基准测试
+离线运行（本地桩服务器代替 DeepSeek API），每次运行的结果保存为 JSON 文件，便于比较不同版本：
+
+    python -m benchmarks.load                      # 端到端吞吐与延迟
+    python -m benchmarks.load --baseline benchmarks/results/load-....json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from typing import Any, Dict, List, Optional, Sequence
+
+
+# 仓库根目录（基准测试按 python -m benchmarks.xxx 从这里运行）
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 结果文件目录
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+# ==================== 统计 ====================
+
+def percentile(sorted_values: Sequence[float], q: float) -> Optional[float]:
+    """已排序序列的分位数（线性插值），空序列返回 None"""
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(values: Sequence[float], digits: int = 3) -> Dict[str, Any]:
+    """p50 / p95 / p99 / 平均 / 最大值"""
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+    return {
+        "count": len(ordered),
+        "p50": round(percentile(ordered, 0.50), digits),
+        "p95": round(percentile(ordered, 0.95), digits),
+        "p99": round(percentile(ordered, 0.99), digits),
+        "mean": round(sum(ordered) / len(ordered), digits),
+        "max": round(ordered[-1], digits)
+    }
+
+
+# ==================== 结果文件 ====================
+
+def git_commit() -> Optional[str]:
+    """当前代码版本（不在 git 仓库中时为 None）"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, timeout=5, check=True
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def write_artifact(
+    name: str,
+    config: Dict[str, Any],
+    results: Dict[str, Any],
+    out_dir: str = RESULTS_DIR
+) -> str:
+    """
+    保存一次运行的结果
+
+    Returns:
+        str: 结果文件路径（benchmarks/results/<name>-<时间>-<版本>.json）
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    commit = git_commit()
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(out_dir, f"{name}-{stamp}{'-' + commit if commit else ''}.json")
+    artifact = {
+        "benchmark": name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def load_artifact(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(
+    current: Dict[str, Any],
+    baseline: Dict[str, Any],
+    metrics: List[str],
+    lower_is_better: Sequence[str] = ()
+) -> List[str]:
+    """
+    与基线结果逐项比较
+
+    Args:
+        current / baseline: 结果（artifact["results"]）
+        metrics: 要比较的指标路径，例如 "turn_latency_ms.p95"
+        lower_is_better: 其中越小越好的指标（其余越大越好）
+
+    Returns:
+        list: 每个指标一行的比较文本，变差超过 10% 的行带 ⚠️
+    """
+    def lookup(results: Dict[str, Any], path: str) -> Optional[float]:
+        value: Any = results
+        for part in path.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value if isinstance(value, (int, float)) else None
+
+    lines = []
+    for metric in metrics:
+        now, before = lookup(current, metric), lookup(baseline, metric)
+        if now is None or before is None:
+            continue
+        change = (now - before) / before if before else 0.0
+        worse = change > 0.10 if metric in lower_is_better else change < -0.10
+        lines.append(f"{'⚠️' if worse else '  '} {metric:28} {before:>12g} → {now:<12g} ({change:+.1%})")
+    return lines
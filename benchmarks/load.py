@@ -0,0 +1,417 @@
+"""
+迪拜商场互动服务 Agent - 端到端负载测试
+本地桩服务器按对话语料回放脚本化的 tool_calls 与回复（可配置延迟与抖动），
+以目标并发数重放语料中的对话，统计每轮延迟、上游耗时、工具耗时与吞吐量
+
+    python -m benchmarks.load --concurrency 16 --repeat 20 --latency 0.3
+    python -m benchmarks.load --stream --no-shortcuts --baseline benchmarks/results/load-....json
+    python -m benchmarks.load --http --stream      # 经由 server.py 的 HTTP 接口（含 HTTP/SSE 开销）
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import asyncio
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks import RESULTS_DIR, ROOT, compare, load_artifact, summarize, write_artifact
+
+import agent_core
+import mock_data
+from server import ConciergeServer
+from session_store import SessionStore
+from stub_server import StubLLMServer
+from tracing import TRACER, Span, set_debug
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_CORPUS = os.path.join(ROOT, "benchmarks", "corpus.jsonl")
+
+# 与基线比较的指标（延迟越小越好，吞吐量越大越好）
+COMPARED_METRICS = [
+    "turns_per_s",
+    "turn_latency_ms.p50",
+    "turn_latency_ms.p95",
+    "turn_latency_ms.p99",
+    "first_token_ms.p95",
+    "upstream_ms.p95",
+    "tool_ms.p95"
+]
+LOWER_IS_BETTER = [metric for metric in COMPARED_METRICS if metric != "turns_per_s"]
+
+
+# ==================== 语料与脚本化上游 ====================
+
+def load_corpus(path: str = DEFAULT_CORPUS) -> List[Dict[str, Any]]:
+    """
+    读取对话语料（每行一个对话）
+
+    {"id": "...", "turns": [{"user": "用户输入", "replies": [上游第 1 次回复, 第 2 次回复, ...]}]}
+    回复格式与 StubLLMServer 的脚本条目相同：{"content": ...} 或 {"tool_calls": [...]}。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ScriptedResponder:
+    """
+    按语料回放上游回复（供 StubLLMServer 使用，线程安全）
+
+    根据请求中最后一条用户消息找到语料中的轮次，再按该消息之后已有的助手消息数
+    （即本轮已进行的工具调用次数）取第几条回复，因此任意多个对话可以并发回放。
+    每次回复前等待 latency × (1 ± jitter) 秒，模拟上游的生成耗时。
+    """
+
+    def __init__(
+        self,
+        corpus: List[Dict[str, Any]],
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        seed: Optional[int] = None
+    ):
+        self.turns = {turn["user"]: turn["replies"] for conversation in corpus for turn in conversation["turns"]}
+        self.latency = latency
+        self.jitter = jitter
+        self.unscripted = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        messages = body.get("messages", [])
+        last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=None)
+
+        replies = self.turns.get(messages[last_user].get("content")) if last_user is not None else None
+        if replies:
+            step = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+            reply = replies[min(step, len(replies) - 1)]
+        else:
+            with self._lock:
+                self.unscripted += 1
+            reply = {"content": "How else may I help you today?"}
+
+        if reply.get("tool_calls"):
+            # 每次调用使用不同的 tool_call_id（与真实 API 一致）
+            reply = {"tool_calls": [dict(tc, id=f"call_{uuid.uuid4().hex[:12]}") for tc in reply["tool_calls"]]}
+
+        if self.latency:
+            with self._lock:
+                factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0.0, self.latency * factor))
+        return reply
+
+
+class SpanCollector:
+    """收集 span 的导出器（按 trace 统计每轮的上游与工具耗时）"""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+# ==================== 负载生成 ====================
+
+def _http_turn(
+    client: httpx.Client,
+    server_url: str,
+    session_id: str,
+    message: str,
+    stream: bool,
+    started: float
+) -> Optional[float]:
+    """通过 server.py 的接口发送一轮，返回首个文本增量的到达时间（非流式为 None）"""
+    url = f"{server_url}/sessions/{session_id}/messages"
+    if not stream:
+        response = client.post(url, json={"message": message})
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return None
+
+    first_token = None
+    with client.stream("POST", url, json={"message": message, "stream": True}) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        for line in response.iter_lines():
+            if line == "event: delta" and first_token is None:
+                first_token = time.perf_counter() - started
+            elif line == "event: error":
+                raise RuntimeError("SSE error")
+    return first_token
+
+
+def _replay(
+    conversation: Dict[str, Any],
+    user_id: str,
+    base_url: str,
+    stream: bool,
+    server_url: Optional[str] = None,
+    client: Optional[httpx.Client] = None
+) -> List[Dict[str, Any]]:
+    """
+    依次发送一个对话的各轮，返回每轮的客户端侧测量
+
+    server_url 不为空时用 client 经由 HTTP 服务器发送（user_id 作为会话 ID，历史保存在服务端）。
+    """
+    history: List[Dict[str, Any]] = []
+    measurements = []
+    for turn in conversation["turns"]:
+        started = time.perf_counter()
+        first_token = None
+        error = None
+        try:
+            if server_url:
+                first_token = _http_turn(client, server_url, user_id, turn["user"], stream, started)
+            elif stream:
+                for _ in agent_core.stream_concierge(turn["user"], history, user_id=user_id,
+                                                     api_key="bench", base_url=base_url):
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+            else:
+                agent_core.chat_with_concierge(turn["user"], history, user_id=user_id,
+                                               api_key="bench", base_url=base_url)
+        except Exception as e:
+            error = type(e).__name__
+        measurements.append({
+            "latency": time.perf_counter() - started,
+            "first_token": first_token,
+            "error": error
+        })
+        if error is not None:
+            break  # 历史已回滚，该对话的后续轮次没有意义
+    return measurements
+
+
+def _http_client(max_connections: int) -> httpx.Client:
+    """所有访客共用的 HTTP 客户端（连接池）"""
+    # httpx 分别写出请求头与请求体，关闭 Nagle 算法以免请求体等待服务器的延迟 ACK
+    transport = httpx.HTTPTransport(
+        socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    )
+    return httpx.Client(transport=transport, timeout=60.0)
+
+
+def _start_http_server(base_url: str, max_concurrency: int, sessions: SessionStore):
+    """在后台线程的事件循环中启动 HTTP 服务器（上游指向桩服务器），返回 (server, loop, thread)"""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="bench-http", daemon=True)
+    thread.start()
+    server = ConciergeServer(port=0, max_concurrency=max_concurrency, sessions=sessions,
+                             api_key="bench", base_url=base_url)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    return server, loop, thread
+
+
+def _stop_http_server(server: ConciergeServer, loop: asyncio.AbstractEventLoop, thread: threading.Thread):
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def run_load(
+    corpus: List[Dict[str, Any]],
+    concurrency: int = 8,
+    repeat: int = 5,
+    latency: float = 0.05,
+    jitter: float = 0.5,
+    stream: bool = False,
+    shortcuts: bool = True,
+    seed: Optional[int] = 0,
+    warmup: bool = True,
+    http: bool = False
+) -> Dict[str, Any]:
+    """
+    以 concurrency 个并发访客重放语料 repeat 遍
+
+    每个对话使用独立的 user_id 和历史；用户状态写入临时目录，不影响 user_data.json。
+
+    Args:
+        shortcuts: 是否保留意图快速路由、回复缓存和工具结果缓存（False 时每轮都调用上游并执行工具）
+        warmup: 先不计时地并发重放一遍语料（建立连接、创建客户端），随后清空回复缓存与工具结果缓存
+        http: 经由 server.py 的 HTTP 接口发送（服务器在本进程的后台线程中运行，并发上限等于 concurrency，
+            会话存储在临时目录中）
+
+    Returns:
+        dict: 结果统计（延迟单位为毫秒）
+    """
+    collector = SpanCollector()
+
+    saved_state = mock_data.USER_STATE
+    saved_shortcuts = (agent_core.INTENT_ROUTER.enabled, agent_core.RESPONSE_CACHE.max_entries,
+                       agent_core.TOOL_CACHE.max_entries)
+    if not shortcuts:
+        agent_core.INTENT_ROUTER.enabled = False
+        agent_core.RESPONSE_CACHE.max_entries = 0
+        agent_core.TOOL_CACHE.max_entries = 0
+
+    responder = ScriptedResponder(corpus, latency, jitter, seed)
+    jobs = [(conversation, f"bench_{r}_{conversation['id']}") for r in range(repeat) for conversation in corpus]
+    random.Random(seed).shuffle(jobs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mock_data.USER_STATE = mock_data.create_user_state(data_file=os.path.join(tmp, "user_data.json"))
+        try:
+            with StubLLMServer(responder=responder) as server, ThreadPoolExecutor(concurrency) as pool:
+                http_server = None
+                if http:
+                    sessions = SessionStore(os.path.join(tmp, "sessions.db"))
+                    http_server = _start_http_server(server.base_url, concurrency, sessions)
+                server_url = http_server[0].base_url if http_server else None
+                client = _http_client(concurrency) if http else None
+                try:
+                    if warmup:
+                        list(pool.map(lambda c: _replay(c, f"bench_warmup_{c['id']}", server.base_url, stream,
+                                                        server_url, client), corpus))
+                        agent_core.RESPONSE_CACHE.clear()
+                        agent_core.TOOL_CACHE.clear()
+                    warmup_requests = server.request_count
+
+                    TRACER.add_exporter(collector)
+                    started = time.perf_counter()
+                    futures = [pool.submit(_replay, conversation, user_id, server.base_url, stream, server_url, client)
+                               for conversation, user_id in jobs]
+                    measurements = [m for future in futures for m in future.result()]
+                    duration = time.perf_counter() - started
+                    upstream_requests = server.request_count - warmup_requests
+                finally:
+                    if client is not None:
+                        client.close()
+                    if http_server:
+                        _stop_http_server(*http_server)
+        finally:
+            mock_data.USER_STATE.close()
+            mock_data.USER_STATE = saved_state
+            (agent_core.INTENT_ROUTER.enabled, agent_core.RESPONSE_CACHE.max_entries,
+             agent_core.TOOL_CACHE.max_entries) = saved_shortcuts
+            if collector in TRACER.exporters:
+                TRACER.exporters.remove(collector)
+
+    # 按 trace 汇总每轮的上游与工具耗时
+    turns = [s for s in collector.spans if s.name == "turn"]
+    upstream: Dict[str, float] = defaultdict(float)
+    tools: Dict[str, float] = defaultdict(float)
+    llm_calls: Dict[str, int] = defaultdict(int)
+    prompt_tokens = cached_tokens = 0
+    for span in collector.spans:
+        if span.name == "llm_call":
+            upstream[span.trace_id] += span.duration or 0.0
+            llm_calls[span.trace_id] += 1
+            prompt_tokens += span.attrs.get("prompt_tokens", 0)
+            cached_tokens += span.attrs.get("cached_tokens", 0)
+        elif span.name == "tool":
+            tools[span.trace_id] += span.duration or 0.0
+
+    completed = [m for m in measurements if m["error"] is None]
+    results = {
+        "conversations": len(jobs),
+        "turns": len(completed),
+        "errors": len(measurements) - len(completed),
+        "error_types": dict(Counter(m["error"] for m in measurements if m["error"] is not None)),
+        "duration_s": round(duration, 3),
+        "turns_per_s": round(len(completed) / duration, 2) if duration else 0.0,
+        "turn_latency_ms": summarize([m["latency"] * 1000 for m in completed]),
+        # 只统计调用了上游 / 执行了工具的轮次（上游耗时含等待并发名额的时间）
+        "upstream_ms": summarize([t * 1000 for t in upstream.values()]),
+        "tool_ms": summarize([t * 1000 for t in tools.values()]),
+        "llm_calls_per_turn": round(sum(llm_calls.values()) / len(turns), 3) if turns else 0.0,
+        "paths": dict(Counter(s.attrs.get("path", "unknown") for s in turns)),
+        "upstream_requests": upstream_requests,
+        "unscripted_requests": responder.unscripted,
+        "prompt_cache_hit_rate": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0
+    }
+    if stream:
+        results["first_token_ms"] = summarize([m["first_token"] * 1000 for m in completed
+                                               if m["first_token"] is not None])
+    return results
+
+
+# ==================== 命令行 ====================
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Concierge 端到端负载测试（本地桩服务器）")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="对话语料（JSONL）")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发访客数")
+    parser.add_argument("--repeat", type=int, default=5, help="语料重放遍数")
+    parser.add_argument("--latency", type=float, default=0.05, help="每次上游调用的模拟延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="延迟抖动比例（0~1）")
+    parser.add_argument("--stream", action="store_true", help="使用流式接口（额外统计首个 token 延迟）")
+    parser.add_argument("--http", action="store_true", help="经由 server.py 的 HTTP 接口发送（含 HTTP/SSE 开销）")
+    parser.add_argument("--no-shortcuts", action="store_true", help="关闭意图快速路由、回复缓存和工具结果缓存")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--no-warmup", action="store_true", help="不做预热（包含建立连接等冷启动开销）")
+    parser.add_argument("--out", default=None, help="结果目录（默认 benchmarks/results）")
+    parser.add_argument("--baseline", default=None, help="与之比较的历史结果文件")
+    parser.add_argument("--verbose", action="store_true", help="保留每轮的调试输出")
+    args = parser.parse_args(argv)
+
+    set_debug(args.verbose)
+    corpus = load_corpus(args.corpus)
+    config = {
+        "corpus": os.path.relpath(args.corpus, ROOT),
+        "concurrency": args.concurrency,
+        "repeat": args.repeat,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "stream": args.stream,
+        "http": args.http,
+        "shortcuts": not args.no_shortcuts,
+        "seed": args.seed,
+        "warmup": not args.no_warmup
+    }
+    print(f"🏃 负载测试: {len(corpus)} 个对话 × {args.repeat} 遍，并发 {args.concurrency}，"
+          f"上游延迟 {args.latency * 1000:g} ms ±{args.jitter:.0%}")
+
+    results = run_load(
+        corpus,
+        concurrency=args.concurrency,
+        repeat=args.repeat,
+        latency=args.latency,
+        jitter=args.jitter,
+        stream=args.stream,
+        shortcuts=not args.no_shortcuts,
+        seed=args.seed,
+        warmup=not args.no_warmup,
+        http=args.http
+    )
+
+    print(f"\n   轮次: {results['turns']}（失败 {results['errors']}），耗时 {results['duration_s']} s，"
+          f"吞吐 {results['turns_per_s']} 轮/秒")
+    for name in ("turn_latency_ms", "first_token_ms", "upstream_ms", "tool_ms"):
+        if name in results and results[name]["count"]:
+            stats = results[name]
+            print(f"   {name:16} p50 {stats['p50']:>9} | p95 {stats['p95']:>9} | p99 {stats['p99']:>9} "
+                  f"| max {stats['max']:>9}  (n={stats['count']})")
+    print(f"   路径: {results['paths']}，每轮 LLM 调用 {results['llm_calls_per_turn']} 次，"
+          f"前缀缓存命中率 {results['prompt_cache_hit_rate']:.1%}")
+
+    path = write_artifact("load", config, results, args.out or RESULTS_DIR)
+    print(f"\n💾 结果已保存: {os.path.relpath(path)}")
+
+    if args.baseline:
+        baseline = load_artifact(args.baseline)
+        print(f"\n📊 与基线比较（{baseline.get('git_commit')}，{baseline.get('timestamp')}）:")
+        if baseline.get("config") != config:
+            print(f"   ⚠️ 基线的运行配置不同: {baseline.get('config')}")
+        for line in compare(results, baseline["results"], COMPARED_METRICS, LOWER_IS_BETTER):
+            print(f"   {line}")
+
+    agent_core.shutdown_clients()
+
+
+if __name__ == "__main__":
+    main()
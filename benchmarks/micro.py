@@ -0,0 +1,414 @@
+"""
+迪拜商场互动服务 Agent - 存储与工具函数微基准
+按 10^3 ~ 10^6 的规模生成用户、店铺、车牌数据，测量各操作的延迟、吞吐量与峰值内存，
+并用对数-对数斜率给出规模曲线（≈0 表示与规模无关，≈1 表示随规模线性增长）
+
+    python -m benchmarks.micro                                     # 10^3 ~ 10^5
+    python -m benchmarks.micro --sizes 1000,10000,100000,1000000 --only users,parking
+    python -m benchmarks.micro --backends wal,sqlite --budget 5
+"""
+
+import io
+import os
+import gc
+import json
+import math
+import time
+import random
+import string
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from benchmarks import RESULTS_DIR, summarize, write_artifact
+
+import mock_data
+from parking_index import ParkingIndex
+from shop_index import ShopIndex
+from tracing import set_debug
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+COMPONENTS = ("users", "shops", "parking")
+# json-group 为 json 后端的组提交模式（USER_STATE_COMMIT=group）
+BACKENDS = ("json", "json-group", "wal", "sqlite")
+
+# 每个操作最多测量的次数与时间（秒），先到者为准（json 同步后端在大规模下每次写入都很慢）
+DEFAULT_OPS = 2000
+DEFAULT_BUDGET = 2.0
+
+# 斜率超过该值的曲线标记为随规模增长
+SLOPE_WARNING = 0.3
+
+
+# ==================== 数据集 ====================
+
+# 合成店铺名的音节（辅音 + 元音 + 可选尾音，约 1700 个），三元组分布接近真实品牌名
+SYLLABLES = [c + v + e for c in "bcdfghjklmnprstvz" for v in "aeiou" for e in ("", "l", "n", "r", "s")]
+CATEGORIES = ["Luxury Fashion", "Fashion", "Electronics", "Coffee", "Restaurant", "Beauty", "Jewellery",
+              "Sports", "Kids", "Home"]
+FLOORS = ["Lower Ground", "Ground Floor", "1st Floor", "2nd Floor"]
+EMIRATES = ["DXB", "AUH", "SHJ", "AJM", "RAK", "FUJ", "UAQ"]
+LEVELS = ["B1", "B2", "B3", "B4"]
+
+
+def generate_users(n: int, rng: random.Random) -> Dict[str, Dict[str, Any]]:
+    """n 个用户（user_json 格式），每人 100~1000 积分、0~3 张优惠券"""
+    users = {}
+    for i in range(n):
+        coupons = [
+            {"type": "Coffee voucher", "code": "".join(rng.choices(string.ascii_uppercase + string.digits, k=8)),
+             "points_cost": 30}
+            for _ in range(rng.randint(0, 3))
+        ]
+        users[user_key(i)] = {"points": rng.randint(100, 1000), "coupons": coupons}
+    return users
+
+
+def user_key(i: int) -> str:
+    return f"user_{i:07d}"
+
+
+def _word(rng: random.Random) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+
+
+def generate_shops(n: int, rng: random.Random) -> Dict[str, Dict[str, Any]]:
+    """n 家名称互不相同的店铺（与 mock_data.SHOPS 结构相同），名称由 1~3 个合成词组成"""
+    shops: Dict[str, Dict[str, Any]] = {}
+    while len(shops) < n:
+        name = " ".join(_word(rng) for _ in range(rng.choice((1, 2, 2, 3))))
+        if name in shops:
+            continue
+        floor, zone = rng.choice(FLOORS), rng.choice("ABCDEFGH")
+        shops[name] = {
+            "name": name,
+            "floor": floor,
+            "zone": zone,
+            "category": rng.choice(CATEGORIES),
+            "description": f"{name} boutique.",
+            "location": f"{floor}, Zone {zone}"
+        }
+    return shops
+
+
+def generate_plates(n: int, rng: random.Random) -> Dict[str, str]:
+    """n 个互不相同的车牌 → 车位（"DXB-A12345" → "B2-0012345"）"""
+    return {
+        f"{rng.choice(EMIRATES)}-{string.ascii_uppercase[i // 100_000 % 26]}{i % 100_000}":
+            f"{LEVELS[i % len(LEVELS)]}-{i:07d}"
+        for i in range(n)
+    }
+
+
+# ==================== 测量 ====================
+
+def measure(operation: Callable[..., Any], make_args: Callable[[], Tuple], max_ops: int, budget: float) -> Dict[str, Any]:
+    """
+    逐次计时执行 operation(*make_args())（生成参数的时间不计入），达到 max_ops 次或 budget 秒后停止
+
+    Returns:
+        dict: 单次延迟（微秒）的 p50/p95/p99 等，以及 ops_per_s
+    """
+    latencies: List[float] = []
+    started = time.perf_counter()
+    deadline = started + budget
+    while True:
+        args = make_args()
+        t0 = time.perf_counter()
+        operation(*args)
+        t1 = time.perf_counter()
+        latencies.append((t1 - t0) * 1e6)
+        if len(latencies) >= max_ops or t1 >= deadline:
+            break
+    elapsed = time.perf_counter() - started
+    stats = summarize(latencies, digits=1)
+    stats["ops_per_s"] = round(len(latencies) / elapsed, 1) if elapsed else 0.0
+    return stats
+
+
+def timed(build: Callable[[], Any]) -> Tuple[Any, float]:
+    """(结果, 耗时秒)"""
+    gc.collect()
+    started = time.perf_counter()
+    result = build()
+    return result, round(time.perf_counter() - started, 4)
+
+
+def peak_memory(build: Callable[[], Any]) -> Tuple[Any, float]:
+    """
+    (结果, 构建过程中的 Python 堆峰值 MB)
+
+    只统计 Python 对象分配（tracemalloc）；SQLite 页缓存等 C 层内存不计入。
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, round(peak / 2 ** 20, 2)
+
+
+# ==================== 用户状态 ====================
+
+def open_user_state(backend: str, data_file: str):
+    """按后端打开用户状态（json 后端显式指定提交模式，不受环境变量影响；不输出加载提示）"""
+    with redirect_stdout(io.StringIO()):
+        if backend == "json":
+            return mock_data.UserState(data_file, commit_mode="sync")
+        if backend == "json-group":
+            return mock_data.UserState(data_file, commit_mode="group")
+        return mock_data.create_user_state(backend, data_file)
+
+
+def bench_users(n: int, backend: str, max_ops: int, budget: float, seed: int) -> Dict[str, Any]:
+    """
+    加载时间、峰值内存，以及 add_points / redeem_coupon（工具函数）和 get_coupons 的延迟
+
+    sqlite 后端第一次打开时从 JSON 迁移（migrate_s），之后的打开时间为 load_s。
+    """
+    rng = random.Random(seed)
+    result: Dict[str, Any] = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, "user_data.json")
+        with open(data_file, "w", encoding="utf-8") as f:
+            json.dump(generate_users(n, rng), f, ensure_ascii=False, indent=2)
+        result["file_mb"] = round(os.path.getsize(data_file) / 2 ** 20, 2)
+
+        if backend == "sqlite":
+            state, result["migrate_s"] = timed(lambda: open_user_state(backend, data_file))
+            state.close()
+
+        state, result["peak_mb"] = peak_memory(lambda: open_user_state(backend, data_file))
+        state.close()
+        state, result["load_s"] = timed(lambda: open_user_state(backend, data_file))
+
+        saved_state = mock_data.USER_STATE
+        mock_data.USER_STATE = state
+        try:
+            result["add_points"] = measure(
+                mock_data.add_points, lambda: (user_key(rng.randrange(n)), 10, "bench"), max_ops, budget
+            )
+            result["redeem_coupon"] = measure(
+                mock_data.redeem_coupon, lambda: (user_key(rng.randrange(n)), "Coffee voucher", 5), max_ops, budget
+            )
+            result["get_coupons"] = measure(
+                state.get_coupons, lambda: (user_key(rng.randrange(n)),), max_ops, budget
+            )
+        finally:
+            mock_data.USER_STATE = saved_state
+            state.close()
+
+    return result
+
+
+# ==================== 店铺搜索 ====================
+
+def _typo(name: str, rng: random.Random) -> str:
+    """交换第一个词中相邻的两个字符"""
+    word = name.split()[0]
+    if len(word) < 4:
+        return name
+    i = rng.randrange(1, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:] + name[len(word):]
+
+
+def bench_shops(n: int, max_ops: int, budget: float, seed: int) -> Dict[str, Any]:
+    """索引构建时间与峰值内存，以及 get_shop_info 对完全匹配、前缀、拼写错误、不存在名称的延迟"""
+    rng = random.Random(seed)
+    shops = generate_shops(n, rng)
+    names = list(shops)
+
+    result: Dict[str, Any] = {}
+    _, result["peak_mb"] = peak_memory(lambda: ShopIndex(shops))
+    index, result["build_s"] = timed(lambda: ShopIndex(shops))
+
+    saved = mock_data.SHOPS, mock_data.SHOP_INDEX
+    mock_data.SHOPS, mock_data.SHOP_INDEX = shops, index
+    try:
+        queries = {
+            "exact": lambda: rng.choice(names).lower(),
+            "prefix": lambda: rng.choice(names)[:4],
+            "typo": lambda: _typo(rng.choice(names), rng),
+            "miss": lambda: "Qxjv " + "".join(rng.choices(string.ascii_lowercase, k=6))
+        }
+        for kind, query in queries.items():
+            result[kind] = measure(mock_data.get_shop_info, lambda: (query(),), max_ops, budget)
+    finally:
+        mock_data.SHOPS, mock_data.SHOP_INDEX = saved
+
+    return result
+
+
+# ==================== 车位查询 ====================
+
+def bench_parking(n: int, max_ops: int, budget: float, seed: int) -> Dict[str, Any]:
+    """索引构建（导入 n 条入场事件）时间与峰值内存、find_parking 延迟、闸机事件吞吐量、占用统计延迟"""
+    rng = random.Random(seed)
+    parked = generate_plates(n, rng)
+    plates = list(parked)
+    events = [{"type": "entry", "plate": plate, "spot": spot} for plate, spot in parked.items()]
+    capacity = {level: n for level in LEVELS}
+
+    def build() -> ParkingIndex:
+        index = ParkingIndex(capacity)
+        index.apply_events(events)
+        return index
+
+    result: Dict[str, Any] = {}
+    _, result["peak_mb"] = peak_memory(build)
+    index, result["build_s"] = timed(build)
+
+    def spoken(plate: str) -> str:
+        # 访客的随意写法："dxb a12345"
+        emirate, number = plate.split("-")
+        return f"{emirate.lower()} {number.lower()}"
+
+    def gate(plate: str):
+        index.apply_events([{"type": "exit", "plate": plate},
+                            {"type": "entry", "plate": plate, "spot": parked[plate]}])
+
+    saved = mock_data.PARKING_INDEX
+    mock_data.PARKING_INDEX = index
+    try:
+        result["lookup"] = measure(
+            mock_data.find_parking, lambda: (spoken(rng.choice(plates)),), max_ops, budget
+        )
+        result["lookup_number_only"] = measure(
+            mock_data.find_parking, lambda: (rng.choice(plates).split("-")[1],), max_ops, budget
+        )
+        result["lookup_miss"] = measure(
+            mock_data.find_parking, lambda: (f"DXB Z{rng.randrange(10 ** 6)}",), max_ops, budget
+        )
+        result["gate_event_pair"] = measure(gate, lambda: (rng.choice(plates),), max_ops, budget)
+        result["occupancy"] = measure(mock_data.get_parking_occupancy, tuple, max_ops, budget)
+    finally:
+        mock_data.PARKING_INDEX = saved
+        index.close()
+
+    return result
+
+
+# ==================== 规模曲线 ====================
+
+def scaling_slope(points: Sequence[Tuple[int, float]]) -> Optional[float]:
+    """log(值) 对 log(规模) 的最小二乘斜率（O(1) ≈ 0，O(n) ≈ 1）"""
+    points = [(math.log(size), math.log(value)) for size, value in points if value and value > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if not denominator:
+        return None
+    return round(sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator, 3)
+
+
+def curves(results: Dict[str, Any], sizes: Sequence[int]) -> Dict[str, Dict[str, Any]]:
+    """
+    从各规模的结果中提取曲线：{"users.json.add_points.p50_us": {"values": {规模: 值}, "slope": 斜率}}
+
+    包括每个操作的 p50 延迟、加载/构建时间和峰值内存。
+    """
+    series: Dict[str, Dict[int, float]] = {}
+
+    def collect(prefix: str, by_size: Dict[str, Dict[str, Any]]):
+        for size in sizes:
+            for name, value in by_size.get(str(size), {}).items():
+                if isinstance(value, dict) and value.get("count"):
+                    key, value = f"{prefix}.{name}.p50_us", value["p50"]
+                elif name in ("load_s", "build_s", "migrate_s", "peak_mb"):
+                    key = f"{prefix}.{name}"
+                else:
+                    continue
+                series.setdefault(key, {})[size] = value
+
+    for backend, by_size in results.get("users", {}).items():
+        collect(f"users.{backend}", by_size)
+    for component in ("shops", "parking"):
+        if component in results:
+            collect(component, results[component])
+
+    return {
+        key: {"values": {str(size): value for size, value in values.items()},
+              "slope": scaling_slope(sorted(values.items()))}
+        for key, values in series.items()
+    }
+
+
+def print_curves(table: Dict[str, Dict[str, Any]], sizes: Sequence[int]):
+    header = "".join(f"{f'10^{round(math.log10(size))}' if size == 10 ** round(math.log10(size)) else size:>12}"
+                     for size in sizes)
+    print(f"\n📈 规模曲线（延迟为 p50 微秒）\n   {'':44}{header}{'斜率':>10}")
+    for key, curve in table.items():
+        cells = "".join(f"{curve['values'].get(str(size), ''):>12}" for size in sizes)
+        slope = curve["slope"]
+        flag = "  ⚠️" if slope is not None and slope >= SLOPE_WARNING else ""
+        print(f"   {key:44}{cells}{slope if slope is not None else '-':>10}{flag}")
+
+
+# ==================== 命令行 ====================
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="用户状态存储、店铺搜索、车位查询的规模微基准")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="数据规模（逗号分隔），例如 1000,10000,100000,1000000")
+    parser.add_argument("--only", default=",".join(COMPONENTS), help=f"要测试的部分（{','.join(COMPONENTS)}）")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help=f"用户状态后端（{','.join(BACKENDS)}）")
+    parser.add_argument("--ops", type=int, default=DEFAULT_OPS, help="每个操作最多测量的次数")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="每个操作最多测量的秒数")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--out", default=RESULTS_DIR, help="结果目录（默认 benchmarks/results）")
+    args = parser.parse_args(argv)
+
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    components = [c for c in args.only.split(",") if c]
+    backends = [b for b in args.backends.split(",") if b]
+    for name, allowed in ((components, COMPONENTS), (backends, BACKENDS)):
+        unknown = set(name) - set(allowed)
+        if unknown:
+            parser.error(f"未知的选项: {', '.join(sorted(unknown))}（可选: {', '.join(allowed)}）")
+
+    set_debug(False)
+    results: Dict[str, Any] = {}
+
+    for size in sizes:
+        print(f"\n🔬 规模 {size:,}")
+        if "users" in components:
+            for backend in backends:
+                entry = bench_users(size, backend, args.ops, args.budget, args.seed)
+                results.setdefault("users", {}).setdefault(backend, {})[str(size)] = entry
+                print(f"   users/{backend:10} 加载 {entry['load_s']:>8} s  峰值 {entry['peak_mb']:>8} MB  "
+                      f"add_points p50 {entry['add_points']['p50']:>9} µs  "
+                      f"redeem p50 {entry['redeem_coupon']['p50']:>9} µs  "
+                      f"get_coupons p50 {entry['get_coupons']['p50']:>6} µs")
+        if "shops" in components:
+            entry = bench_shops(size, args.ops, args.budget, args.seed)
+            results.setdefault("shops", {})[str(size)] = entry
+            print(f"   shops             构建 {entry['build_s']:>8} s  峰值 {entry['peak_mb']:>8} MB  "
+                  + "  ".join(f"{kind} p50 {entry[kind]['p50']} µs" for kind in ("exact", "prefix", "typo", "miss")))
+        if "parking" in components:
+            entry = bench_parking(size, args.ops, args.budget, args.seed)
+            results.setdefault("parking", {})[str(size)] = entry
+            print(f"   parking           构建 {entry['build_s']:>8} s  峰值 {entry['peak_mb']:>8} MB  "
+                  f"lookup p50 {entry['lookup']['p50']} µs  "
+                  f"闸机事件 {entry['gate_event_pair']['ops_per_s']:,} 对/秒")
+
+    results["curves"] = curves(results, sizes)
+    print_curves(results["curves"], sizes)
+
+    config = {"sizes": sizes, "components": components, "backends": backends,
+              "ops": args.ops, "budget": args.budget, "seed": args.seed}
+    path = write_artifact("micro", config, results, args.out)
+    print(f"\n💾 结果已保存: {os.path.relpath(path)}")
+
+
+if __name__ == "__main__":
+    main()
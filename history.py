@@ -0,0 +1,306 @@
+"""
+迪拜商场互动服务 Agent - 对话历史压缩
+按 token 预算裁剪发送给模型的历史：旧轮次的工具调用/结果折叠为简短事实，
+更早的轮次压缩为一行摘要；完整历史本身不被修改
+"""
+
+import os
+import json
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from tracing import debug
+
+
+# ==================== 默认配置 ====================
+
+# 历史部分（不含 system prompt 和工具定义）的 token 预算
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
+
+# 最近几轮始终原样保留（含完整的工具调用与结果）
+DEFAULT_KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", "2"))
+
+# 压缩边界按多少轮对齐：边界每 N 轮才移动一次，期间压缩视图只在末尾追加，
+# 上游前缀缓存可以持续命中
+DEFAULT_COMPACT_CHUNK = int(os.environ.get("HISTORY_COMPACT_CHUNK", "4"))
+
+# 摘要说明最多占预算的比例
+SUMMARY_SHARE = 0.2
+
+NOTES_HEADER = "Earlier in this conversation (condensed):\n"
+
+
+# ==================== Token 估算 ====================
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    本地估算文本的 token 数（无需分词器）
+
+    经验值：ASCII 约 4 个字符 1 个 token，CJK 约 1 个字符 1 个 token，
+    阿拉伯文等其他文字约 2 个字符 1 个 token。
+    """
+    if not text:
+        return 0
+
+    ascii_chars = cjk_chars = other_chars = 0
+    for ch in text:
+        code = ord(ch)
+        if code < 128:
+            ascii_chars += 1
+        elif 0x2E80 <= code <= 0x9FFF or 0xF900 <= code <= 0xFAFF or 0xFF00 <= code <= 0xFFEF:
+            cjk_chars += 1
+        else:
+            other_chars += 1
+    return ascii_chars // 4 + cjk_chars + other_chars // 2 + 1
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """估算单条消息的 token 数（含角色等固定开销）"""
+    tokens = 4 + estimate_tokens(message.get("content"))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        tokens += 8 + estimate_tokens(function.get("name")) + estimate_tokens(function.get("arguments"))
+    return tokens
+
+
+# ==================== 轮次拆分 ====================
+
+def split_turns(chat_history: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    按用户消息拆分轮次：每轮为 [user, (assistant+tool_calls, tool...)*, assistant]
+
+    工具调用与其结果总在同一轮内，以轮为单位取舍不会留下孤立的 tool_call_id。
+    """
+    turns: List[List[Dict[str, Any]]] = []
+    for message in chat_history:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def tool_facts(turn: List[Dict[str, Any]], max_chars: int = 160) -> List[str]:
+    """
+    把一轮中的工具调用/结果折叠为简短事实
+
+    例如 "find_parking(plate_number=DXB-1234) → 您的车辆 DXB-1234 停放在 B2-A05 区域。"
+    """
+    calls: Dict[str, Tuple[str, str]] = {}
+    for message in turn:
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            try:
+                args = json.loads(function.get("arguments") or "{}")
+                args_text = ", ".join(f"{k}={v}" for k, v in args.items() if k != "user_id")
+            except ValueError:
+                args_text = function.get("arguments", "")
+            calls[tool_call.get("id")] = (function.get("name", ""), args_text)
+
+    facts = []
+    for message in turn:
+        if message.get("role") != "tool":
+            continue
+        name, args_text = calls.get(message.get("tool_call_id"), (message.get("name", ""), ""))
+        try:
+            result = json.loads(message.get("content") or "{}")
+        except ValueError:
+            result = message.get("content")
+
+        if isinstance(result, dict):
+            outcome = result.get("message") or result.get("error") or json.dumps(result, ensure_ascii=False)
+            if result.get("success") is False:
+                outcome = f"失败: {outcome}"
+        else:
+            outcome = str(result)
+        facts.append(_shorten(f"{name}({args_text}) → {outcome}", max_chars))
+    return facts
+
+
+def collapse_turn(turn: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """去掉一轮中的工具调用与结果，只保留用户消息和最终回复"""
+    return [
+        message for message in turn
+        if message.get("role") == "user"
+        or (message.get("role") == "assistant" and not message.get("tool_calls"))
+    ]
+
+
+def summarize_turn(turn: List[Dict[str, Any]], max_chars: int = 120) -> str:
+    """把一轮对话压缩为一行摘要"""
+    user = next((m.get("content", "") for m in turn if m.get("role") == "user"), "")
+    reply = next(
+        (m.get("content", "") for m in reversed(turn)
+         if m.get("role") == "assistant" and not m.get("tool_calls")),
+        ""
+    )
+    return f"用户: {_shorten(user, max_chars // 2)} → 助手: {_shorten(reply, max_chars // 2)}"
+
+
+# ==================== 历史管理器 ====================
+
+class HistoryManager:
+    """
+    按 token 预算压缩发送给模型的历史
+
+    未超出预算时原样发送；超出时依次：
+    1. 除最近 keep_turns 轮外，工具调用/结果折叠为事实，轮次只保留用户消息和最终回复
+    2. 仍超出时从最早的轮次开始整轮移除，改为一行摘要
+    折叠出的事实与摘要合并为一条 system 消息放在历史最前面（最多占预算的 SUMMARY_SHARE）。
+    当前轮（最后一轮）始终原样保留。
+
+    折叠与移除的边界都按 compact_chunk 轮对齐，因此连续几轮请求的压缩视图前缀保持不变，
+    而不是每轮都整体平移（那样会让上游前缀缓存完全失效）。
+    """
+
+    def __init__(
+        self,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+        keep_turns: int = DEFAULT_KEEP_TURNS,
+        fact_max_chars: int = 160,
+        compact_chunk: int = DEFAULT_COMPACT_CHUNK
+    ):
+        self.token_budget = token_budget
+        self.keep_turns = max(1, keep_turns)
+        self.fact_max_chars = fact_max_chars
+        self.compact_chunk = max(1, compact_chunk)
+        self.compactions = 0
+
+    def compact(self, chat_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        返回适合发送的历史（不修改 chat_history）
+
+        Returns:
+            list: 消息列表；发生压缩时第一条为记录早期事实的 system 消息
+        """
+        costs = [message_tokens(m) for m in chat_history]
+        if sum(costs) <= self.token_budget:
+            return list(chat_history)
+
+        turns = split_turns(chat_history)
+        boundary = max(len(turns) - self.keep_turns, 0) // self.compact_chunk * self.compact_chunk
+        older = turns[:boundary]
+        recent = turns[boundary:]
+
+        # 第 1 步：旧轮次折叠工具调用（各部分 token 数增量维护，整体为线性时间）
+        collapsed = deque(
+            (tool_facts(turn, self.fact_max_chars), collapse_turn(turn), turn)
+            for turn in older
+        )
+        costs_collapsed = deque(
+            sum(message_tokens(m) for m in msgs) + sum(estimate_tokens(f) + 1 for f in facts)
+            for facts, msgs, _ in collapsed
+        )
+        recent = deque(recent)
+        costs_recent = deque(sum(message_tokens(m) for m in turn) for turn in recent)
+        notes: deque = deque()
+        # 摘要 system 消息本身的开销（标题 + 每行前缀）
+        notes_cost = message_tokens({"content": NOTES_HEADER})
+        body_cost = sum(costs_collapsed) + sum(costs_recent)
+
+        # 第 2 步：从最早的轮次开始整轮移除（保留当前轮），每次移除 compact_chunk 轮
+        removed = 0
+        while body_cost + notes_cost > self.token_budget or removed % self.compact_chunk:
+            if collapsed:
+                facts, _, turn = collapsed.popleft()
+                body_cost -= costs_collapsed.popleft()
+            elif len(recent) > 1:
+                turn = recent.popleft()
+                facts = tool_facts(turn, self.fact_max_chars)
+                body_cost -= costs_recent.popleft()
+            else:
+                break
+            removed += 1
+
+            for line in [summarize_turn(turn)] + facts:
+                notes.append(line)
+                notes_cost += estimate_tokens(line) + 1
+
+            # 摘要本身也受预算限制：丢弃最早的摘要行
+            while notes and notes_cost > self.token_budget * SUMMARY_SHARE:
+                notes_cost -= estimate_tokens(notes.popleft()) + 1
+
+        facts = [fact for turn_facts, _, _ in collapsed for fact in turn_facts]
+        lines = list(notes) + facts
+        messages: List[Dict[str, Any]] = []
+        if lines:
+            messages.append({
+                "role": "system",
+                "content": NOTES_HEADER + "\n".join(f"- {line}" for line in lines)
+            })
+        for _, msgs, _ in collapsed:
+            messages.extend(msgs)
+        for turn in recent:
+            messages.extend(turn)
+
+        self.compactions += 1
+        debug(f"🗜️ 历史已压缩: {len(chat_history)} 条 / ~{sum(costs)} tokens → "
+              f"{len(messages)} 条 / ~{sum(message_tokens(m) for m in messages)} tokens")
+        return messages
+
+
+def check_tool_pairs(messages: List[Dict[str, Any]]) -> bool:
+    """检查每个 tool_call_id 都有对应结果、每个 tool 结果都有对应调用"""
+    pending = set()
+    for message in messages:
+        for tool_call in message.get("tool_calls") or []:
+            pending.add(tool_call["id"])
+        if message.get("role") == "tool":
+            if message.get("tool_call_id") not in pending:
+                return False
+            pending.discard(message["tool_call_id"])
+    return not pending
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import time
+
+    print("对话历史压缩测试\n")
+
+    def make_turn(i: int) -> List[Dict[str, Any]]:
+        call_id = f"call_{i}"
+        return [
+            {"role": "user", "content": f"Where is my car? DXB-{1000 + i}"},
+            {"role": "assistant", "content": "", "tool_calls": [{
+                "id": call_id, "type": "function",
+                "function": {"name": "find_parking", "arguments": json.dumps({"plate_number": f"DXB-{1000 + i}"})}
+            }]},
+            {"role": "tool", "tool_call_id": call_id, "name": "find_parking", "content": json.dumps({
+                "success": True, "plate_number": f"DXB-{1000 + i}", "parking_spot": "B2-A05",
+                "message": f"您的车辆 DXB-{1000 + i} 停放在 B2-A05 区域。", "padding": "x" * 400
+            }, ensure_ascii=False)},
+            {"role": "assistant", "content": f"Marhaba! Your car DXB-{1000 + i} is parked at B2-A05. " * 3}
+        ]
+
+    history: List[Dict[str, Any]] = []
+    for i in range(200):
+        history.extend(make_turn(i))
+    # 当前轮：工具调用尚未得到最终回复
+    history.extend(make_turn(200)[:3])
+
+    manager = HistoryManager(token_budget=2000, keep_turns=2)
+    start = time.perf_counter()
+    compacted = manager.compact(history)
+    elapsed = time.perf_counter() - start
+
+    total = sum(message_tokens(m) for m in compacted)
+    print(f"   原始: {len(history)} 条 ~{sum(message_tokens(m) for m in history)} tokens")
+    print(f"   压缩: {len(compacted)} 条 ~{total} tokens，耗时 {elapsed * 1000:.1f} ms")
+    print(f"   摘要消息:\n{compacted[0]['content'][:400]}")
+
+    assert total <= 2000
+    assert check_tool_pairs(compacted)
+    assert compacted[-3:] == history[-3:], "当前轮必须原样保留"
+    assert len(history) == 200 * 4 + 3, "原始历史不应被修改"
+
+    # 未超预算时原样返回
+    short = make_turn(0)
+    assert manager.compact(short) == short
+
+    print("\n所有测试完成！")
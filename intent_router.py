@@ -0,0 +1,350 @@
+"""
+迪拜商场互动服务 Agent - 意图快速路由
+常见的单一意图问题（"Where is my car? DXB-1234"、"爱马仕在哪"）在本地识别：
+直接调用对应工具并用多语言模板回复，省去两次 LLM 往返；有任何歧义时交给 LLM
+"""
+
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from shop_index import normalize
+from parking_index import normalize_plate, spot_level
+
+
+# ==================== 默认配置 ====================
+
+# 是否启用快速路由（INTENT_ROUTER=0 关闭）
+DEFAULT_ENABLED = os.environ.get("INTENT_ROUTER", "1") != "0"
+
+# 置信度低于该值的问题交给 LLM
+DEFAULT_MIN_CONFIDENCE = float(os.environ.get("INTENT_ROUTER_MIN_CONFIDENCE", "0.85"))
+
+# 超过该词数的消息视为复杂请求
+MAX_WORDS = 16
+
+
+# ==================== 关键词 ====================
+# 均为归一化之后的形式（小写、阿拉伯文 ة→ه、أ→ا 等）
+
+PARKING_WORDS = {
+    "car", "my car", "parked", "park", "parking", "vehicle", "plate",
+    "سيارتي", "سياره", "السياره", "موقف", "ركنت", "صفيت",
+}
+PARKING_WORDS_CJK = ("车", "停车", "车牌")
+
+# 明确在找车的词：车牌 + 停车关键词之外还要有其中之一，才按高置信度路由
+# （"I hit a car DXB-1234"、"Sell my car DXB-1234" 都有车牌和 car，但不是在找车）
+LOCATE_WORDS = {
+    "where", "wheres", "find", "locate", "located", "parked", "left",
+    "اين", "وين", "فين", "ركنت", "صفيت",
+}
+LOCATE_WORDS_CJK = ("在哪", "哪里", "哪儿", "找")
+
+# 找车问句里常见的虚词；除此之外的词（车牌、停车词、找车词除外）视为未识别的内容词，每个降低置信度
+PARKING_FILLER_WORDS = {
+    "my", "is", "the", "a", "i", "me", "did", "do", "can", "you", "s", "it", "please",
+    "number", "no", "with", "help", "hi", "hello", "hey", "thanks", "thank", "was",
+    "سيارتي", "لو", "من", "فضلك",
+}
+UNKNOWN_WORD_PENALTY = 0.1
+
+# 出现这些词说明还有别的意图（积分、附近、空位……）或多个请求，交给 LLM
+OTHER_INTENT_WORDS = {
+    "and", "also", "then", "points", "point", "coupon", "voucher", "redeem",
+    "near", "nearby", "nearest", "closest", "free", "available", "spaces", "spots", "how many",
+    "lost", "key", "keys", "stolen", "damaged", "towed", "ticket", "pay", "fee", "fees", "charge",
+    "نقاط", "كوبون", "قسيمه", "اقرب", "قريب", "شاغره", "متاحه", "مفتاح", "رسوم", "دفع",
+}
+OTHER_INTENT_WORDS_CJK = (
+    "积分", "优惠券", "兑换", "附近", "最近", "空位", "车位多", "和", "还有", "然后", "钥匙", "丢", "费"
+)
+
+# "某店在哪" 的问法：去掉这些前后缀后剩下的就是店名
+SHOP_PREFIXES = [
+    "where can i find", "how do i get to", "how can i get to", "how to get to", "take me to",
+    "directions to", "location of", "where is", "where are", "where s", "wheres", "find",
+    "اين يقع", "اين تقع", "اين محل", "اين متجر", "اين", "وين", "فين",
+]
+SHOP_SUFFIXES = ["located", "please", "store", "shop", "boutique", "يقع", "موجود"]
+SHOP_PATTERN_ZH = re.compile(r"^(?:请问)?\s*(.+?)\s*(?:在哪里|在哪儿|在哪|怎么走|在几楼)(?:呢|啊)?$")
+
+_PIECES = re.compile(r"\d+|[^\d\s]+")
+
+
+# ==================== 语言识别 ====================
+
+def detect_language(text: str) -> str:
+    """按文字识别回复语言："ar" / "zh" / "en" """
+    for ch in text:
+        code = ord(ch)
+        if 0x0600 <= code <= 0x06FF:
+            return "ar"
+        if 0x4E00 <= code <= 0x9FFF:
+            return "zh"
+    return "en"
+
+
+def _has_any(normalized: str, words, cjk_words) -> bool:
+    padded = f" {normalized} "
+    return any(f" {w} " in padded for w in words) or any(w in normalized for w in cjk_words)
+
+
+# ==================== 意图识别 ====================
+
+def extract_plates(normalized: str) -> Tuple[List[str], List[str]]:
+    """
+    从归一化文本中找出车牌
+
+    Returns:
+        (带酋长国前缀的车牌列表, 单独的号码列表)，例如 "my car dxb 1234" → (["dxb 1234"], [])
+    """
+    pieces = _PIECES.findall(normalized)
+    plates, numbers = [], []
+    for i, piece in enumerate(pieces):
+        if not piece.isdigit():
+            continue
+        for n in (2, 1):
+            if i >= n:
+                candidate = " ".join(pieces[i - n:i + 1])
+                if normalize_plate(candidate)[0]:
+                    plates.append(candidate)
+                    break
+        else:
+            numbers.append(piece)
+    return plates, numbers
+
+
+def _unknown_words(normalized: str, plate: str) -> int:
+    """找车问句中未识别的内容词个数（车牌、停车词、找车词、虚词之外的词）"""
+    known = set(plate.split()) | LOCATE_WORDS | PARKING_FILLER_WORDS
+    known.update(word for phrase in PARKING_WORDS for word in phrase.split())
+    cjk_words = PARKING_WORDS_CJK + LOCATE_WORDS_CJK
+    return sum(
+        1 for word in normalized.split()
+        if word not in known and not word.isdigit() and not any(w in word for w in cjk_words)
+    )
+
+
+def classify_parking(normalized: str) -> Optional[Tuple[Dict[str, Any], float]]:
+    """
+    车位查询：恰好一个车牌，且明确在找车（停车关键词 + 找车词）或整句几乎只有车牌；
+    每个未识别的内容词降低置信度（"Where is my car, I hit it DXB-1234" 交给 LLM）
+    """
+    plates, numbers = extract_plates(normalized)
+    if len(plates) + len(numbers) != 1:
+        return None
+
+    has_keyword = _has_any(normalized, PARKING_WORDS, PARKING_WORDS_CJK)
+    locating = has_keyword and _has_any(normalized, LOCATE_WORDS, LOCATE_WORDS_CJK)
+    if plates:
+        plate = plates[0]
+        if locating:
+            confidence = 0.95
+        elif has_keyword:
+            # 提到了车和车牌，但没有在问车在哪（"I hit a car DXB-1234"）
+            confidence = 0.5
+        else:
+            # 只发了车牌（"DXB-1234"、"DXB 1234 please"）
+            extra = len(normalized.split()) - len(plate.split())
+            confidence = 0.9 if extra <= 1 else 0.5
+    else:
+        plate = numbers[0]
+        # 只有号码时必须明确在找车，且号码长度合理
+        confidence = 0.85 if locating and 3 <= len(plate) <= 5 else 0.0
+
+    if locating:
+        confidence -= UNKNOWN_WORD_PENALTY * _unknown_words(normalized, plate)
+    return {"plate_number": plate}, max(confidence, 0.0)
+
+
+def shop_query(normalized: str) -> Optional[str]:
+    """从 "where is X" / "أين X" / "X在哪" 中取出店名 X；不是这种问法时返回 None"""
+    match = SHOP_PATTERN_ZH.match(normalized)
+    if match:
+        return match.group(1).strip() or None
+
+    for prefix in SHOP_PREFIXES:
+        if normalized == prefix or not normalized.startswith(prefix + " "):
+            continue
+        words = normalized[len(prefix):].split()
+        if words and words[0] == "the":
+            words = words[1:]
+        while words and words[-1] in SHOP_SUFFIXES:
+            words = words[:-1]
+        return " ".join(words) or None
+    return None
+
+
+class IntentRouter:
+    """
+    规则 + 轻量打分的意图识别
+
+    - 车位查询：规则抽取车牌（复用 parking_index 的车牌归一化），按关键词与句子长度打分
+    - 店铺位置：固定问法抽取店名，置信度为店铺搜索索引的相关度（三元组/编辑距离模型），
+      并要求与第二名拉开差距
+    任何一项不满足（多个车牌、多个意图、店名有歧义、句子过长）都返回 None，交给 LLM。
+    """
+
+    def __init__(
+        self,
+        shop_search: Callable[[str, int], List[Tuple[str, float]]],
+        min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+        enabled: bool = DEFAULT_ENABLED
+    ):
+        """
+        Args:
+            shop_search: 店铺搜索函数 (query, k) → [(店铺 key, 相关度)]，例如 SHOP_INDEX.search
+        """
+        self.shop_search = shop_search
+        self.min_confidence = min_confidence
+        self.enabled = enabled
+        self.stats = {"routed": 0, "fallbacks": 0, "find_parking": 0, "get_shop_info": 0}
+
+    def classify(self, text: str) -> Optional[Dict[str, Any]]:
+        """
+        识别一条用户消息
+
+        Returns:
+            dict: {"tool", "arguments", "confidence", "language"}；需要交给 LLM 时返回 None
+        """
+        route = self._classify(text) if self.enabled else None
+        if route is None or route["confidence"] < self.min_confidence:
+            self.stats["fallbacks"] += 1
+            return None
+        self.stats["routed"] += 1
+        self.stats[route["tool"]] += 1
+        return route
+
+    def _classify(self, text: str) -> Optional[Dict[str, Any]]:
+        normalized = normalize(text)
+        if not normalized or len(normalized.split()) > MAX_WORDS:
+            return None
+        if _has_any(normalized, OTHER_INTENT_WORDS, OTHER_INTENT_WORDS_CJK):
+            return None
+
+        language = detect_language(text)
+
+        parking = classify_parking(normalized)
+        if parking is not None:
+            arguments, confidence = parking
+            return {"tool": "find_parking", "arguments": arguments,
+                    "confidence": confidence, "language": language}
+
+        query = shop_query(normalized)
+        if query is None or any(ch.isdigit() for ch in query) or \
+                _has_any(query, PARKING_WORDS, PARKING_WORDS_CJK):
+            return None
+
+        matches = self.shop_search(query, 2)
+        if not matches:
+            return None
+        confidence = matches[0][1]
+        # 与第二名太接近说明店名有歧义
+        if len(matches) > 1 and matches[1][1] > confidence - 0.1:
+            confidence = min(confidence, 0.5)
+        return {"tool": "get_shop_info", "arguments": {"shop_name": query},
+                "confidence": confidence, "language": language}
+
+
+# ==================== 模板回复 ====================
+
+TEMPLATES = {
+    ("find_parking", True): {
+        "en": "Your car {plate} is parked at spot {spot} (level {level}). Have a wonderful day!",
+        "ar": "سيارتك {plate} متوقفة في الموقف {spot} (الطابق {level}). نتمنى لك يوماً سعيداً!",
+        "zh": "您的车辆 {plate} 停放在 {spot}（{level} 层）。祝您愉快！"
+    },
+    ("find_parking", False): {
+        "en": "I couldn't find a parking record for {plate}. Please check the plate number, "
+              "or visit the Customer Service Center (Ground Floor, Zone A) for help.",
+        "ar": "لم أجد سجل موقف للوحة {plate}. يرجى التأكد من رقم اللوحة، "
+              "أو زيارة مركز خدمة العملاء (الطابق الأرضي، المنطقة A).",
+        "zh": "未找到车牌号 {plate} 的停车记录。请确认车牌号，或前往客服中心（Ground Floor, Zone A）咨询。"
+    },
+    ("get_shop_info", True): {
+        "en": "{name} is located at {location}. Is there anything else I can help you with?",
+        "ar": "يقع {name} في {location}. هل يمكنني مساعدتك في شيء آخر؟",
+        "zh": "{name} 位于 {location}。{description}"
+    }
+}
+
+
+def render_reply(route: Dict[str, Any], result: Dict[str, Any]) -> Optional[str]:
+    """
+    把工具结果渲染为模板回复（按用户语言）
+
+    Returns:
+        str: 回复文本；没有对应模板（例如店铺未找到）时返回 None，由调用方交给 LLM
+    """
+    if "error" in result:
+        return None
+    templates = TEMPLATES.get((route["tool"], bool(result.get("success"))))
+    if templates is None:
+        return None
+    template = templates.get(route["language"], templates["en"])
+
+    if route["tool"] == "find_parking":
+        if result.get("success"):
+            return template.format(plate=result["plate_number"], spot=result["parking_spot"],
+                                   level=spot_level(result["parking_spot"]))
+        return template.format(plate=route["arguments"]["plate_number"].upper())
+
+    shop = result["shop"]
+    return template.format(name=shop["name"], location=shop["location"],
+                           description=shop.get("description", "")).strip()
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import time
+    from mock_data import SHOP_INDEX, find_parking, get_shop_info
+
+    print("意图快速路由测试\n")
+
+    router = IntentRouter(SHOP_INDEX.search)
+    cases = {
+        "Where is my car? DXB-1234": "find_parking",
+        "DXB 1234": "find_parking",
+        "where's my car, plate 5678?": "find_parking",
+        "أين سيارتي؟ دبي ١٢٣٤": "find_parking",
+        "我的车在哪 DXB-1234": "find_parking",
+        "where did i park my car dxb 1234": "find_parking",
+        "I parked my car, plate DXB 1234": "find_parking",
+        "Where is Hermès?": "get_shop_info",
+        "where is the apple store": "get_shop_info",
+        "أين هيرميس؟": "get_shop_info",
+        "爱马仕在哪里？": "get_shop_info",
+        # 交给 LLM
+        "Where is my car?": None,
+        "My car is DXB-1234 and I want to redeem points": None,
+        "Where is the nearest coffee?": None,
+        "Where is Hermes and Chanel?": None,
+        "Compare DXB-1234 and DXB-5678": None,
+        "Tell me about luxury brands": None,
+        "how many free spaces on B1": None,
+        "I lost my car key, plate DXB-1234": None,
+        "I hit a car DXB-1234": None,
+        "Sell my car DXB-1234": None,
+        "Where is the car that hit mine? DXB-1234": None,
+        "1234": None,
+    }
+    for text, expected in cases.items():
+        route = router.classify(text)
+        print(f"   {text!r:52} → {route and (route['tool'], route['arguments'], route['confidence'])}")
+        assert (route and route["tool"]) == expected, text
+
+    for text in ["Where is my car? DXB-1234", "أين سيارتي؟ دبي ١٢٣٤", "我的车在哪 SHJ 0000", "爱马仕在哪里？"]:
+        route = router.classify(text)
+        function = find_parking if route["tool"] == "find_parking" else get_shop_info
+        print(f"   {render_reply(route, function(**route['arguments']))}")
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        router.classify("Where is my car? DXB-1234")
+        router.classify("Where is Hermès?")
+    print(f"\n   单次识别: {(time.perf_counter() - start) / 2000 * 1e6:.1f} µs")
+    print(f"   统计: {router.stats}")
+
+    print("\n所有测试完成！")
@@ -0,0 +1,346 @@
+"""
+迪拜商场互动服务 Agent - DeepSeek 客户端连接池
+按 (api_key, base_url) 复用 OpenAI 客户端，保持 HTTP keep-alive 连接，避免每轮对话重新握手
+"""
+
+import os
+import time
+import atexit
+import asyncio
+import threading
+import weakref
+from typing import Any, Awaitable, Dict, Optional, Tuple, TypeVar
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+T = TypeVar("T")
+
+
+# ==================== 默认配置 ====================
+
+DEEPSEEK_BASE_URL = os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+
+# 连接池参数（可通过环境变量覆盖）
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get("LLM_POOL_MAX_CONNECTIONS", "20"))
+DEFAULT_MAX_KEEPALIVE = int(os.environ.get("LLM_POOL_MAX_KEEPALIVE", str(DEFAULT_MAX_CONNECTIONS)))
+DEFAULT_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+DEFAULT_IDLE_TIMEOUT = float(os.environ.get("LLM_CLIENT_IDLE_TIMEOUT", "600"))
+DEFAULT_REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", "60"))
+
+# 每个事件循环允许同时进行的上游请求数
+DEFAULT_MAX_INFLIGHT = int(os.environ.get("LLM_MAX_INFLIGHT", str(DEFAULT_MAX_CONNECTIONS)))
+
+
+# ==================== 客户端注册表 ====================
+
+class ClientRegistry:
+    """
+    OpenAI 客户端注册表（线程安全）
+
+    每个 (api_key, base_url) 对应一个长期存活的客户端及其 httpx 连接池；
+    超过 idle_timeout 未被使用的客户端会在下一次访问时被回收并关闭连接。
+    异步客户端的连接池绑定在事件循环上，因此额外按事件循环区分。
+    """
+
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE,
+        keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        request_timeout: float = DEFAULT_REQUEST_TIMEOUT
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self._clients: Dict[Tuple, Any] = {}
+        self._last_used: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def get_client(self, api_key: str, base_url: Optional[str] = None) -> OpenAI:
+        """获取（或创建）指定 api_key + base_url 的共享客户端"""
+        key = (api_key, base_url or DEEPSEEK_BASE_URL)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ClientRegistry 已关闭，无法再创建客户端")
+
+            self._evict_idle_locked(now, keep=key)
+
+            client = self._clients.get(key)
+            if client is None:
+                client = OpenAI(
+                    api_key=key[0],
+                    base_url=key[1],
+                    timeout=self.request_timeout,
+                    http_client=httpx.Client(
+                        limits=self.limits,
+                        timeout=self.request_timeout
+                    )
+                )
+                self._clients[key] = client
+            self._last_used[key] = now
+            return client
+
+    def get_async_client(self, api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+        """获取（或创建）当前事件循环上的共享异步客户端（必须在协程中调用）"""
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url or DEEPSEEK_BASE_URL, loop)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ClientRegistry 已关闭，无法再创建客户端")
+
+            self._evict_idle_locked(now, keep=key)
+
+            client = self._clients.get(key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=key[0],
+                    base_url=key[1],
+                    timeout=self.request_timeout,
+                    # 重试由 resilience.ResilientCaller 统一负责（含退避、总体超时与熔断），避免两层重试叠加
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(
+                        limits=self.limits,
+                        timeout=self.request_timeout
+                    )
+                )
+                self._clients[key] = client
+            self._last_used[key] = now
+            return client
+
+    def evict_idle(self) -> int:
+        """立即回收所有空闲超时的客户端，返回回收数量"""
+        with self._lock:
+            return self._evict_idle_locked(time.monotonic())
+
+    def _evict_idle_locked(self, now: float, keep: Optional[Tuple] = None) -> int:
+        expired = [
+            key for key, last_used in self._last_used.items()
+            if key != keep and now - last_used > self.idle_timeout
+        ]
+        for key in expired:
+            self._close_locked(key)
+        return len(expired)
+
+    def close(self, api_key: str, base_url: Optional[str] = None):
+        """关闭指定客户端（例如用户在侧边栏更换了 API Key）"""
+        base_url = base_url or DEEPSEEK_BASE_URL
+        with self._lock:
+            for key in [k for k in self._clients if k[:2] == (api_key, base_url)]:
+                self._close_locked(key)
+
+    def _close_locked(self, key: Tuple):
+        client = self._clients.pop(key, None)
+        self._last_used.pop(key, None)
+        if client is None:
+            return
+
+        try:
+            if len(key) == 3:
+                # 异步客户端只能在其所属事件循环上关闭；循环已结束时连接随之释放
+                loop = key[2]
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(client.close(), loop)
+            else:
+                client.close()
+        except Exception as e:
+            print(f"⚠️ 关闭客户端失败: {e}")
+
+    def close_all(self):
+        """关闭全部客户端及连接池（进程退出时自动调用）"""
+        with self._lock:
+            for key in list(self._clients):
+                self._close_locked(key)
+            self._closed = True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+
+# 全局注册表实例（Streamlit 与命令行共用）
+CLIENT_REGISTRY = ClientRegistry()
+atexit.register(CLIENT_REGISTRY.close_all)
+
+
+def get_client(api_key: str, base_url: Optional[str] = None) -> OpenAI:
+    """从全局注册表获取共享客户端"""
+    return CLIENT_REGISTRY.get_client(api_key, base_url)
+
+
+def get_async_client(api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    """从全局注册表获取当前事件循环上的共享异步客户端"""
+    return CLIENT_REGISTRY.get_async_client(api_key, base_url)
+
+
+# ==================== 上游并发控制 ====================
+
+# asyncio.Semaphore 绑定事件循环，因此每个循环各持有一个
+_UPSTREAM_SEMAPHORES: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def upstream_semaphore() -> asyncio.Semaphore:
+    """获取当前事件循环的上游请求信号量（限制同时在途的 LLM 请求数）"""
+    loop = asyncio.get_running_loop()
+    semaphore = _UPSTREAM_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_MAX_INFLIGHT)
+        _UPSTREAM_SEMAPHORES[loop] = semaphore
+    return semaphore
+
+
+# ==================== 前缀缓存统计 ====================
+
+class PromptCacheStats:
+    """
+    累计上游返回的前缀缓存命中情况（线程安全）
+
+    DeepSeek 在 usage 中返回 prompt_cache_hit_tokens / prompt_cache_miss_tokens；
+    OpenAI 兼容服务返回 prompt_tokens_details.cached_tokens，两者都支持。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.hit_tokens = 0
+            self.miss_tokens = 0
+
+    @staticmethod
+    def parse(usage: Any) -> Optional[Dict[str, int]]:
+        """从 usage 对象（或字典）中提取 prompt / 命中 / 未命中 token 数"""
+        if usage is None:
+            return None
+
+        def field(obj: Any, name: str) -> Any:
+            return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+        prompt_tokens = field(usage, "prompt_tokens") or 0
+        hit = field(usage, "prompt_cache_hit_tokens")
+        if hit is None:
+            details = field(usage, "prompt_tokens_details")
+            hit = (field(details, "cached_tokens") if details is not None else None) or 0
+        miss = field(usage, "prompt_cache_miss_tokens")
+        if miss is None:
+            miss = max(prompt_tokens - hit, 0)
+        return {"prompt_tokens": prompt_tokens, "hit_tokens": hit, "miss_tokens": miss}
+
+    def record(self, usage: Any) -> Optional[Dict[str, int]]:
+        """记录一次请求的用量，返回解析结果"""
+        parsed = self.parse(usage)
+        if parsed is None:
+            return None
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += parsed["prompt_tokens"]
+            self.hit_tokens += parsed["hit_tokens"]
+            self.miss_tokens += parsed["miss_tokens"]
+        return parsed
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hit_tokens + self.miss_tokens
+        return self.hit_tokens / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "hit_tokens": self.hit_tokens,
+                "miss_tokens": self.miss_tokens,
+                "hit_rate": round(self.hit_rate, 4)
+            }
+
+
+# 全局前缀缓存统计
+PROMPT_CACHE_STATS = PromptCacheStats()
+
+
+# ==================== 同步桥接 ====================
+
+_BACKGROUND_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_BACKGROUND_LOCK = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    """惰性启动一个常驻后台事件循环，供同步调用方复用异步客户端连接池"""
+    global _BACKGROUND_LOOP
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever,
+                name="llm-client-loop",
+                daemon=True
+            ).start()
+            _BACKGROUND_LOOP = loop
+        return _BACKGROUND_LOOP
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """
+    在后台事件循环上运行协程并阻塞等待结果
+
+    调用线程被中断（如 KeyboardInterrupt）时会取消对应的任务。
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _background_loop())
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def shutdown_clients():
+    """关闭全局注册表中的所有连接"""
+    CLIENT_REGISTRY.close_all()
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    from stub_server import StubLLMServer
+
+    print("DeepSeek 客户端连接池 - 本地桩服务器测试\n")
+
+    with StubLLMServer() as server:
+        registry = ClientRegistry(idle_timeout=0.5)
+
+        # 同一 key 两次请求应复用同一客户端与同一 TCP 连接
+        for i in range(3):
+            client = registry.get_client("sk-test", server.base_url)
+            reply = client.chat.completions.create(
+                model="deepseek-chat",
+                messages=[{"role": "user", "content": f"ping {i}"}]
+            )
+            print(f"   回复 {i}: {reply.choices[0].message.content}")
+
+        print(f"\n   客户端数量: {len(registry)}")
+        print(f"   服务端收到请求: {server.request_count}，建立 TCP 连接: {server.connection_count}")
+        assert server.connection_count == 1, "连接未被复用"
+
+        # 空闲回收
+        time.sleep(0.6)
+        print(f"   空闲回收数量: {registry.evict_idle()}")
+        assert len(registry) == 0
+
+        registry.close_all()
+
+    print("\n所有测试完成！")
@@ -0,0 +1,411 @@
+"""
+迪拜商场互动服务 Agent - 商场地图
+楼层 × 区域构成的步行图（含扶梯、电梯），启动时预计算全点对最短距离和按类别排好序的最近店铺表，
+"离我最近的咖啡馆"、"2 楼有什么" 之类的问题无需模型翻阅整个店铺目录即可直接回答
+"""
+
+import re
+import math
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from shop_index import normalize
+
+
+# ==================== 地图数据 ====================
+
+# 楼层（从下到上）及其显示名称（与 mock_data.SHOPS 中的 floor 字段一致）
+FLOORS = ["B2", "B1", "G", "1", "2", "3"]
+FLOOR_NAMES = {
+    "B2": "B2 Parking",
+    "B1": "B1 Parking",
+    "G": "Ground Floor",
+    "1": "1st Floor",
+    "2": "2nd Floor",
+    "3": "3rd Floor"
+}
+
+# 区域在商场平面上的坐标（米）；各楼层区域上下对齐
+ZONE_COORDS = {
+    "A": (0, 0),       # 正门
+    "B": (60, 0),      # 喷泉
+    "C": (120, 0),
+    "D": (120, 60),    # 美食广场
+    "E": (60, 90),     # 影院入口
+    "F": (60, 40),     # 中央广场（中央电梯）
+    "G": (0, 60),
+    "H": (-40, 30)
+}
+
+# 同层相邻区域之间的步行通道
+WALKWAYS = [
+    ("A", "B"), ("B", "C"), ("C", "D"), ("D", "E"), ("E", "G"), ("G", "H"), ("H", "A"),
+    ("F", "A"), ("F", "B"), ("F", "D"), ("F", "E"), ("F", "G")
+]
+
+# 停车层只有 A~F 区（对应停车分区）
+PARKING_ZONES = ["A", "B", "C", "D", "E", "F"]
+
+# 垂直通道：(名称, 所在区域, 连接的楼层, 每层折算步行距离（米，含等候）)
+CONNECTORS = [
+    ("Escalator 1", "A", ["G", "1", "2", "3"], 25),
+    ("Escalator 3", "C", ["G", "1", "2", "3"], 25),
+    ("Central Lift", "F", ["B2", "B1", "G", "1", "2", "3"], 35)
+]
+
+# 可直接作为起点的地标
+LANDMARKS = {
+    "main entrance": ("G", "A"),
+    "fountain": ("G", "B"),
+    "central plaza": ("G", "F"),
+    "food court": ("2", "D"),
+    "cinema": ("1", "E"),
+    "正门": ("G", "A"),
+    "入口": ("G", "A"),
+    "喷泉": ("G", "B"),
+    "美食广场": ("2", "D"),
+    "影院": ("1", "E"),
+    "المدخل الرئيسي": ("G", "A"),
+    "النافورة": ("G", "B")
+}
+
+# 类别同义词（归一化后按词匹配）→ SHOPS 中的 category
+CATEGORY_SYNONYMS = {
+    "Cafe & Dining": ["cafe", "coffee", "dining", "food", "restaurant", "eat", "burger",
+                      "咖啡", "餐厅", "餐饮", "吃", "美食", "مقهى", "قهوة", "مطعم"],
+    "Luxury Fashion": ["luxury", "designer", "handbag", "奢侈品", "名牌", "فاخر"],
+    "Fashion Retail": ["fashion", "clothes", "clothing", "apparel", "服装", "衣服", "ملابس", "ازياء"],
+    "Electronics": ["electronics", "phone", "iphone", "computer", "电子", "数码", "手机", "الكترونيات"],
+    "Service Facility": ["service", "facility", "prayer", "lounge", "服务", "客服", "祈祷", "خدمات", "مصلى"]
+}
+
+# 步行速度（米/秒）
+WALK_SPEED = 1.2
+
+Node = Tuple[str, str]
+
+
+# ==================== 位置解析 ====================
+
+_FLOOR_PATTERNS = [
+    ("B2", r"\bb2\b|\bbasement 2\b|地下二层|负二"),
+    ("B1", r"\bb1\b|\bbasement 1\b|\bbasement\b|地下一层|负一"),
+    ("G", r"\bground\b|\bgf\b|\blobby\b|一楼|1楼|首层|底层|الارضي"),
+    ("1", r"\b1st\b|\bfirst\b|\bl1\b|\blevel 1\b|二楼|2楼|الاول"),
+    ("2", r"\b2nd\b|\bsecond\b|\bl2\b|\blevel 2\b|三楼|3楼|الثاني"),
+    ("3", r"\b3rd\b|\bthird\b|\bl3\b|\blevel 3\b|四楼|4楼|الثالث")
+]
+
+# 停车位编号，例如 "B2-A05"
+_PARKING_SPOT = re.compile(r"\b(b[12])\s*([a-f])\s*\d+\b")
+_ZONE = re.compile(r"\bzone\s*([a-h])\b|\b([a-h])\s*区|区\s*([a-h])\b")
+
+
+def parse_floor(text: str) -> Optional[str]:
+    """从文本中解析楼层代码（"2nd Floor" → "2"，"Ground" → "G"），无法识别时返回 None"""
+    normalized = normalize(text)
+    for floor, pattern in _FLOOR_PATTERNS:
+        if re.search(pattern, normalized):
+            return floor
+    if normalized.upper() in FLOOR_NAMES:
+        return normalized.upper()
+    return None
+
+
+# ==================== 商场地图 ====================
+
+class MallMap:
+    """
+    商场地图与最近店铺索引
+
+    - 节点为 (楼层, 区域)，边为同层步行通道和扶梯/电梯
+    - 构建时用 Floyd-Warshall 预计算全点对最短距离及下一跳（节点数约 40，一次性开销可忽略）
+    - 每个 (起点节点, 类别) 预先按距离排好店铺列表，查询只需取前 k 个
+    店铺增删时只重建受影响类别的排序表。
+    """
+
+    def __init__(
+        self,
+        shops: Optional[Dict[str, Dict[str, Any]]] = None,
+        resolve_shop: Optional[Callable[[str], Optional[str]]] = None
+    ):
+        """
+        Args:
+            shops: 店铺字典（key → 店铺信息），需包含 floor 和 zone 字段
+            resolve_shop: 把用户输入的店铺名解析为店铺 key 的函数（用于 "从 Zara 出发"）
+        """
+        self.resolve_shop = resolve_shop
+        self.shops: Dict[str, Dict[str, Any]] = {}
+        self._shop_nodes: Dict[str, Node] = {}
+        self._by_category: Dict[str, Set[str]] = defaultdict(set)
+        self._nearest: Dict[Tuple[Node, str], List[str]] = {}
+
+        self.nodes: List[Node] = []
+        self._edges: Dict[Node, Dict[Node, Tuple[float, Optional[str]]]] = defaultdict(dict)
+        self._build_graph()
+        self._dist, self._next = self._all_pairs()
+
+        for key, shop in (shops or {}).items():
+            self.add(key, shop, reindex=False)
+        for category in list(self._by_category):
+            self._reindex(category)
+
+    # ---------- 图构建 ----------
+
+    def _build_graph(self):
+        for floor in FLOORS:
+            zones = PARKING_ZONES if floor.startswith("B") else list(ZONE_COORDS)
+            self.nodes.extend((floor, zone) for zone in zones)
+            for a, b in WALKWAYS:
+                if a in zones and b in zones:
+                    self._link((floor, a), (floor, b), math.dist(ZONE_COORDS[a], ZONE_COORDS[b]), None)
+
+        for name, zone, floors, cost in CONNECTORS:
+            for lower, upper in zip(floors, floors[1:]):
+                self._link((lower, zone), (upper, zone), cost, name)
+
+    def _link(self, a: Node, b: Node, distance: float, via: Optional[str]):
+        self._edges[a][b] = (distance, via)
+        self._edges[b][a] = (distance, via)
+
+    def _all_pairs(self):
+        dist = {u: {v: math.inf for v in self.nodes} for u in self.nodes}
+        nxt: Dict[Node, Dict[Node, Optional[Node]]] = {u: {} for u in self.nodes}
+        for u in self.nodes:
+            dist[u][u] = 0.0
+            nxt[u][u] = u
+            for v, (distance, _) in self._edges[u].items():
+                dist[u][v] = distance
+                nxt[u][v] = v
+
+        for k in self.nodes:
+            dist_k = dist[k]
+            for i in self.nodes:
+                dist_i = dist[i]
+                d_ik = dist_i[k]
+                if d_ik == math.inf:
+                    continue
+                for j in self.nodes:
+                    candidate = d_ik + dist_k[j]
+                    if candidate < dist_i[j]:
+                        dist_i[j] = candidate
+                        nxt[i][j] = nxt[i][k]
+        return dist, nxt
+
+    # ---------- 店铺索引 ----------
+
+    def _shop_node(self, shop: Dict[str, Any]) -> Optional[Node]:
+        floor = parse_floor(shop.get("floor", ""))
+        zone = str(shop.get("zone", "")).upper()
+        node = (floor, zone)
+        return node if node in self._dist else None
+
+    def add(self, key: str, shop: Dict[str, Any], reindex: bool = True):
+        """加入（或更新）一个店铺；没有可识别楼层/区域的店铺不参与距离查询"""
+        self.remove(key, reindex=reindex)
+        node = self._shop_node(shop)
+        if node is None:
+            return
+
+        self.shops[key] = shop
+        self._shop_nodes[key] = node
+        category = shop.get("category", "")
+        self._by_category[category].add(key)
+        if reindex:
+            self._reindex(category)
+
+    def remove(self, key: str, reindex: bool = True):
+        """移除一个店铺"""
+        shop = self.shops.pop(key, None)
+        if shop is None:
+            return
+
+        self._shop_nodes.pop(key, None)
+        category = shop.get("category", "")
+        self._by_category[category].discard(key)
+        if not self._by_category[category]:
+            del self._by_category[category]
+        if reindex:
+            self._reindex(category)
+
+    def _reindex(self, category: str):
+        keys = self._by_category.get(category, set())
+        for node in self.nodes:
+            if keys:
+                dist = self._dist[node]
+                self._nearest[(node, category)] = sorted(
+                    keys, key=lambda key: (dist[self._shop_nodes[key]], key)
+                )
+            else:
+                self._nearest.pop((node, category), None)
+
+    def node_of(self, key: str) -> Optional[Node]:
+        """店铺所在节点 (楼层, 区域)"""
+        return self._shop_nodes.get(key)
+
+    @property
+    def categories(self) -> List[str]:
+        return sorted(self._by_category)
+
+    def match_categories(self, text: Optional[str]) -> List[str]:
+        """
+        把用户描述的类别映射到 SHOPS 中的类别（"coffee" → "Cafe & Dining"）
+
+        空文本或 "all" 返回全部类别；无法识别时返回空列表。
+        """
+        query = normalize(text or "")
+        if query in ("", "all", "any", "全部", "所有"):
+            return self.categories
+
+        matched = [
+            c for c in self.categories
+            if normalize(c) == query or (len(query) >= 3 and query in normalize(c))
+        ]
+        if matched:
+            return matched
+
+        tokens = set(query.split())
+        for category, synonyms in CATEGORY_SYNONYMS.items():
+            if category not in self._by_category:
+                continue
+            for synonym in synonyms:
+                synonym = normalize(synonym)
+                if synonym in tokens or (not synonym.isascii() and synonym in query):
+                    matched.append(category)
+                    break
+        return matched
+
+    # ---------- 位置与路线 ----------
+
+    def resolve_location(self, text: Optional[str]) -> Optional[Node]:
+        """
+        解析起点：停车位编号、楼层 + 区域、地标或店铺名
+
+        未给出起点时默认正门；只给区域时取地面层，只给楼层时取该层中央广场。
+        """
+        if not text or not text.strip():
+            return ("G", "A")
+
+        normalized = normalize(text)
+        spot = _PARKING_SPOT.search(normalized)
+        if spot:
+            return (spot.group(1).upper(), spot.group(2).upper())
+
+        floor = parse_floor(text)
+        zone_match = _ZONE.search(normalized)
+        if zone_match:
+            zone = next(g for g in zone_match.groups() if g).upper()
+            node = (floor or "G", zone)
+            return node if node in self._dist else None
+
+        for name, node in LANDMARKS.items():
+            if normalize(name) in normalized:
+                return node
+
+        if floor:
+            return (floor, "F")
+
+        if self.resolve_shop is not None:
+            key = self.resolve_shop(text)
+            if key in self._shop_nodes:
+                return self._shop_nodes[key]
+        return None
+
+    def distance(self, a: Node, b: Node) -> float:
+        """两节点之间的最短步行距离（米）"""
+        return self._dist[a][b]
+
+    def route(self, a: Node, b: Node) -> List[str]:
+        """
+        路线说明：只列出楼层变化（连续乘坐同一扶梯/电梯合并为一步）
+
+        例如 ["乘 Central Lift 从 B2 Parking 到 Ground Floor"]
+        """
+        steps: List[str] = []
+        current_via, start_floor = None, None
+        node = a
+        while node != b:
+            nxt = self._next[node][b]
+            if nxt is None:
+                return []
+            via = self._edges[node][nxt][1]
+            if via != current_via:
+                if current_via is not None:
+                    steps.append(f"乘 {current_via} 从 {FLOOR_NAMES[start_floor]} 到 {FLOOR_NAMES[node[0]]}")
+                current_via, start_floor = via, node[0]
+            node = nxt
+        if current_via is not None:
+            steps.append(f"乘 {current_via} 从 {FLOOR_NAMES[start_floor]} 到 {FLOOR_NAMES[node[0]]}")
+        return steps
+
+    # ---------- 查询 ----------
+
+    def nearby(
+        self,
+        origin: Node,
+        categories: Iterable[str],
+        k: int = 3,
+        floor: Optional[str] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        距离 origin 最近的 k 家店铺
+
+        每个类别的列表已按距离排好序，这里只做 k 路归并。
+
+        Returns:
+            list: [(店铺 key, 距离米)]，按距离升序
+        """
+        dist = self._dist[origin]
+        results: List[Tuple[str, float]] = []
+        for category in categories:
+            taken = 0
+            for key in self._nearest.get((origin, category), []):
+                if floor is not None and self._shop_nodes[key][0] != floor:
+                    continue
+                results.append((key, dist[self._shop_nodes[key]]))
+                taken += 1
+                if taken >= k:
+                    break
+        results.sort(key=lambda item: (item[1], item[0]))
+        return results[:k]
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import time
+    from mock_data import SHOPS, SHOP_INDEX
+
+    print("商场地图测试\n")
+
+    mall = MallMap(SHOPS, resolve_shop=SHOP_INDEX.lookup)
+    print(f"   节点数: {len(mall.nodes)}，类别: {mall.categories}")
+
+    for category, origin in [("coffee", "Zone B"), ("luxury", "B2-A05"), ("咖啡", "Zara"), ("all", "3rd floor")]:
+        node = mall.resolve_location(origin)
+        results = mall.nearby(node, mall.match_categories(category), k=3)
+        print(f"   {category!r} from {origin!r} {node}:")
+        for key, distance in results:
+            print(f"      {key:24} {distance:6.1f} m  {mall.route(node, mall.node_of(key))}")
+
+    assert mall.resolve_location("B2-A05") == ("B2", "A")
+    assert mall.resolve_location("1st Floor, Zone C") == ("1", "C")
+    assert mall.resolve_location("Zara") == ("1", "E")
+    assert mall.match_categories("coffee") == ["Cafe & Dining"]
+    assert mall.nearby(("G", "A"), ["Luxury Fashion"], k=1)[0][0] == "Hermès"
+    assert mall.route(("B2", "A"), ("G", "A")) == ["乘 Central Lift 从 B2 Parking 到 Ground Floor"]
+
+    # 二楼有什么
+    print(f"   2nd floor: {mall.nearby(('2', 'F'), mall.categories, k=10, floor='2')}")
+
+    # 增量更新
+    mall.add("Tim Hortons", {"name": "Tim Hortons", "floor": "Ground Floor", "zone": "B", "category": "Cafe & Dining"})
+    assert mall.nearby(("G", "B"), ["Cafe & Dining"], k=1)[0][0] == "Tim Hortons"
+    mall.remove("Tim Hortons")
+
+    start = time.perf_counter()
+    for _ in range(10000):
+        mall.nearby(("G", "B"), ["Cafe & Dining"], k=3)
+    print(f"\n   单次最近店铺查询: {(time.perf_counter() - start) / 10000 * 1e6:.1f} µs")
+
+    print("\n所有测试完成！")
@@ -3,6 +3,17 @@
 用于演示 Agent 功能的模拟数据和工具函数
 """
 
+import os
+import atexit
+import random
+import string
+import threading
+
+from shop_index import ShopIndex
+from mall_map import MallMap, FLOOR_NAMES, WALK_SPEED, parse_floor
+from parking_index import ParkingIndex
+from tracing import debug
+
 # ==================== 模拟数据库 ====================
 
 # 店铺信息数据库
@@ -10,6 +21,7 @@ SHOPS = {
     "Hermès": {
         "name": "Hermès",
         "floor": "Ground Floor",
+        "zone": "A",
         "category": "Luxury Fashion",
         "description": "法国顶级奢侈品牌，提供手袋、丝巾、配饰等经典产品。",
         "location": "Ground Floor, Zone A, near Main Entrance"
@@ -17,6 +29,7 @@ SHOPS = {
     "Louis Vuitton": {
         "name": "Louis Vuitton",
         "floor": "Ground Floor",
+        "zone": "B",
         "category": "Luxury Fashion",
         "description": "世界知名奢侈品牌，专营皮具、箱包及时尚配饰。",
         "location": "Ground Floor, Zone B, opposite Fountain"
@@ -24,6 +37,7 @@ SHOPS = {
     "Chanel": {
         "name": "Chanel",
         "floor": "1st Floor",
+        "zone": "C",
         "category": "Luxury Fashion",
         "description": "经典法式奢华品牌，提供时装、香水和美妆产品。",
         "location": "1st Floor, Zone C, near Escalator 3"
@@ -31,6 +45,7 @@ SHOPS = {
     "% Arabica": {
         "name": "% Arabica",
         "floor": "2nd Floor",
+        "zone": "D",
         "category": "Cafe & Dining",
         "description": "精品咖啡馆，提供手冲咖啡和轻食。",
         "location": "2nd Floor, Food Court Area, near Window Seating"
@@ -38,6 +53,7 @@ SHOPS = {
     "Shake Shack": {
         "name": "Shake Shack",
         "floor": "2nd Floor",
+        "zone": "D",
         "category": "Cafe & Dining",
         "description": "美式快餐品牌，招牌汉堡和奶昔。",
         "location": "2nd Floor, Food Court, Zone D"
@@ -45,6 +61,7 @@ SHOPS = {
     "Zara": {
         "name": "Zara",
         "floor": "1st Floor",
+        "zone": "E",
         "category": "Fashion Retail",
         "description": "西班牙快时尚品牌，提供男女装及童装。",
         "location": "1st Floor, Zone E, near Cinema Entrance"
@@ -52,6 +69,7 @@ SHOPS = {
     "Apple Store": {
         "name": "Apple Store",
         "floor": "Ground Floor",
+        "zone": "F",
         "category": "Electronics",
         "description": "苹果官方零售店，销售 iPhone、Mac、iPad 等产品及配件。",
         "location": "Ground Floor, Zone F, Central Plaza"
@@ -59,6 +77,7 @@ SHOPS = {
     "Customer Service Center": {
         "name": "Customer Service Center",
         "floor": "Ground Floor",
+        "zone": "A",
         "category": "Service Facility",
         "description": "商场客服中心，提供咨询、失物招领、轮椅租赁等服务。",
         "location": "Ground Floor, Main Entrance Lobby"
@@ -66,6 +85,7 @@ SHOPS = {
     "Prayer Room": {
         "name": "Prayer Room",
         "floor": "3rd Floor",
+        "zone": "G",
         "category": "Service Facility",
         "description": "祈祷室，提供安静的礼拜空间。",
         "location": "3rd Floor, near Restrooms, Zone G"
@@ -73,12 +93,77 @@ SHOPS = {
     "VIP Lounge": {
         "name": "VIP Lounge",
         "floor": "3rd Floor",
+        "zone": "H",
         "category": "Service Facility",
         "description": "VIP 休息室，为高级会员提供休息和饮品服务。",
         "location": "3rd Floor, Zone H, requires membership card"
     }
 }
 
+# 店铺多语言别名（阿拉伯文、阿拉伯语转写、中文、常用缩写），只用于搜索，不返回给模型
+SHOP_ALIASES = {
+    "Hermès": ["هيرميس", "هرمس", "hirmis", "爱马仕"],
+    "Louis Vuitton": ["LV", "لويس فيتون", "لوي فيتون", "louis fitoun", "路易威登", "驴牌"],
+    "Chanel": ["شانيل", "شانيل باريس", "shanel", "香奈儿"],
+    "% Arabica": ["Arabica", "% أرابيكا", "ارابيكا", "阿拉比卡", "% 咖啡"],
+    "Shake Shack": ["شيك شاك", "shek shak", "昔客堡"],
+    "Zara": ["زارا", "飒拉"],
+    "Apple Store": ["Apple", "أبل ستور", "متجر أبل", "苹果店", "苹果专卖店"],
+    "Customer Service Center": ["Customer Service", "Info Desk", "خدمة العملاء", "مكتب الاستعلامات", "客服中心", "服务台"],
+    "Prayer Room": ["مصلى", "غرفة الصلاة", "musalla", "祈祷室", "礼拜室"],
+    "VIP Lounge": ["صالة كبار الشخصيات", "صالة VIP", "贵宾室", "VIP 休息室"]
+}
+
+# 店铺搜索索引（启动时构建一次，增删店铺时增量更新）
+SHOP_INDEX = ShopIndex(SHOPS, SHOP_ALIASES)
+
+
+def _resolve_shop(name):
+    """把用户输入的店铺名解析为 SHOPS 中的 key（用于以店铺作为起点）"""
+    matches = SHOP_INDEX.search(name, k=1)
+    return matches[0][0] if matches and matches[0][1] >= 0.8 else None
+
+
+# 商场地图（预计算距离表与按类别的最近店铺表）
+MALL_MAP = MallMap(SHOPS, resolve_shop=_resolve_shop)
+
+
+# 店铺变更的订阅者（例如用于使缓存失效），回调参数为店铺名
+_SHOP_SUBSCRIBERS = []
+
+
+def subscribe_shops(callback):
+    """订阅店铺的新增、更新与移除"""
+    _SHOP_SUBSCRIBERS.append(callback)
+
+
+def _notify_shops(shop_name):
+    for callback in list(_SHOP_SUBSCRIBERS):
+        try:
+            callback(shop_name)
+        except Exception as e:
+            print(f"⚠️ 店铺变更订阅回调失败: {e}")
+
+
+def add_shop(shop, aliases=None):
+    """新增或更新店铺（可附带多语言别名），并同步更新搜索索引"""
+    SHOPS[shop["name"]] = shop
+    if aliases is not None:
+        SHOP_ALIASES[shop["name"]] = list(aliases)
+    SHOP_INDEX.add(shop["name"], shop, SHOP_ALIASES.get(shop["name"]))
+    MALL_MAP.add(shop["name"], shop)
+    _notify_shops(shop["name"])
+
+
+def remove_shop(shop_name):
+    """移除店铺，并同步更新搜索索引"""
+    SHOPS.pop(shop_name, None)
+    SHOP_ALIASES.pop(shop_name, None)
+    SHOP_INDEX.remove(shop_name)
+    MALL_MAP.remove(shop_name)
+    _notify_shops(shop_name)
+
+
 # 停车场数据库
 PARKING = {
     "DXB-1234": "B2-A05",
@@ -88,18 +173,81 @@ PARKING = {
     "AUH-7890": "B2-E15"
 }
 
+# 各停车层总车位数
+PARKING_CAPACITY = {
+    "B1": 1200,
+    "B2": 1500
+}
+
+# 停车索引（车牌归一化 + O(1) 查询 + 各层占用统计），以 PARKING 为初始数据
+PARKING_INDEX = ParkingIndex(PARKING_CAPACITY)
+PARKING_INDEX.apply_events(
+    {"type": "entry", "plate": plate, "spot": spot} for plate, spot in PARKING.items()
+)
+
+# 闸机事件来源（可选）：持续跟踪 JSONL 文件 / 监听本地 Unix 套接字
+if os.environ.get("PARKING_EVENTS_FILE"):
+    PARKING_INDEX.follow_jsonl(os.environ["PARKING_EVENTS_FILE"])
+if os.environ.get("PARKING_EVENTS_SOCKET"):
+    PARKING_INDEX.serve_socket(os.environ["PARKING_EVENTS_SOCKET"])
+
 # 用户状态（内存存储）
 class UserState:
-    """用于 Demo 的用户状态管理（支持持久化存储）"""
-    def __init__(self, data_file="user_data.json"):
+    """
+    用于 Demo 的用户状态管理（支持持久化存储）
+
+    同一用户的读-改-写操作持有该用户的锁；整文件写入由 _save_lock 串行化，
+    序列化与写文件在同一把锁内完成，避免旧快照覆盖新快照。
+
+    commit_mode:
+        sync  - 每次变更立即重写文件（默认）
+        group - 组提交：变更立即在内存生效并返回，后台线程把一个时间窗口
+                （flush_interval_ms）或一批（flush_max_batch）变更合并为一次写入；
+                可调用 flush() 立即落盘，进程退出时自动 flush
+
+    写文件失败时变更仍记为待写（下一次保存或 flush 时重试），flush() / close() 抛出写入异常，
+    调用方可据此得知数据尚未落盘；后台刷写线程失败后等待 FLUSH_RETRY_SECONDS 再重试。
+    """
+    FLUSH_RETRY_SECONDS = 1.0
+
+    def __init__(self, data_file="user_data.json", commit_mode="sync",
+                 flush_interval_ms=50, flush_max_batch=256):
+        if commit_mode not in ("sync", "group"):
+            raise ValueError(f"未知的提交模式: {commit_mode}")
+
         self.data_file = data_file
         self.users = {}
+        self.commit_mode = commit_mode
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_batch = flush_max_batch
+        self._save_lock = threading.Lock()  # 保护 users 字典结构和文件写入
+        self._user_locks = {}
+        self._user_locks_guard = threading.Lock()
         self.load()  # 启动时加载数据
 
+        # 组提交状态
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # 串行化 flush，同一批变更不会被两次扣除
+        self._stop = threading.Event()
+        self._flusher = None
+        if commit_mode == "group":
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-state-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def _lock_for(self, user_id):
+        """获取该用户的锁（不同用户互不阻塞）"""
+        with self._user_locks_guard:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
     def load(self):
-        """从JSON文件加载用户数据"""
+        """从JSON文件加载用户数据（文件损坏时移到 <data_file>.corrupt-<时间> 后从空数据开始）"""
         import json
-        import os
+        import time
 
         if os.path.exists(self.data_file):
             try:
@@ -107,54 +255,159 @@ class UserState:
                     self.users = json.load(f)
                 print(f"✅ 已从 {self.data_file} 加载用户数据")
             except Exception as e:
-                print(f"⚠️ 加载用户数据失败: {e}")
+                # 文件损坏：先移到一旁保留原始数据，再从空数据开始（否则下一次写入会覆盖它）
+                corrupt_file = f"{self.data_file}.corrupt-{time.strftime('%Y%m%d-%H%M%S')}"
+                os.replace(self.data_file, corrupt_file)
+                print(f"⚠️ 加载用户数据失败: {e}；已将损坏的文件移至 {corrupt_file}")
                 self.users = {}
         else:
             print(f"📝 {self.data_file} 不存在，将创建新的用户数据")
             self.users = {}
 
     def save(self):
-        """保存用户数据到JSON文件"""
+        """保存用户数据到JSON文件（同步模式立即写入，组提交模式下只登记一次待写变更）"""
+        with self._pending_cond:
+            self._pending += 1
+            self._pending_cond.notify()
+        if self.commit_mode == "group":
+            return
+
+        try:
+            self.flush()
+        except Exception:
+            pass  # 已打印警告；变更保留为待写，下一次保存或 flush 时重试
+
+    def _write_file(self, batch_size=1):
+        """
+        把当前全部用户数据写入文件；失败时打印警告并抛出异常
+
+        先写临时文件并 fsync，再原子替换数据文件：写到一半时进程被杀，数据文件仍是上一个完整版本
+        """
         import json
 
+        tmp_file = self.data_file + ".tmp"
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(self.users, f, ensure_ascii=False, indent=2)
-            print(f"💾 用户数据已保存到 {self.data_file}")
+            with self._save_lock:
+                data = json.dumps(self.users, ensure_ascii=False, indent=2)
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.data_file)
         except Exception as e:
-            print(f"⚠️ 保存用户数据失败: {e}")
+            print(f"⚠️ 保存用户数据失败（{batch_size} 次变更尚未落盘）: {e}")
+            raise
+        if batch_size > 1:
+            debug(f"💾 用户数据已保存到 {self.data_file}（合并 {batch_size} 次变更）")
+        else:
+            debug(f"💾 用户数据已保存到 {self.data_file}")
+
+    def flush(self):
+        """
+        立即写入所有尚未落盘的变更
+
+        写入成功后才从待写计数中扣除（写入期间到达的新变更留到下一次）；
+        写入失败时待写计数不变，异常抛给调用方
+        """
+        with self._flush_lock:
+            with self._pending_cond:
+                batch_size = self._pending
+            if batch_size:
+                self._write_file(batch_size)
+                with self._pending_cond:
+                    self._pending -= batch_size
+
+    def _flush_loop(self):
+        """后台刷写线程：等到第一笔变更后，再收集一个时间窗口或一整批变更统一写入"""
+        while not self._stop.is_set():
+            with self._pending_cond:
+                self._pending_cond.wait_for(lambda: self._pending or self._stop.is_set())
+                self._pending_cond.wait_for(
+                    lambda: self._pending >= self.flush_max_batch or self._stop.is_set(),
+                    timeout=self.flush_interval
+                )
+            try:
+                self.flush()
+            except Exception:
+                # 已打印警告；变更保留为待写，稍后重试（close() 时的最后一次 flush 会把异常抛给调用方）
+                self._stop.wait(self.FLUSH_RETRY_SECONDS)
+
+    def close(self):
+        """停止后台刷写线程并写入剩余变更（写入失败时抛出异常）"""
+        if self._flusher is not None and not self._stop.is_set():
+            self._stop.set()
+            with self._pending_cond:
+                self._pending_cond.notify()
+            self._flusher.join()
+        self.flush()
 
     def get_user(self, user_id):
         """获取或创建用户"""
         if user_id not in self.users:
-            self.users[user_id] = {
-                "points": 0,
-                "coupons": []
-            }
-            self.save()  # 新建用户时保存
+            with self._save_lock:
+                created = user_id not in self.users
+                if created:
+                    self.users[user_id] = {
+                        "points": 0,
+                        "coupons": []
+                    }
+            if created:
+                self.save()  # 新建用户时保存
         return self.users[user_id]
 
     def add_points(self, user_id, amount):
         """增加积分"""
-        user = self.get_user(user_id)
-        user["points"] += amount
-        self.save()  # 积分变化时保存
-        return user["points"]
+        with self._lock_for(user_id):
+            user = self.get_user(user_id)
+            user["points"] += amount
+            self.save()  # 积分变化时保存
+            return user["points"]
 
     def deduct_points(self, user_id, amount):
         """扣除积分"""
-        user = self.get_user(user_id)
-        if user["points"] >= amount:
-            user["points"] -= amount
-            self.save()  # 积分变化时保存
-            return True
-        return False
+        with self._lock_for(user_id):
+            user = self.get_user(user_id)
+            if user["points"] >= amount:
+                user["points"] -= amount
+                self.save()  # 积分变化时保存
+                return True
+            return False
 
     def add_coupon(self, user_id, coupon):
         """添加优惠券"""
-        user = self.get_user(user_id)
-        user["coupons"].append(coupon)
-        self.save()  # 优惠券变化时保存
+        with self._lock_for(user_id):
+            user = self.get_user(user_id)
+            user["coupons"].append(coupon)
+            self.save()  # 优惠券变化时保存
+
+    def redeem(self, user_id, coupon_type, cost, code=None):
+        """
+        原子兑换优惠券：检查积分、扣除积分、发放优惠券在同一把用户锁内完成，只保存一次
+
+        Args:
+            user_id: 用户 ID
+            coupon_type: 优惠券类型
+            cost: 所需积分
+            code: 优惠券代码（默认随机生成）
+
+        Returns:
+            dict: 成功时 {"success": True, "coupon": {...}, "remaining_points": n}，
+                  积分不足时 {"success": False, "current_points": n}
+        """
+        with self._lock_for(user_id):
+            user = self.get_user(user_id)
+            if user["points"] < cost:
+                return {"success": False, "current_points": user["points"]}
+
+            coupon = {
+                "type": coupon_type,
+                "code": code or generate_coupon_code(),
+                "points_cost": cost
+            }
+            user["points"] -= cost
+            user["coupons"].append(coupon)
+            self.save()  # 一次写入同时持久化扣分和优惠券
+            return {"success": True, "coupon": coupon, "remaining_points": user["points"]}
 
     def get_points(self, user_id):
         """获取当前积分"""
@@ -164,8 +417,60 @@ class UserState:
         """获取优惠券列表"""
         return self.get_user(user_id)["coupons"]
 
+    def reset_user(self, user_id):
+        """删除用户的全部状态"""
+        with self._lock_for(user_id):
+            with self._save_lock:
+                removed = self.users.pop(user_id, None) is not None
+            if removed:
+                self.save()
+
+
+def generate_coupon_code():
+    """生成 8 位随机优惠券代码"""
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+
+
+def create_user_state(backend=None, data_file="user_data.json"):
+    """
+    按配置创建用户状态存储
+
+    Args:
+        backend: 存储后端（默认读取环境变量 USER_STATE_BACKEND）
+            - json: 每次变更重写整个 JSON 文件（默认，适合 Demo；
+                    USER_STATE_COMMIT=group 时启用组提交，见 UserState）
+            - wal:  追加写日志 + 后台快照压缩（见 wal_store.py）
+            - sqlite: SQLite WAL 模式数据库（见 sqlite_store.py），首次启动时自动迁移 JSON 数据
+            - remote: 通过 Unix socket 访问用户状态服务（见 state_service.py），多个工作进程共享同一份数据
+        data_file: 数据文件路径（sqlite 后端使用同名 .db 文件；remote 后端由服务进程决定，忽略此参数）
+
+    Returns:
+        与 UserState 接口一致的存储实例
+    """
+    backend = backend or os.environ.get("USER_STATE_BACKEND", "json")
+
+    if backend == "json":
+        return UserState(
+            data_file,
+            commit_mode=os.environ.get("USER_STATE_COMMIT", "sync"),
+            flush_interval_ms=float(os.environ.get("USER_STATE_FLUSH_MS", "50")),
+            flush_max_batch=int(os.environ.get("USER_STATE_FLUSH_BATCH", "256"))
+        )
+    if backend == "wal":
+        from wal_store import WalUserState
+        return WalUserState(data_file)
+    if backend == "sqlite":
+        from sqlite_store import SqliteUserState
+        return SqliteUserState(os.path.splitext(data_file)[0] + ".db", migrate_from=data_file)
+    if backend == "remote":
+        from state_service import RemoteUserState
+        return RemoteUserState()
+
+    raise ValueError(f"未知的用户状态后端: {backend}")
+
+
 # 全局用户状态实例
-USER_STATE = UserState()
+USER_STATE = create_user_state()
 
 
 # ==================== 工具函数 ====================
@@ -175,20 +480,20 @@ def find_parking(plate_number):
     查找车辆停车位置
 
     Args:
-        plate_number: 车牌号（如 "DXB-1234"）
+        plate_number: 车牌号（如 "DXB-1234"，大小写、空格、分隔符和酋长国写法不限）
 
     Returns:
         dict: 包含停车位信息或错误信息
     """
-    print(f"DEBUG: Tool [find_parking] called with plate_number='{plate_number}'")
+    debug(f"DEBUG: Tool [find_parking] called with plate_number='{plate_number}'")
 
-    if plate_number in PARKING:
-        parking_spot = PARKING[plate_number]
+    record = PARKING_INDEX.lookup(plate_number)
+    if record is not None:
         return {
             "success": True,
-            "plate_number": plate_number,
-            "parking_spot": parking_spot,
-            "message": f"您的车辆 {plate_number} 停放在 {parking_spot} 区域。"
+            "plate_number": record["plate"],
+            "parking_spot": record["spot"],
+            "message": f"您的车辆 {record['plate']} 停放在 {record['spot']} 区域。"
         }
     else:
         return {
@@ -198,6 +503,35 @@ def find_parking(plate_number):
         }
 
 
+def get_parking_occupancy(level=None):
+    """
+    查询停车场各层占用情况
+
+    Args:
+        level: 停车层（如 "B1"），为空时返回全部楼层
+
+    Returns:
+        dict: 各层已占用/总车位/空余车位
+    """
+    debug(f"DEBUG: Tool [get_parking_occupancy] called with level='{level}'")
+
+    summary = PARKING_INDEX.occupancy(level)
+    if not summary:
+        return {
+            "success": False,
+            "level": level,
+            "message": f"没有停车层 '{level}'。可选: {', '.join(PARKING_CAPACITY)}"
+        }
+
+    free = {lv: info["free"] for lv, info in summary.items() if info["free"] is not None}
+    best = max(free, key=free.get) if free else None
+    return {
+        "success": True,
+        "levels": summary,
+        "message": f"{best} 层空余车位最多（{free[best]} 个）。" if best else "暂无空余车位数据。"
+    }
+
+
 def get_shop_info(shop_name):
     """
     获取店铺信息
@@ -208,16 +542,20 @@ def get_shop_info(shop_name):
     Returns:
         dict: 包含店铺详细信息或错误信息
     """
-    print(f"DEBUG: Tool [get_shop_info] called with shop_name='{shop_name}'")
-
-    # 支持模糊匹配（不区分大小写）
-    for key, shop in SHOPS.items():
-        if shop_name.lower() in key.lower():
-            return {
-                "success": True,
-                "shop": shop,
-                "message": f"{shop['name']} 位于 {shop['location']}。{shop['description']}"
-            }
+    debug(f"DEBUG: Tool [get_shop_info] called with shop_name='{shop_name}'")
+
+    # 索引查询：忽略大小写与重音、容忍拼写错误，按相关度排序
+    matches = SHOP_INDEX.search(shop_name, k=3)
+    if matches:
+        shop = SHOPS[matches[0][0]]
+        result = {
+            "success": True,
+            "shop": shop,
+            "message": f"{shop['name']} 位于 {shop['location']}。{shop['description']}"
+        }
+        if len(matches) > 1:
+            result["other_matches"] = [SHOPS[key]["name"] for key, _ in matches[1:]]
+        return result
 
     return {
         "success": False,
@@ -226,6 +564,72 @@ def get_shop_info(shop_name):
     }
 
 
+def find_nearby(category=None, from_location=None, k=3, floor=None):
+    """
+    查找离指定位置最近的某类店铺/设施（也可列出某一楼层的全部店铺）
+
+    Args:
+        category: 类别描述，例如 "coffee"、"luxury"、"咖啡"；为空表示全部类别
+        from_location: 起点，例如 "Zone B"、"1st Floor"、"B2-A05"、"Zara"；为空表示正门
+        k: 返回数量
+        floor: 只看某一楼层，例如 "2nd Floor"
+
+    Returns:
+        dict: 按步行距离排序的店铺列表或错误信息
+    """
+    debug(f"DEBUG: Tool [find_nearby] called with category='{category}', from_location='{from_location}', k={k}, floor='{floor}'")
+
+    origin = MALL_MAP.resolve_location(from_location)
+    if origin is None:
+        return {
+            "success": False,
+            "from_location": from_location,
+            "message": f"无法识别位置 '{from_location}'。请提供楼层和区域（如 '1st Floor, Zone C'）、停车位或店铺名称。"
+        }
+
+    categories = MALL_MAP.match_categories(category)
+    if not categories:
+        return {
+            "success": False,
+            "category": category,
+            "message": f"没有 '{category}' 类别的店铺。可选类别: {', '.join(MALL_MAP.categories)}"
+        }
+
+    floor_code = None
+    if floor:
+        floor_code = parse_floor(floor)
+        if floor_code is None:
+            return {"success": False, "floor": floor, "message": f"无法识别楼层 '{floor}'。"}
+
+    k = max(1, min(int(k), 10))
+    results = []
+    for key, distance in MALL_MAP.nearby(origin, categories, k=k, floor=floor_code):
+        shop = SHOPS[key]
+        results.append({
+            "name": shop["name"],
+            "category": shop["category"],
+            "location": shop["location"],
+            "distance_m": round(distance),
+            "walk_minutes": max(1, round(distance / WALK_SPEED / 60)),
+            "directions": MALL_MAP.route(origin, MALL_MAP.node_of(key))
+        })
+
+    origin_name = f"{FLOOR_NAMES[origin[0]]}, Zone {origin[1]}"
+    if not results:
+        return {
+            "success": False,
+            "from": origin_name,
+            "message": "在指定范围内没有找到符合条件的店铺。"
+        }
+
+    return {
+        "success": True,
+        "from": origin_name,
+        "results": results,
+        "message": f"离 {origin_name} 最近的是 {results[0]['name']}（{results[0]['location']}），步行约 {results[0]['walk_minutes']} 分钟。"
+    }
+
+
 def add_points(user_id, amount, reason):
     """
     增加用户积分（用于打卡任务、游戏奖励等）
@@ -238,7 +642,7 @@ def add_points(user_id, amount, reason):
     Returns:
         dict: 包含当前总积分和操作信息
     """
-    print(f"DEBUG: Tool [add_points] called with user_id='{user_id}', amount={amount}, reason='{reason}'")
+    debug(f"DEBUG: Tool [add_points] called with user_id='{user_id}', amount={amount}, reason='{reason}'")
 
     total_points = USER_STATE.add_points(user_id, amount)
 
@@ -264,11 +668,13 @@ def redeem_coupon(user_id, coupon_type, points_cost):
     Returns:
         dict: 包含优惠券代码或错误信息
     """
-    print(f"DEBUG: Tool [redeem_coupon] called with user_id='{user_id}', coupon_type='{coupon_type}', points_cost={points_cost}")
+    debug(f"DEBUG: Tool [redeem_coupon] called with user_id='{user_id}', coupon_type='{coupon_type}', points_cost={points_cost}")
 
-    current_points = USER_STATE.get_points(user_id)
+    # 检查、扣分、发券在存储层一次原子完成，并发会话不会重复扣分
+    result = USER_STATE.redeem(user_id, coupon_type, points_cost)
 
-    if current_points < points_cost:
+    if not result["success"]:
+        current_points = result["current_points"]
         return {
             "success": False,
             "user_id": user_id,
@@ -277,23 +683,8 @@ def redeem_coupon(user_id, coupon_type, points_cost):
             "message": f"积分不足。您当前有 {current_points} 积分，需要 {points_cost} 积分才能兑换 {coupon_type}。"
         }
 
-    # 扣除积分
-    USER_STATE.deduct_points(user_id, points_cost)
-
-    # 生成优惠券代码
-    import random
-    import string
-    coupon_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-
-    # 添加到用户优惠券列表
-    coupon = {
-        "type": coupon_type,
-        "code": coupon_code,
-        "points_cost": points_cost
-    }
-    USER_STATE.add_coupon(user_id, coupon)
-
-    remaining_points = USER_STATE.get_points(user_id)
+    coupon_code = result["coupon"]["code"]
+    remaining_points = result["remaining_points"]
 
     return {
         "success": True,
@@ -311,7 +702,7 @@ def redeem_coupon(user_id, coupon_type, points_cost):
 TOOL_DEFINITIONS = [
     {
         "name": "find_parking",
-        "description": "查找用户车辆的停车位置。当用户询问 '我的车停在哪里' 或提供车牌号时调用此工具。支持迪拜常见车牌格式（如 DXB-1234）。",
+        "description": "查找用户车辆的停车位置。当用户询问 '我的车停在哪里' 或提供车牌号时调用此工具。支持迪拜常见车牌格式（如 DXB-1234），大小写、空格和分隔符不限，可直接传入用户原话中的车牌。",
         "input_schema": {
             "type": "object",
             "properties": {
@@ -323,20 +714,60 @@ TOOL_DEFINITIONS = [
             "required": ["plate_number"]
         }
     },
+    {
+        "name": "get_parking_occupancy",
+        "description": "查询停车场各层的已占用、总车位和空余车位数。当用户问 '哪层还有车位'、'停车场满了吗' 时调用。",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "level": {
+                    "type": "string",
+                    "description": "停车层，例如 'B1'、'B2'；不填返回全部楼层"
+                }
+            },
+            "required": []
+        }
+    },
     {
         "name": "get_shop_info",
-        "description": "获取商场内店铺的位置、楼层和详细信息。当用户询问某个品牌或店铺的位置时调用。支持模糊匹配店铺名称。",
+        "description": "获取商场内店铺的位置、楼层和详细信息。当用户询问某个品牌或店铺的位置时调用。支持模糊匹配店铺名称，也支持阿拉伯文和中文店名。",
         "input_schema": {
             "type": "object",
             "properties": {
                 "shop_name": {
                     "type": "string",
-                    "description": "店铺名称，例如 'Hermès'、'Apple Store'、'% Arabica' 等"
+                    "description": "店铺名称（可直接使用用户输入的写法，无需翻译），例如 'Hermès'、'هيرميس'、'爱马仕'、'Apple Store' 等"
                 }
             },
             "required": ["shop_name"]
         }
     },
+    {
+        "name": "find_nearby",
+        "description": "查找离用户当前位置最近的某类店铺或设施，或列出某一楼层的店铺。当用户问 '最近的咖啡馆在哪'、'2 楼有什么' 时调用，结果已按步行距离排序并附带路线。",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "category": {
+                    "type": "string",
+                    "description": "类别，例如 'coffee'、'luxury'、'fashion'、'electronics'、'prayer'、'咖啡'；不填表示全部类别"
+                },
+                "from_location": {
+                    "type": "string",
+                    "description": "用户当前位置，例如 'Zone B'、'1st Floor, Zone C'、停车位 'B2-A05' 或店铺名 'Zara'；不填默认正门"
+                },
+                "k": {
+                    "type": "integer",
+                    "description": "返回数量（1~10），默认 3"
+                },
+                "floor": {
+                    "type": "string",
+                    "description": "只查看某一楼层，例如 '2nd Floor'"
+                }
+            },
+            "required": []
+        }
+    },
     {
         "name": "add_points",
         "description": "为用户增加积分。当用户完成打卡任务、赢得互动游戏、参与商场活动时调用此工具。积分可用于后续兑换优惠券。",
@@ -403,6 +834,73 @@ def print_user_status(user_id):
         print(f"  - {coupon['type']}: {coupon['code']}")
 
 
+def stress_test_redeem(open_state, threads=16, rounds=50, initial_points=500, cost=7, bonus=3):
+    """
+    多线程并发兑换压力测试：验证积分不会丢失、也不会被重复扣除
+
+    一半线程反复兑换优惠券，另一半线程同时为同一用户加分；
+    结束后检查 余额 == 初始 + 加分总额 - 成功兑换次数 × cost，
+    且优惠券数量与成功兑换次数一致，重新打开存储后结果不变。
+
+    Args:
+        open_state: 无参函数，返回一个（新打开的）用户状态实例
+        threads: 并发线程数
+        rounds: 每个线程的操作次数
+
+    Returns:
+        dict: 测试统计
+    """
+    import io
+    import contextlib
+
+    user_id = "stress_user"
+    state = open_state()
+    successes = []
+    barrier = threading.Barrier(threads)
+
+    def redeemer():
+        barrier.wait()
+        for _ in range(rounds):
+            result = state.redeem(user_id, "压力测试券", cost)
+            if result["success"]:
+                assert result["remaining_points"] >= 0, "积分被扣成负数"
+                successes.append(result["coupon"]["code"])
+
+    def earner():
+        barrier.wait()
+        for _ in range(rounds):
+            state.add_points(user_id, bonus)
+
+    # 静默各后端的保存日志
+    with contextlib.redirect_stdout(io.StringIO()):
+        state.add_points(user_id, initial_points)
+        workers = [
+            threading.Thread(target=redeemer if i % 2 == 0 else earner)
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        earned = (threads // 2) * rounds * bonus
+        expected = initial_points + earned - len(successes) * cost
+
+        if hasattr(state, "close"):
+            state.close()
+        reopened = open_state()
+        points = reopened.get_points(user_id)
+        coupons = reopened.get_coupons(user_id)
+        if hasattr(reopened, "close"):
+            reopened.close()
+
+    assert points == expected, f"积分不一致: 实际 {points}，期望 {expected}"
+    assert len(coupons) == len(successes), f"优惠券数量不一致: {len(coupons)} != {len(successes)}"
+    assert len(set(successes)) == len(successes), "出现重复的优惠券代码"
+
+    return {"redeemed": len(successes), "final_points": points}
+
+
 # ==================== 测试代码 ====================
 
 if __name__ == "__main__":
@@ -431,4 +929,46 @@ if __name__ == "__main__":
     # 打印用户状态
     print_user_status("user_001")
 
+    # 并发兑换压力测试（各存储后端）
+    print("\n5. 并发兑换压力测试:")
+    import shutil
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ("json", "wal", "sqlite"):
+            data_file = os.path.join(tmp, f"{backend}_user_data.json")
+            stats = stress_test_redeem(lambda: create_user_state(backend, data_file))
+            print(f"   {backend}: 成功兑换 {stats['redeemed']} 次，最终积分 {stats['final_points']} ✅")
+
+        # 写文件失败：变更保留为待写，flush() / close() 抛出异常；恢复后重试成功
+        print("\n6. 写入失败处理:")
+        missing_dir = os.path.join(tmp, "missing")
+        for mode in ("sync", "group"):
+            state = UserState(os.path.join(missing_dir, f"{mode}.json"), commit_mode=mode, flush_interval_ms=10)
+            state.add_points("alice", 10)
+            try:
+                state.flush()
+            except OSError:
+                pass
+            else:
+                raise AssertionError("写入失败时 flush() 应抛出异常")
+            assert state._pending > 0, "写入失败的变更应保留为待写"
+            os.makedirs(missing_dir, exist_ok=True)
+            state.close()
+            assert state._pending == 0
+            assert UserState(state.data_file).get_points("alice") == 10
+            print(f"   {mode}: 目录恢复后 close() 写入成功 ✅")
+            shutil.rmtree(missing_dir)
+
+        # 数据文件损坏（例如写到一半被杀）：移到一旁保留，不被下一次写入覆盖
+        corrupt_path = os.path.join(tmp, "corrupt.json")
+        with open(corrupt_path, "w", encoding="utf-8") as f:
+            f.write('{"alice": {"points": 10, "coup')
+        state = UserState(corrupt_path)
+        assert state.users == {}
+        moved = [name for name in os.listdir(tmp) if name.startswith("corrupt.json.corrupt-")]
+        assert len(moved) == 1 and not os.path.exists(corrupt_path + ".tmp")
+        state.add_points("bob", 5)
+        assert UserState(corrupt_path).get_points("bob") == 5
+        print(f"   损坏的数据文件已移至 {moved[0]} ✅")
+
     print("\n所有测试完成！")
@@ -0,0 +1,450 @@
+"""
+迪拜商场互动服务 Agent - 停车索引
+车牌归一化（大小写、分隔符、酋长国前缀）+ O(1) 查询；从出入口闸机事件流（JSONL 文件或本地套接字）
+批量导入和实时更新，同时维护各停车层的占用统计
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import threading
+import socketserver
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# ==================== 车牌归一化 ====================
+
+# 酋长国前缀别名 → 统一代码
+EMIRATE_CODES = {
+    "DXB": "DXB", "DUBAI": "DXB", "دبي": "DXB",
+    "AD": "AUH", "AUH": "AUH", "ABUDHABI": "AUH", "ابوظبي": "AUH",
+    "SHJ": "SHJ", "SHARJAH": "SHJ", "الشارقه": "SHJ",
+    "AJM": "AJM", "AJMAN": "AJM", "عجمان": "AJM",
+    "RAK": "RAK", "راسالخيمه": "RAK",
+    "UAQ": "UAQ", "امالقيوين": "UAQ",
+    "FUJ": "FUJ", "FUJAIRAH": "FUJ", "الفجيره": "FUJ"
+}
+
+# 阿拉伯-印度数字 → ASCII 数字
+_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+_SEPARATORS = re.compile(r"[\s\-_./·|]+")
+
+
+def normalize_plate(plate: str) -> Tuple[Optional[str], str]:
+    """
+    归一化车牌
+
+    Returns:
+        (酋长国代码或 None, 号码部分)，例如
+        "dxb 1234" / "DXB1234" / "Dubai-1234" → ("DXB", "1234")，"1234" → (None, "1234")
+    """
+    text = plate.translate(_DIGITS).upper().replace("أ", "ا").replace("إ", "ا").replace("ة", "ه")
+    tokens = [t for t in _SEPARATORS.split(text) if t]
+    if not tokens:
+        return None, ""
+
+    # 以分隔符隔开的前缀（"ABU DHABI 1234"、"دبي ١٢٣٤"）
+    for n in (2, 1):
+        if len(tokens) > n and "".join(tokens[:n]) in EMIRATE_CODES:
+            return EMIRATE_CODES["".join(tokens[:n])], "".join(tokens[n:])
+
+    # 紧贴号码的前缀（"DXB1234"）：前缀之后必须是数字，避免把号码里的字母代码当作酋长国
+    compact = "".join(tokens)
+    match = re.match(r"([^\d]+)(\d.*)", compact)
+    if match and match.group(1) in EMIRATE_CODES:
+        return EMIRATE_CODES[match.group(1)], match.group(2)
+    return None, compact
+
+
+def plate_key(plate: str) -> str:
+    """车牌的规范形式，例如 "DXB-1234"（无酋长国前缀时只有号码）"""
+    emirate, number = normalize_plate(plate)
+    return f"{emirate}-{number}" if emirate else number
+
+
+def spot_level(spot: str) -> str:
+    """车位所在停车层，例如 "B2-A05" → "B2" """
+    return spot.split("-", 1)[0].upper()
+
+
+# ==================== 停车索引 ====================
+
+class ParkingIndex:
+    """
+    停车索引（线程安全）
+
+    - 规范车牌 → 车位：O(1) 查询
+    - 号码 → 规范车牌集合：用户只说号码（"1234"）时，号码唯一即可命中
+    - 车位 → 规范车牌：同一车位被新车占用时清除旧记录
+    - 各停车层已占用车位数：随事件增量维护
+
+    闸机事件为 JSON 对象：
+        {"type": "entry", "plate": "DXB 1234", "spot": "B2-A05", "ts": 1700000000}
+        {"type": "exit",  "plate": "DXB-1234"}
+    """
+
+    def __init__(self, capacity: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            capacity: 各停车层总车位数，例如 {"B1": 1200, "B2": 1500}
+        """
+        self.capacity = dict(capacity or {})
+        self._spots: Dict[str, str] = {}
+        self._plates: Dict[str, str] = {}
+        self._by_number: Dict[str, set] = defaultdict(set)
+        self._occupants: Dict[str, str] = {}
+        self._occupied: Dict[str, int] = defaultdict(int)
+        self._subscribers: List[Callable[[Dict[str, Any]], None]] = []
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._servers: List[socketserver.BaseServer] = []
+        self.events_applied = 0
+
+    def __len__(self):
+        return len(self._spots)
+
+    # ---------- 订阅 ----------
+
+    def subscribe(self, callback: Callable[[Dict[str, Any]], None]):
+        """订阅车位变更（每条生效的事件调用一次，例如用于使缓存失效）"""
+        self._subscribers.append(callback)
+
+    def _notify(self, events: List[Dict[str, Any]]):
+        for callback in list(self._subscribers):
+            for event in events:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"⚠️ 停车事件订阅回调失败: {e}")
+
+    # ---------- 写入 ----------
+
+    def _park_locked(self, key: str, plate: str, spot: str) -> Optional[str]:
+        """登记停车；返回被挤出该车位的旧车牌（没有时为 None）"""
+        self._leave_locked(key)
+
+        evicted = None
+        previous = self._occupants.get(spot)
+        if previous is not None:
+            # 车位已被记录为另一辆车（漏掉了它的出场事件）：以新事件为准
+            evicted = self._plates[previous]
+            self._leave_locked(previous)
+
+        self._spots[key] = spot
+        self._plates[key] = plate
+        self._by_number[normalize_plate(key)[1]].add(key)
+        self._occupants[spot] = key
+        self._occupied[spot_level(spot)] += 1
+        return evicted
+
+    def _leave_locked(self, key: str) -> bool:
+        spot = self._spots.pop(key, None)
+        if spot is None:
+            return False
+
+        self._plates.pop(key, None)
+        number = normalize_plate(key)[1]
+        self._by_number[number].discard(key)
+        if not self._by_number[number]:
+            del self._by_number[number]
+        if self._occupants.get(spot) == key:
+            del self._occupants[spot]
+        self._occupied[spot_level(spot)] -= 1
+        return True
+
+    def _apply_locked(self, event: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        应用一条事件，返回要通知订阅者的事件（未生效时为空）
+
+        新车停入已记录为另一辆车的车位时，先附上旧车的出场事件，订阅者据此使旧车的缓存失效
+        """
+        plate = str(event.get("plate", "")).strip()
+        if not plate:
+            return []
+
+        key = plate_key(plate)
+        if event.get("type") == "entry" and event.get("spot"):
+            evicted = self._park_locked(key, plate, str(event["spot"]).upper())
+            if evicted is not None:
+                return [{"type": "exit", "plate": evicted}, event]
+            return [event]
+        if event.get("type") == "exit" and self._leave_locked(key):
+            return [event]
+        return []
+
+    def park(self, plate: str, spot: str):
+        """登记车辆停入车位（等价于一条 entry 事件）"""
+        self.apply_events([{"type": "entry", "plate": plate, "spot": spot}])
+
+    def leave(self, plate: str):
+        """登记车辆离场（等价于一条 exit 事件）"""
+        self.apply_events([{"type": "exit", "plate": plate}])
+
+    def apply_events(self, events: Iterable[Dict[str, Any]]) -> int:
+        """
+        批量应用闸机事件（整批只加一次锁）
+
+        Returns:
+            int: 生效的事件数
+        """
+        applied = 0
+        notifications: List[Dict[str, Any]] = []
+        with self._lock:
+            for event in events:
+                changes = self._apply_locked(event)
+                if changes:
+                    applied += 1
+                    notifications.extend(changes)
+            self.events_applied += applied
+
+        if notifications and self._subscribers:
+            self._notify(notifications)
+        return applied
+
+    # ---------- 查询 ----------
+
+    def lookup(self, plate: str) -> Optional[Dict[str, str]]:
+        """
+        按车牌查找车位（O(1)）
+
+        先按完整规范车牌查找；用户没说酋长国时按号码查找，号码唯一时命中。
+
+        Returns:
+            dict: {"plate": 登记的车牌, "spot": 车位}；未找到或号码有歧义时返回 None
+        """
+        emirate, number = normalize_plate(plate)
+        with self._lock:
+            key = f"{emirate}-{number}" if emirate else number
+            if key not in self._spots:
+                if emirate:
+                    return None
+                keys = self._by_number.get(number, ())
+                if len(keys) != 1:
+                    return None
+                key = next(iter(keys))
+            return {"plate": self._plates[key], "spot": self._spots[key]}
+
+    def occupancy(self, level: Optional[str] = None) -> Dict[str, Dict[str, Optional[int]]]:
+        """
+        各停车层占用统计
+
+        Returns:
+            dict: {层: {"occupied": n, "capacity": n 或 None, "free": n 或 None}}
+        """
+        with self._lock:
+            levels = sorted(set(self.capacity) | {lv for lv, n in self._occupied.items() if n})
+            if level is not None:
+                levels = [lv for lv in levels if lv == level.upper()]
+
+            summary = {}
+            for lv in levels:
+                occupied = self._occupied.get(lv, 0)
+                capacity = self.capacity.get(lv)
+                summary[lv] = {
+                    "occupied": occupied,
+                    "capacity": capacity,
+                    "free": max(capacity - occupied, 0) if capacity is not None else None
+                }
+            return summary
+
+    # ---------- 事件导入 ----------
+
+    def ingest_jsonl(self, path: str, batch_size: int = 1000) -> int:
+        """
+        从 JSONL 文件批量导入闸机事件
+
+        Returns:
+            int: 生效的事件数
+        """
+        total = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            batch = []
+            for line in f:
+                event = self._parse(line)
+                if event is not None:
+                    batch.append(event)
+                if len(batch) >= batch_size:
+                    total += self.apply_events(batch)
+                    batch = []
+            total += self.apply_events(batch)
+        return total
+
+    @staticmethod
+    def _parse(line: str) -> Optional[Dict[str, Any]]:
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            event = json.loads(line)
+        except ValueError:
+            print(f"⚠️ 忽略无法解析的停车事件: {line[:80]}")
+            return None
+        return event if isinstance(event, dict) else None
+
+    def follow_jsonl(self, path: str, poll_interval: float = 0.5, batch_size: int = 1000):
+        """
+        后台线程持续跟踪 JSONL 事件文件（先回放已有内容，再读取新追加的行）
+
+        文件被截断或轮转时从头重新读取。
+        """
+        def run():
+            position = 0
+            pending = ""
+            while not self._stop.is_set():
+                try:
+                    if os.path.getsize(path) < position:
+                        position, pending = 0, ""
+                    with open(path, 'r', encoding='utf-8') as f:
+                        f.seek(position)
+                        chunk = f.read()
+                        position = f.tell()
+                except FileNotFoundError:
+                    chunk = ""
+
+                if chunk:
+                    lines = (pending + chunk).split("\n")
+                    pending = lines.pop()  # 可能是写了一半的行
+                    events = [e for e in map(self._parse, lines) if e is not None]
+                    for i in range(0, len(events), batch_size):
+                        self.apply_events(events[i:i + batch_size])
+                else:
+                    self._stop.wait(poll_interval)
+
+        self._start_thread(run, f"parking-follow-{os.path.basename(path)}")
+
+    def serve_socket(self, address: str):
+        """
+        在本地 Unix 套接字上接收闸机事件（每行一个 JSON 对象）
+
+        每个连接一个线程；同一次读取到的多行按批应用。
+        """
+        index = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                pending = b""
+                while True:
+                    chunk = self.request.recv(65536)
+                    if not chunk:
+                        break
+                    # 一次 recv 收到的完整行作为一批提交
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()
+                    events = [index._parse(line.decode("utf-8", errors="replace")) for line in lines]
+                    index.apply_events(e for e in events if e is not None)
+                event = index._parse(pending.decode("utf-8", errors="replace"))
+                if event is not None:
+                    index.apply_events([event])
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if not hasattr(socket, "AF_UNIX"):
+            raise RuntimeError("当前平台不支持 Unix 套接字，请改用 follow_jsonl()")
+        if os.path.exists(address):
+            os.remove(address)
+
+        server = Server(address, Handler)
+        self._servers.append(server)
+        self._start_thread(server.serve_forever, "parking-socket")
+
+    def _start_thread(self, target: Callable[[], None], name: str):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def close(self):
+        """停止所有后台导入线程"""
+        self._stop.set()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._servers.clear()
+        self._threads.clear()
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+
+    print("停车索引测试\n")
+
+    for plate in ["DXB-1234", "dxb 1234", "DXB1234", "Dubai 1234", "AD-9999", "AUH 9999", "دبي ١٢٣٤", "1234"]:
+        print(f"   {plate!r:14} → {normalize_plate(plate)}")
+
+    index = ParkingIndex(capacity={"B1": 6000, "B2": 6000})
+    index.park("DXB-1234", "B2-A05")
+    index.park("AD-9999", "B2-D08")
+    for plate in ["dxb 1234", "DXB1234", "1234", "auh-9999", "9999", "SHJ 1234"]:
+        print(f"   lookup({plate!r}) → {index.lookup(plate)}")
+    assert index.lookup("dxb 1234")["spot"] == "B2-A05"
+    assert index.lookup("1234")["spot"] == "B2-A05"
+    assert index.lookup("SHJ 1234") is None
+
+    # 同一车位被新车占用
+    index.park("SHJ-4321", "B2-A05")
+    assert index.lookup("DXB-1234") is None
+    assert index.occupancy("B2")["B2"]["occupied"] == 2
+
+    changes = []
+    index.subscribe(changes.append)
+
+    # 被挤出车位的旧车也通知订阅者（否则它的车位查询缓存不会失效）
+    index.park("RAK-5", "B2-A05")
+    assert [(e["type"], e["plate"]) for e in changes] == [("exit", "SHJ-4321"), ("entry", "RAK-5")]
+    assert index.events_applied == 4
+    changes.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 批量导入 5 万条事件
+        events_file = os.path.join(tmp, "gate_events.jsonl")
+        with open(events_file, 'w', encoding='utf-8') as f:
+            for i in range(50000):
+                level = random.choice(["B1", "B2"])
+                spot = f"{level}-{random.choice('ABCDEF')}{i % 1000:03d}"
+                f.write(json.dumps({"type": "entry", "plate": f"DXB {10000 + i}", "spot": spot}) + "\n")
+                if i % 3 == 0:
+                    f.write(json.dumps({"type": "exit", "plate": f"DXB-{10000 + i}"}) + "\n")
+
+        start = time.perf_counter()
+        applied = index.ingest_jsonl(events_file)
+        print(f"\n   导入 {applied} 条事件: {time.perf_counter() - start:.2f} s，在场车辆 {len(index)}")
+        print(f"   占用统计: {index.occupancy()}")
+        assert sum(level["occupied"] for level in index.occupancy().values()) == len(index)
+
+        start = time.perf_counter()
+        for i in range(10000):
+            index.lookup(f"dxb{10000 + i}")
+        print(f"   单次查询: {(time.perf_counter() - start) / 10000 * 1e6:.1f} µs")
+
+        # 跟踪追加写入的事件文件
+        live_file = os.path.join(tmp, "live.jsonl")
+        open(live_file, 'w').close()
+        index.follow_jsonl(live_file, poll_interval=0.05)
+        with open(live_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({"type": "entry", "plate": "RAK 777", "spot": "B1-C01"}) + "\n")
+        time.sleep(0.3)
+        assert index.lookup("rak777")["spot"] == "B1-C01"
+
+        # Unix 套接字
+        sock_path = os.path.join(tmp, "gate.sock")
+        index.serve_socket(sock_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(sock_path)
+            client.sendall(b'{"type": "entry", "plate": "AJM 55", "spot": "B1-D02"}\n')
+            time.sleep(0.3)
+            # 连接保持打开时事件也应立即生效
+            assert index.lookup("AJM-55")["spot"] == "B1-D02"
+            assert changes[-1]["plate"] == "AJM 55"
+
+        index.close()
+
+    print("\n所有测试完成！")
@@ -0,0 +1,488 @@
+"""
+迪拜商场互动服务 Agent - 上游调用容错
+DeepSeek 请求的单次/总体超时、带抖动的指数退避重试、对冲请求（超过 p95 延迟仍未返回时再发一次）
+以及熔断器（上游持续失败时快速失败，而不是让每个访客都等到超时）
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+
+# ==================== 默认配置 ====================
+
+# 单次请求超时（流式请求为等到响应头的时间，以及相邻两个片段之间的最长间隔）
+DEFAULT_ATTEMPT_TIMEOUT = float(os.environ.get("LLM_ATTEMPT_TIMEOUT", "30"))
+# 一次调用（含全部重试与对冲）的总体超时
+DEFAULT_DEADLINE = float(os.environ.get("LLM_DEADLINE", "60"))
+DEFAULT_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+DEFAULT_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.25"))
+DEFAULT_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", "4"))
+
+# 对冲请求：默认关闭（会增加上游请求数）；延迟为空时使用近期成功请求的 p95
+DEFAULT_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+DEFAULT_HEDGE_DELAY = float(os.environ["LLM_HEDGE_DELAY"]) if os.environ.get("LLM_HEDGE_DELAY") else None
+# 样本不足时的对冲延迟
+FALLBACK_HEDGE_DELAY = 2.0
+MIN_LATENCY_SAMPLES = 20
+
+# 熔断：连续失败次数达到阈值后打开，reset_timeout 秒后放行一个探测请求
+DEFAULT_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+DEFAULT_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+
+# 可重试的 HTTP 状态码
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+# ==================== 异常 ====================
+
+class UpstreamError(Exception):
+    """上游（LLM 服务）暂时不可用"""
+
+
+class CircuitOpenError(UpstreamError):
+    """熔断器已打开，请求被直接拒绝"""
+
+
+class DeadlineExceeded(UpstreamError):
+    """超过总体超时仍未得到响应"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """超时、连接错误、限流和 5xx 可重试；其余 4xx（如 API Key 无效、请求格式错误）不重试"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS
+    return False
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """从 429/503 响应的 Retry-After 头读取建议的等待秒数"""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+# ==================== 延迟统计 ====================
+
+class LatencyTracker:
+    """最近若干次成功请求的延迟（线程安全），用于估算对冲延迟"""
+
+    def __init__(self, window: int = 256):
+        self._samples: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """第 q 分位（0~1）；样本不足 MIN_LATENCY_SAMPLES 时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+# ==================== 熔断器 ====================
+
+class CircuitBreaker:
+    """
+    熔断器（线程安全）
+
+    closed    - 正常放行，记录连续失败次数
+    open      - 连续失败达到 failure_threshold 后打开，reset_timeout 内的请求直接失败
+    half_open - 超时后放行一个探测请求：成功则关闭，失败则重新打开
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_BREAKER_FAILURES,
+        reset_timeout: float = DEFAULT_BREAKER_RESET
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """请求前检查；熔断中抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            remaining = max(self.reset_timeout - (time.monotonic() - self._opened_at), 0)
+        raise CircuitOpenError(f"上游服务暂时不可用（熔断中，约 {remaining:.0f} 秒后重试）")
+
+    def available(self) -> bool:
+        """当前是否会放行请求（关闭，或已到探测时间）；不改变状态"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return not self._probing
+
+    def release_probe(self):
+        """探测请求被调用方取消（结果未知）：允许下一个请求继续探测"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"⚡ 熔断器打开：连续失败 {self.failures} 次")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+# ==================== 容错调用 ====================
+
+class ResilientCaller:
+    """
+    上游调用的容错封装
+
+    call(factory) 中 factory 每次调用都发起一次新请求（重试与对冲各调用一次）：
+    - 每次尝试受 attempt_timeout 限制，全部尝试受 deadline 限制
+    - 可重试错误按 "full jitter" 指数退避重试，最多 max_retries 次（优先遵守 Retry-After）
+    - hedge 打开时，一次尝试超过对冲延迟仍未返回则再发一个相同请求，取先成功的一个，另一个取消
+    - 每个上游（key，例如 base_url）一个熔断器；不可重试的错误（4xx）说明上游在正常响应，不计为失败
+    """
+
+    def __init__(
+        self,
+        attempt_timeout: float = DEFAULT_ATTEMPT_TIMEOUT,
+        deadline: float = DEFAULT_DEADLINE,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+        max_delay: float = DEFAULT_RETRY_MAX_DELAY,
+        hedge: bool = DEFAULT_HEDGE,
+        hedge_delay: Optional[float] = DEFAULT_HEDGE_DELAY,
+        breaker_failures: int = DEFAULT_BREAKER_FAILURES,
+        breaker_reset: float = DEFAULT_BREAKER_RESET
+    ):
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.latency = LatencyTracker()
+        self._breakers: Dict[Any, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "failures": 0,
+            "rejected": 0,
+            "deadline_exceeded": 0
+        }
+
+    def breaker(self, key: Any = None) -> CircuitBreaker:
+        """获取某个上游的熔断器"""
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+                self._breakers[key] = breaker
+            return breaker
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.stats[name] += n
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """第 attempt 次重试前的等待时间（full jitter；有 Retry-After 时以其为准）"""
+        suggested = retry_after(error) if error is not None else None
+        if suggested is not None:
+            return min(suggested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def current_hedge_delay(self) -> float:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        p95 = self.latency.percentile(0.95)
+        return p95 if p95 is not None else FALLBACK_HEDGE_DELAY
+
+    async def call(self, factory: Callable[[], Awaitable[T]], key: Any = None) -> T:
+        """
+        带重试、对冲、超时与熔断地执行一次上游调用
+
+        Raises:
+            CircuitOpenError: 熔断中
+            DeadlineExceeded: 超过总体超时
+            UpstreamError: 重试次数用尽（__cause__ 为最后一个错误）
+            其他异常: 不可重试的错误（如 API Key 无效）原样抛出
+        """
+        loop = asyncio.get_running_loop()
+        breaker = self.breaker(key)
+        deadline = loop.time() + self.deadline
+        self._count("calls")
+
+        attempt = 0
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                self._count("rejected")
+                raise
+
+            remaining = deadline - loop.time()
+            started = loop.time()
+            self._count("attempts")
+            try:
+                result = await self._attempt(factory, min(self.attempt_timeout, remaining))
+            except asyncio.CancelledError:
+                # 调用方取消（访客断开）不是上游的问题：只释放探测名额
+                breaker.release_probe()
+                raise
+            except Exception as error:
+                if not is_retryable(error):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                self._count("failures")
+
+                delay = self.backoff(attempt, error)
+                out_of_time = loop.time() + delay >= deadline
+                if attempt >= self.max_retries or out_of_time:
+                    if out_of_time:
+                        self._count("deadline_exceeded")
+                        raise DeadlineExceeded(
+                            f"上游服务在 {self.deadline:g} 秒内未能响应（共尝试 {attempt + 1} 次）"
+                        ) from error
+                    raise UpstreamError(
+                        f"上游服务暂时不可用（{type(error).__name__}，共尝试 {attempt + 1} 次）"
+                    ) from error
+
+                attempt += 1
+                self._count("retries")
+                print(f"🔁 上游请求失败（{type(error).__name__}），{delay:.2f} 秒后第 {attempt} 次重试")
+                await asyncio.sleep(delay)
+                continue
+
+            breaker.record_success()
+            self.latency.record(loop.time() - started)
+            return result
+
+    async def _attempt(self, factory: Callable[[], Awaitable[T]], timeout: float) -> T:
+        """一次尝试（可能包含一个对冲请求）"""
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        if not self.hedge:
+            return await asyncio.wait_for(factory(), timeout)
+
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        primary = asyncio.ensure_future(factory())
+        pending = {primary}
+        hedged = False
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                now = loop.time()
+                if now >= end:
+                    raise asyncio.TimeoutError()
+                wait = end - now
+                if not hedged:
+                    wait = min(wait, self.current_hedge_delay())
+
+                done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count("hedge_wins")
+                        for other in done - {task}:
+                            _discard(other)
+                        return task.result()
+                    error = task.exception()
+
+                if not done and not hedged and loop.time() < end:
+                    hedged = True
+                    self._count("hedges")
+                    pending.add(asyncio.ensure_future(factory()))
+            raise error
+        finally:
+            for task in pending:
+                _discard(task)
+
+    async def guard_stream(self, stream: Any) -> AsyncIterator[Any]:
+        """
+        迭代流式响应：相邻片段间隔超过 attempt_timeout、或整个流超过 deadline 时关闭流并抛出
+        DeadlineExceeded（已输出的内容无法撤回，因此流中途的错误不重试）
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        iterator = stream.__aiter__()
+        try:
+            while True:
+                timeout = min(self.attempt_timeout, deadline - loop.time())
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), max(timeout, 0))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    self._count("deadline_exceeded")
+                    raise DeadlineExceeded("上游流式响应中断（长时间没有新内容）") from None
+                yield chunk
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                await close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """调用统计与各上游的熔断器状态"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["breakers"] = {str(key): breaker.state for key, breaker in self._breakers.items()}
+        p95 = self.latency.percentile(0.95)
+        stats["p95_seconds"] = round(p95, 4) if p95 is not None else None
+        return stats
+
+
+def _discard(task: "asyncio.Future[Any]"):
+    """放弃一个对冲请求：未完成则取消，已成功则关闭其响应（例如流式连接）"""
+    if not task.done():
+        task.cancel()
+        return
+    if task.cancelled() or task.exception() is not None:
+        return
+    close = getattr(task.result(), "close", None)
+    if close is not None:
+        result = close()
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    from openai import AsyncOpenAI
+    from stub_server import StubLLMServer, FaultInjector
+
+    print("上游调用容错测试（本地故障注入桩服务器）\n")
+
+    async def main():
+        messages = [{"role": "user", "content": "ping"}]
+
+        # 1. 503 与连接断开后重试成功
+        faults = FaultInjector(script=[{"error": 503}, {"drop": True}])
+        with StubLLMServer(faults=faults) as server:
+            client = AsyncOpenAI(api_key="k", base_url=server.base_url, max_retries=0)
+            caller = ResilientCaller(base_delay=0.01)
+            reply = await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            print(f"   重试后成功: {reply.choices[0].message.content!r}  {caller.snapshot()}")
+            assert caller.stats["retries"] == 2
+
+            # 2. 400 不重试
+            faults.script.append({"error": 400})
+            try:
+                await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            except openai.BadRequestError:
+                print("   400 直接失败，未重试")
+            else:
+                raise AssertionError("400 不应成功")
+            assert caller.stats["retries"] == 2
+            await client.close()
+
+        # 3. 对冲：首个请求卡住，对冲请求先返回
+        faults = FaultInjector(script=[{"delay": 1.0}])
+        with StubLLMServer(faults=faults) as server:
+            client = AsyncOpenAI(api_key="k", base_url=server.base_url, max_retries=0)
+            caller = ResilientCaller(hedge=True, hedge_delay=0.1)
+            start = time.perf_counter()
+            await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            elapsed = time.perf_counter() - start
+            print(f"   对冲请求: {elapsed * 1000:.0f} ms  hedges={caller.stats['hedges']} wins={caller.stats['hedge_wins']}")
+            assert elapsed < 0.8 and caller.stats["hedge_wins"] == 1
+            await client.close()
+
+        # 4. 总体超时
+        faults = FaultInjector(delay_rate=1.0, delay=2.0)
+        with StubLLMServer(faults=faults) as server:
+            client = AsyncOpenAI(api_key="k", base_url=server.base_url, max_retries=0)
+            caller = ResilientCaller(attempt_timeout=0.2, deadline=0.5, base_delay=0.01)
+            start = time.perf_counter()
+            try:
+                await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            except DeadlineExceeded as e:
+                print(f"   总体超时: {time.perf_counter() - start:.2f} s  {e}")
+            assert time.perf_counter() - start < 0.8
+            await client.close()
+
+        # 5. 熔断：持续 503 → 打开后快速失败 → 恢复后探测成功
+        faults = FaultInjector(error_rate=1.0, error_status=503)
+        with StubLLMServer(faults=faults) as server:
+            client = AsyncOpenAI(api_key="k", base_url=server.base_url, max_retries=0)
+            caller = ResilientCaller(max_retries=0, breaker_failures=3, breaker_reset=0.3)
+            for _ in range(3):
+                try:
+                    await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+                except UpstreamError:
+                    pass
+            start = time.perf_counter()
+            try:
+                await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            except CircuitOpenError as e:
+                print(f"   熔断快速失败: {(time.perf_counter() - start) * 1000:.2f} ms  {e}")
+            assert server.fault_count == 3
+
+            faults.error_rate = 0.0
+            await asyncio.sleep(0.35)
+            await caller.call(lambda: client.chat.completions.create(model="m", messages=messages))
+            print(f"   探测成功后熔断器: {caller.breaker().state}")
+            assert caller.breaker().state == "closed"
+            await client.close()
+
+        # 6. 流式响应中途停顿
+        faults = FaultInjector(script=[{"stall": 1.0}])
+        with StubLLMServer(faults=faults) as server:
+            client = AsyncOpenAI(api_key="k", base_url=server.base_url, max_retries=0)
+            caller = ResilientCaller(attempt_timeout=0.2)
+            stream = await caller.call(lambda: client.chat.completions.create(
+                model="m", messages=messages, stream=True))
+            try:
+                async for _ in caller.guard_stream(stream):
+                    pass
+            except DeadlineExceeded as e:
+                print(f"   流式停顿: {e}")
+            await client.close()
+
+    asyncio.run(main())
+    print("\n所有测试完成！")
@@ -0,0 +1,281 @@
+"""
+迪拜商场互动服务 Agent - 回复缓存
+常见问题（"Where is Hermès?"、"祈祷室在哪"）直接返回缓存的回复，跳过 LLM 与工具循环：
+先按归一化文本精确匹配，再按字符三元组相似度匹配；带 TTL 和 LRU 淘汰，并统计命中率
+"""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+from shop_index import normalize, trigrams
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "300"))
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+# 相似度阈值（0 表示只做精确匹配）
+DEFAULT_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.9"))
+
+# 不影响问题含义的客套词和虚词（相似度比较前去掉）；疑问词和意图词不在其中，
+# 否则 "What is in Zara?" 与 "How do I get to Zara?" 去掉后都只剩 "zara"
+STOPWORDS = {
+    "is", "are", "the", "a", "an", "s", "please", "can", "could", "you", "i", "of",
+    "hi", "hello", "hey", "marhaba", "请问", "من", "فضلك", "لو"
+}
+
+# 疑问词/意图词 → 意图类别：相似层只在意图类别相同的问题之间匹配
+INTENT_WORDS = {
+    "where": "where", "find": "where", "located": "where", "在哪": "where", "在哪里": "where",
+    "哪里": "where", "أين": "where", "اين": "where",
+    "how": "how", "get": "how", "directions": "how", "怎么走": "how", "怎么": "how", "كيف": "how",
+    "what": "what", "tell": "what", "about": "what", "什么": "what", "ما": "what", "ماذا": "what",
+    "when": "when", "open": "when", "close": "when", "hours": "when", "几点": "when", "متى": "when",
+}
+
+_DIGITS = re.compile(r"\d+")
+
+
+# ==================== 查询归一化 ====================
+
+def normalize_query(text: str) -> str:
+    """精确匹配用的归一化：忽略大小写、重音、标点和多余空白"""
+    return normalize(text)
+
+
+def keyword_text(normalized: str) -> str:
+    """相似度比较用的文本：去掉常见词后的关键词"""
+    words = [w for w in normalized.split() if w not in STOPWORDS]
+    return " ".join(words) or normalized
+
+
+def intent_class(normalized: str) -> Tuple[str, ...]:
+    """问题中出现的意图类别（排序后的元组，没有意图词时为空）"""
+    return tuple(sorted({INTENT_WORDS[w] for w in normalized.split() if w in INTENT_WORDS}))
+
+
+def dice(a: Set[str], b: Set[str]) -> float:
+    """Dice 相似度 2|A∩B| / (|A|+|B|)"""
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+# ==================== 回复缓存 ====================
+
+class ResponseCache:
+    """
+    回复缓存（线程安全）
+
+    - 精确层：(命名空间, 归一化问题) → 回复，O(1)
+    - 相似层：按 (命名空间, 问题中的数字, 意图类别) 分区的关键词三元组倒排索引召回候选，
+      Dice 相似度 ≥ similarity 时命中（数字不同的问题，如 "DXB-1234" 与 "DXB-1235"，
+      或意图不同的问题，如 "What is Zara?" 与 "How do I get to Zara?"，绝不会互相命中）
+    命名空间由调用方给出（例如模型名 + 会话上下文），不同命名空间互不命中。
+    条目超过 ttl 秒过期，超过 max_entries 条时淘汰最久未使用的条目。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL,
+        similarity: float = DEFAULT_SIMILARITY
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries: "OrderedDict[Tuple[Hashable, str], Dict[str, Any]]" = OrderedDict()
+        self._grams: Dict[Tuple[Hashable, str], Set[Tuple[Hashable, str]]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self.stats = {
+            "exact_hits": 0,
+            "similar_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "skipped": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ---------- 查询 ----------
+
+    def get(self, question: str, namespace: Hashable = None) -> Optional[str]:
+        """
+        查找缓存的回复
+
+        Returns:
+            str: 命中时返回回复文本，否则 None
+        """
+        if not self.enabled:
+            return None
+
+        normalized = normalize_query(question)
+        key = (namespace, normalized)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._live_entry(key, now)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return entry["reply"]
+
+            if self.similarity > 0:
+                match = self._similar_locked(namespace, normalized, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.stats["similar_hits"] += 1
+                    return self._entries[match]["reply"]
+
+            self.stats["misses"] += 1
+            return None
+
+    def _live_entry(self, key, now: float) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] <= now:
+            self._remove_locked(key)
+            self.stats["expirations"] += 1
+            return None
+        return entry
+
+    def _similar_locked(self, namespace: Hashable, normalized: str, now: float):
+        grams = trigrams(keyword_text(normalized))
+        partition = (namespace, tuple(_DIGITS.findall(normalized)), intent_class(normalized))
+
+        candidates: Set[Tuple[Hashable, str]] = set()
+        for gram in grams:
+            candidates |= self._grams.get((partition, gram), set())
+
+        best, best_score = None, self.similarity
+        for key in candidates:
+            entry = self._live_entry(key, now)
+            if entry is None:
+                continue
+            score = dice(grams, entry["grams"])
+            if score >= best_score:
+                best, best_score = key, score
+        return best
+
+    # ---------- 写入 ----------
+
+    def put(self, question: str, reply: str, namespace: Hashable = None, ttl: Optional[float] = None):
+        """缓存一条回复（ttl 为空时使用默认 TTL）"""
+        if not self.enabled or not reply:
+            return
+
+        normalized = normalize_query(question)
+        key = (namespace, normalized)
+        grams = trigrams(keyword_text(normalized))
+        partition = (namespace, tuple(_DIGITS.findall(normalized)), intent_class(normalized))
+
+        with self._lock:
+            self._remove_locked(key)
+            self._entries[key] = {
+                "reply": reply,
+                "expires_at": time.monotonic() + (self.ttl if ttl is None else ttl),
+                "grams": grams,
+                "partition": partition
+            }
+            for gram in grams:
+                self._grams[(partition, gram)].add(key)
+            self.stats["stores"] += 1
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove_locked(oldest)
+                self.stats["evictions"] += 1
+
+    def skip(self):
+        """记录一次不可缓存的轮次（用于统计）"""
+        with self._lock:
+            self.stats["skipped"] += 1
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        partition = entry["partition"]
+        for gram in entry["grams"]:
+            keys = self._grams.get((partition, gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[(partition, gram)]
+
+    def clear(self):
+        """清空缓存（例如店铺信息更新后）"""
+        with self._lock:
+            self._entries.clear()
+            self._grams.clear()
+
+    # ---------- 统计 ----------
+
+    def snapshot(self) -> Dict[str, Any]:
+        """命中率等统计"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["similar_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    print("回复缓存测试\n")
+
+    cache = ResponseCache(max_entries=3, ttl=0.5, similarity=0.9)
+    cache.put("Where is Hermès?", "Hermès is on the Ground Floor, Zone A.")
+    cache.put("Where is my car? DXB-1234", "Your car is at B2-A05.")
+
+    for question in ["where is hermes", "WHERE IS HERMÈS!!", "Where's Hermès?", "hermes please",
+                     "Where is Chanel?", "Where is my car? DXB-1235", "where is my car dxb 1234"]:
+        print(f"   {question!r:28} → {cache.get(question)!r}")
+
+    assert cache.get("where is hermes") is not None
+    assert cache.get("Where is Chanel?") is None
+    assert cache.get("Where is my car? DXB-1235") is None
+    assert cache.get("hermes", namespace="other-model") is None
+
+    # 意图不同的问题即使店铺名相同也不互相命中
+    cache.put("How do I get to Zara?", "Zara is on Level 1; take the escalator near Gate 3.")
+    assert cache.get("how do i get to zara") is not None
+    for question in ["What is in Zara?", "Tell me what Zara is", "what to do in zara", "Zara", "When does Zara open?"]:
+        assert cache.get(question) is None, question
+
+    # LRU
+    cache.put("q1", "a1")
+    cache.put("q2", "a2")
+    assert cache.get("Where is my car? DXB-1234") is None, "最久未使用的条目应被淘汰"
+
+    # TTL
+    time.sleep(0.6)
+    assert cache.get("q1") is None
+
+    print(f"\n   统计: {cache.snapshot()}")
+
+    # 1 万条缓存时的查询耗时
+    big = ResponseCache(max_entries=20000, ttl=60)
+    for i in range(10000):
+        big.put(f"where is shop {i} please", f"answer {i}")
+    for i in range(2000):
+        big.put(f"tell me about brand {i:05d} boutique", f"brand {i}")
+    start = time.perf_counter()
+    for i in range(1000):
+        assert big.get(f"Where is shop {i}?") == f"answer {i}"
+        big.get(f"tell me about the brand boutique")
+    print(f"   1 万条缓存时单次查询: {(time.perf_counter() - start) / 1000 * 1e6:.1f} µs")
+
+    print("\n所有测试完成！")
@@ -0,0 +1,252 @@
+"""
+迪拜商场互动服务 Agent - 多端点 / 多模型路由
+可配置多个 OpenAI 兼容端点（DeepSeek、本地模型服务等），按滚动延迟与错误率为每轮选择最快的健康端点；
+把工具结果改写为自然语言这类简单轮次交给更小更快的模型
+"""
+
+import os
+import json
+import time
+import random
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_MODEL = os.environ.get("DEEPSEEK_MODEL", "deepseek-chat")
+# 简单轮次（根据工具结果生成回复）使用的模型，默认与主模型相同
+DEFAULT_LIGHT_MODEL = os.environ.get("DEEPSEEK_LIGHT_MODEL") or DEFAULT_MODEL
+
+# 端点列表：JSON 字符串或 JSON 文件路径，例如
+#   [{"name": "deepseek", "base_url": "https://api.deepseek.com", "model": "deepseek-chat"},
+#    {"name": "local", "base_url": "http://localhost:11434/v1", "model": "qwen2.5:14b",
+#     "light_model": "qwen2.5:3b", "api_key": "ollama"}]
+ENDPOINTS_CONFIG = os.environ.get("LLM_ENDPOINTS", "")
+
+# 滚动统计的平滑系数（越大越看重最近的请求）
+EWMA_ALPHA = 0.2
+# 错误率超过该值（且样本足够）的端点视为不健康
+MAX_ERROR_RATE = 0.5
+MIN_SAMPLES = 5
+# 错误率随时间衰减的半衰期（秒）：不健康的端点不再收到请求，错误率不会被新的成功拉低，
+# 衰减到 MAX_ERROR_RATE 以下后重新变为健康并被探测（仍然失败则很快再次变为不健康）
+ERROR_HALF_LIFE = 30.0
+# 以该概率把一个非最快的健康端点排到第一位，刷新它的延迟统计
+EXPLORE_RATE = 0.05
+
+
+# ==================== 端点 ====================
+
+class Endpoint:
+    """一个 OpenAI 兼容端点及其滚动延迟 / 错误率（线程安全；错误率自上次调用起按 ERROR_HALF_LIFE 衰减）"""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: Optional[str] = None,
+        model: str = DEFAULT_MODEL,
+        light_model: Optional[str] = None,
+        api_key: Optional[str] = None,
+        api_key_env: Optional[str] = None
+    ):
+        """
+        Args:
+            name: 端点名称（日志与统计用）
+            base_url: API 地址（None 表示默认的 DeepSeek 地址）
+            model: 主模型
+            light_model: 简单轮次使用的模型（默认与主模型相同）
+            api_key: API Key；为空时读取 api_key_env 指定的环境变量，仍为空则使用调用方传入的 Key
+        """
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.light_model = light_model or model
+        self.api_key = api_key or (os.environ.get(api_key_env) if api_key_env else None)
+        self.latency: Optional[float] = None
+        self.samples = 0
+        self._error_rate = 0.0
+        self._recorded_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def model_for(self, kind: str) -> str:
+        """kind 为 "light" 时返回轻量模型，否则返回主模型"""
+        return self.light_model if kind == "light" else self.model
+
+    def record(self, latency: Optional[float], ok: bool):
+        """记录一次调用：成功时给出延迟（秒），失败时 latency 为 None"""
+        with self._lock:
+            now = time.monotonic()
+            error_rate = self._decayed_error_rate(now)
+            self.samples += 1
+            self._error_rate = error_rate + EWMA_ALPHA * ((0.0 if ok else 1.0) - error_rate)
+            self._recorded_at = now
+            if ok and latency is not None:
+                self.latency = latency if self.latency is None else \
+                    self.latency + EWMA_ALPHA * (latency - self.latency)
+
+    def _decayed_error_rate(self, now: float) -> float:
+        return self._error_rate * 0.5 ** ((now - self._recorded_at) / ERROR_HALF_LIFE)
+
+    @property
+    def error_rate(self) -> float:
+        """当前的滚动错误率（已按距上次调用的时间衰减）"""
+        return self._decayed_error_rate(time.monotonic())
+
+    @property
+    def healthy(self) -> bool:
+        return self.samples < MIN_SAMPLES or self.error_rate <= MAX_ERROR_RATE
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "base_url": self.base_url,
+                "model": self.model,
+                "light_model": self.light_model,
+                "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+                "error_rate": round(self._decayed_error_rate(time.monotonic()), 4),
+                "samples": self.samples
+            }
+
+
+# ==================== 路由策略 ====================
+
+class RoutingPolicy:
+    """
+    路由策略
+
+    rank() 给出本轮尝试端点的顺序：
+    1. 可用（熔断器未打开）且健康的端点在前，其中还没有样本的优先（先探测），其余按滚动延迟升序
+    2. 以 EXPLORE_RATE 的概率把另一个健康端点提前，避免一直不用的端点统计过时
+    3. 不健康或熔断中的端点排在最后，作为最后的退路；不健康端点的错误率随时间衰减，
+       一段时间后重新回到第 1 组被探测
+    调用方按顺序尝试，当前端点不可用时换下一个。
+    light_turns 为 True 时，简单轮次（上一条消息是工具结果）使用端点的 light_model。
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Endpoint],
+        light_turns: bool = True,
+        explore_rate: float = EXPLORE_RATE
+    ):
+        if not endpoints:
+            raise ValueError("路由策略至少需要一个端点")
+        self.endpoints = list(endpoints)
+        self.light_turns = light_turns
+        self.explore_rate = explore_rate
+        self._random = random.Random()
+
+    @classmethod
+    def single(cls, base_url: Optional[str] = None, model: Optional[str] = None,
+               api_key: Optional[str] = None) -> "RoutingPolicy":
+        """只有一个端点的策略（与原先固定 model + base_url 的行为相同）"""
+        model = model or DEFAULT_MODEL
+        light_model = DEFAULT_LIGHT_MODEL if model == DEFAULT_MODEL else model
+        return cls([Endpoint("default", base_url, model, light_model, api_key)])
+
+    @classmethod
+    def from_config(cls, config: str) -> "RoutingPolicy":
+        """从 JSON 字符串或 JSON 文件路径构建（格式见 ENDPOINTS_CONFIG）"""
+        if os.path.exists(config):
+            with open(config, "r", encoding="utf-8") as f:
+                config = f.read()
+        entries = json.loads(config)
+        return cls([Endpoint(**entry) for entry in entries])
+
+    @property
+    def namespace(self) -> tuple:
+        """用于缓存命名空间的稳定标识（端点与模型不同的策略互不共享回复缓存）"""
+        return tuple((e.name, e.base_url, e.model) for e in self.endpoints)
+
+    def turn_kind(self, chat_history: List[Dict[str, Any]]) -> str:
+        """本次请求的类型："light"（上一条是工具结果，模型只需把结果改写为回复）或 "full" """
+        if self.light_turns and chat_history and chat_history[-1].get("role") == "tool":
+            return "light"
+        return "full"
+
+    def rank(self, available: Callable[[Endpoint], bool] = lambda endpoint: True) -> List[Endpoint]:
+        """
+        本轮尝试端点的顺序
+
+        Args:
+            available: 端点当前能否接受请求（例如熔断器未打开）
+        """
+        usable = [e for e in self.endpoints if e.healthy and available(e)]
+        fallback = [e for e in self.endpoints if e not in usable]
+        fallback.sort(key=lambda e: e.error_rate)
+
+        # 未探测过的在前，其次按滚动延迟；只有失败记录（没有延迟）的排在健康端点最后
+        usable.sort(key=lambda e: (0, 0.0) if e.samples == 0 else
+                    (1, e.latency) if e.latency is not None else (2, 0.0))
+        if len(usable) > 1 and self._random.random() < self.explore_rate:
+            usable.insert(0, usable.pop(self._random.randrange(1, len(usable))))
+        return usable + fallback
+
+    def snapshot(self) -> Dict[str, Any]:
+        """各端点的滚动统计"""
+        return {e.name: e.snapshot() for e in self.endpoints}
+
+
+# 环境变量配置的全局策略（未配置 LLM_ENDPOINTS 时为 None）
+DEFAULT_POLICY: Optional[RoutingPolicy] = RoutingPolicy.from_config(ENDPOINTS_CONFIG) if ENDPOINTS_CONFIG else None
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    print("多端点路由测试\n")
+
+    fast = Endpoint("fast", "http://fast", "big", "small")
+    slow = Endpoint("slow", "http://slow", "big")
+    flaky = Endpoint("flaky", "http://flaky", "big")
+    policy = RoutingPolicy([slow, fast, flaky], explore_rate=0.0)
+
+    # 没有样本的端点先被探测
+    assert [e.name for e in policy.rank()] == ["slow", "fast", "flaky"]
+
+    for _ in range(10):
+        fast.record(0.2, True)
+        slow.record(1.5, True)
+        flaky.record(None, False)
+    print(f"   统计: {json.dumps(policy.snapshot(), indent=2)}")
+    print(f"   顺序: {[e.name for e in policy.rank()]}")
+    assert [e.name for e in policy.rank()] == ["fast", "slow", "flaky"]
+
+    # 只失败过的端点排在有延迟数据的端点之后
+    newcomer = Endpoint("newcomer", "http://new", "big")
+    newcomer.record(None, False)
+    assert [e.name for e in RoutingPolicy([newcomer, slow], explore_rate=0.0).rank()] == ["slow", "newcomer"]
+
+    # 熔断中的端点退到最后
+    order = [e.name for e in policy.rank(lambda e: e.name != "fast")]
+    print(f"   fast 熔断时: {order}")
+    assert order == ["slow", "fast", "flaky"]
+
+    # 简单轮次使用轻量模型
+    history = [{"role": "user", "content": "where is my car"},
+               {"role": "assistant", "content": "", "tool_calls": []},
+               {"role": "tool", "tool_call_id": "1", "content": "{}"}]
+    kind = policy.turn_kind(history)
+    print(f"   工具结果之后: {kind} → {fast.model_for(kind)}")
+    assert fast.model_for(kind) == "small" and fast.model_for(policy.turn_kind(history[:1])) == "big"
+
+    # 探索
+    policy.explore_rate = 1.0
+    assert policy.rank()[0].name == "slow"
+    policy.explore_rate = 0.0
+
+    # 不健康的端点：错误率随时间衰减，恢复健康后重新被探测；仍然失败则再次变为不健康
+    assert not flaky.healthy
+    flaky._recorded_at -= 2 * ERROR_HALF_LIFE
+    print(f"   flaky 空闲 {2 * ERROR_HALF_LIFE:.0f} 秒后: 错误率 {flaky.error_rate:.3f}，健康 {flaky.healthy}")
+    # 恢复后排在熔断中的 fast 之前（恢复前为 ["slow", "fast", "flaky"]）
+    assert flaky.healthy and [e.name for e in policy.rank(lambda e: e.name != "fast")] == ["slow", "flaky", "fast"]
+    for _ in range(3):
+        flaky.record(None, False)
+    assert not flaky.healthy and policy.rank()[-1] is flaky
+    flaky._recorded_at -= 2 * ERROR_HALF_LIFE
+    flaky.record(0.1, True)
+    assert flaky.healthy and policy.rank()[0] is flaky
+
+    print("\n所有测试完成！")
@@ -0,0 +1,472 @@
+"""
+迪拜商场互动服务 Agent - HTTP API 服务器
+不依赖 Streamlit 的多会话 JSON / SSE 接口（供 kiosk、移动 App、WhatsApp 等接入）：
+会话历史保存在服务端，同一会话的轮次按顺序执行，每个进程限制同时处理的轮次数
+
+    POST   /sessions/{id}/messages   {"message": "...", "user_id": "...", "context": {...}, "stream": true}
+                                     （user_id 在会话的第一轮绑定，之后不一致时返回 403）
+    GET    /sessions/{id}            会话的用户/助手消息
+    DELETE /sessions/{id}            结束会话
+    GET    /healthz                  在途轮次、会话数
+    GET    /metrics                  Prometheus 指标（见 tracing.py）
+
+    python server.py                 # 默认 127.0.0.1:8080
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import asyncio
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from agent_core import achat_with_concierge, astream_concierge, shutdown_clients
+from resilience import UpstreamError
+from routing import RoutingPolicy
+from session_store import SESSION_STORE, SessionStore
+from tracing import METRICS, debug
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.environ.get("SERVER_PORT", "8080"))
+# 每个进程同时处理的轮次上限，超过时返回 503（客户端按 Retry-After 重试）
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("SERVER_MAX_CONCURRENCY", "64"))
+
+# 请求体上限（字节）、请求行/请求头单行上限同为 MAX_BODY_BYTES；请求头最多 MAX_HEADERS 行
+MAX_BODY_BYTES = 64 * 1024
+MAX_HEADERS = 100
+# keep-alive 连接的空闲超时（秒）
+KEEP_ALIVE_TIMEOUT = 60.0
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+SESSION_PATH = re.compile(r"^/sessions/([^/]+)(/messages)?/?$")
+
+STATUS_TEXT = {
+    200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"
+}
+
+
+class HTTPError(Exception):
+    """以 JSON {"error": ...} 返回给客户端的错误"""
+
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+# ==================== HTTP 服务器 ====================
+
+class ConciergeServer:
+    """
+    基于 asyncio 的 HTTP/1.1 服务器（keep-alive、chunked SSE）
+
+    轮次直接在服务器的事件循环上运行 achat_with_concierge / astream_concierge，
+    不经过同步封装的后台线程；客户端在流式输出中途断开时，本轮历史会被回滚。
+    """
+
+    def __init__(
+        self,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        sessions: Optional[SessionStore] = None,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        model: Optional[str] = None,
+        routing: Optional[RoutingPolicy] = None
+    ):
+        """
+        Args:
+            host / port: 监听地址（port 为 0 时随机分配）
+            max_concurrency: 同时处理的轮次上限
+            sessions: 会话存储（默认全局 SESSION_STORE，多个工作进程可共用同一数据库）
+            api_key / base_url / model / routing: 传给 achat_with_concierge 的上游配置
+        """
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.sessions = sessions if sessions is not None else SESSION_STORE
+        self.upstream = {"api_key": api_key, "base_url": base_url, "model": model, "routing": routing}
+        self.inflight = 0
+        self.stats = {"requests": 0, "turns": 0, "rejected": 0, "errors": 0, "disconnects": 0}
+        self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    # ---------- 生命周期 ----------
+
+    async def start(self) -> "ConciergeServer":
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_BODY_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    # ---------- 连接与请求解析 ----------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # SSE 事件逐条写出，关闭 Nagle 算法以免小包被攒到对端的延迟 ACK 之后
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), KEEP_ALIVE_TIMEOUT)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": str(e)}, e.headers, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self.stats["requests"] += 1
+                started = time.perf_counter()
+                status = await self._dispatch(writer, method, path, headers, body, keep_alive)
+                debug(f"[HTTP] {method} {path} → {status}（{(time.perf_counter() - started) * 1000:.1f} ms）")
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _readline(reader: asyncio.StreamReader) -> bytes:
+        """读取一行；超过 StreamReader 的 limit（MAX_BODY_BYTES）时返回 400 而不是直接断开连接"""
+        try:
+            return await reader.readline()
+        except (ValueError, asyncio.LimitOverrunError):
+            raise HTTPError(400, f"请求行或请求头超过 {MAX_BODY_BYTES} 字节")
+
+    @classmethod
+    async def _read_request(cls, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        """读取一个请求；连接在请求之间关闭时返回 None"""
+        request_line = await cls._readline(reader)
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "无效的请求行")
+
+        headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = await cls._readline(reader)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise HTTPError(400, f"请求头超过 {MAX_HEADERS} 行")
+
+        try:
+            length = int(headers.get("content-length", "0") or 0)
+        except ValueError:
+            raise HTTPError(400, "无效的 Content-Length")
+        if length < 0:
+            raise HTTPError(400, "无效的 Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, f"请求体超过 {MAX_BODY_BYTES} 字节")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), urlsplit(target).path, headers, body
+
+    # ---------- 路由 ----------
+
+    async def _dispatch(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        body: bytes,
+        keep_alive: bool
+    ) -> int:
+        """处理一个请求，返回状态码"""
+        try:
+            if path == "/healthz" and method == "GET":
+                return await self._send_json(writer, 200, {
+                    "status": "ok",
+                    "inflight": self.inflight,
+                    "max_concurrency": self.max_concurrency,
+                    "sessions": len(self.sessions),
+                    "session_store": self.sessions.snapshot(),
+                    **self.stats
+                }, keep_alive=keep_alive)
+
+            if path == "/metrics" and method == "GET":
+                return await self._send(writer, 200, METRICS.render().encode("utf-8"),
+                                        "text/plain; version=0.0.4; charset=utf-8", keep_alive=keep_alive)
+
+            match = SESSION_PATH.match(path)
+            if match is None:
+                raise HTTPError(404, f"未知路径: {path}")
+            session_id, messages = match.group(1), bool(match.group(2))
+            if not SESSION_ID_PATTERN.match(session_id):
+                raise HTTPError(400, "session_id 只能包含字母、数字、'_'、'-'、'.'（最长 64 个字符）")
+
+            if messages:
+                if method != "POST":
+                    raise HTTPError(405, "请使用 POST 发送消息")
+                return await self._post_message(writer, session_id, headers, body, keep_alive)
+            if method == "GET":
+                return await self._get_session(writer, session_id, keep_alive)
+            if method == "DELETE":
+                self.sessions.delete(session_id)
+                return await self._send(writer, 204, b"", keep_alive=keep_alive)
+            raise HTTPError(405, f"不支持的方法: {method}")
+
+        except HTTPError as e:
+            return await self._send_json(writer, e.status, {"error": str(e)}, e.headers, keep_alive)
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"❌ 处理 {method} {path} 时出错: {type(e).__name__}: {e}")
+            return await self._send_json(writer, 500, {"error": "服务器内部错误"}, keep_alive=keep_alive)
+
+    async def _get_session(self, writer: asyncio.StreamWriter, session_id: str, keep_alive: bool) -> int:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPError(404, f"会话不存在: {session_id}")
+        return await self._send_json(writer, 200, {
+            "session_id": session_id,
+            "user_id": session["user_id"],
+            "messages": visible_messages(session["history"])
+        }, keep_alive=keep_alive)
+
+    # ---------- 对话轮次 ----------
+
+    async def _post_message(
+        self,
+        writer: asyncio.StreamWriter,
+        session_id: str,
+        headers: Dict[str, str],
+        body: bytes,
+        keep_alive: bool
+    ) -> int:
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "请求体不是有效的 JSON")
+        message = payload.get("message") if isinstance(payload, dict) else None
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(400, "缺少 message 字段")
+        context = payload.get("context")
+        if context is not None and not isinstance(context, dict):
+            raise HTTPError(400, "context 必须是对象")
+        user_id = payload.get("user_id")
+        if user_id is not None and not isinstance(user_id, str):
+            raise HTTPError(400, "user_id 必须是字符串")
+        stream = bool(payload.get("stream")) or "text/event-stream" in headers.get("accept", "")
+
+        # 准入控制：超过并发上限时立即拒绝，而不是无限排队
+        if self.inflight >= self.max_concurrency:
+            self.stats["rejected"] += 1
+            raise HTTPError(503, "服务器繁忙，请稍后重试", {"Retry-After": "1"})
+
+        self.inflight += 1
+        try:
+            # 同一会话的轮次按到达顺序执行（历史不能被并发修改）
+            async with self._session_lock(session_id):
+                # user_id 在会话创建时绑定（未给出时使用 session_id），之后不能用别的 user_id 继续该会话
+                session = self.sessions.get(session_id)
+                if session is None:
+                    session = {"history": [], "user_id": user_id or session_id, "context": None}
+                elif user_id and user_id != session["user_id"]:
+                    raise HTTPError(403, "user_id 与会话绑定的用户不一致")
+                if context is not None:
+                    session["context"] = context
+
+                turn = {
+                    "user_input": message,
+                    "chat_history": session["history"],
+                    "user_id": session["user_id"],
+                    "context": session["context"],
+                    **self.upstream
+                }
+
+                # 在写出最终响应之前保存会话：客户端收到回复后可能立即把下一条消息发给
+                # 共用同一数据库的另一个工作进程，那时本轮必须已经落盘
+                persisted = False
+
+                def persist():
+                    nonlocal persisted
+                    self.sessions.put(session_id, session)
+                    persisted = True
+
+                try:
+                    if stream:
+                        return await self._stream_turn(writer, session_id, turn, keep_alive, persist)
+                    return await self._complete_turn(writer, session_id, turn, keep_alive, persist)
+                finally:
+                    # 出错或客户端断开时本轮消息已回滚，仍然保存，使内存中的会话与数据库一致
+                    if not persisted:
+                        persist()
+        finally:
+            self.inflight -= 1
+
+    async def _complete_turn(
+        self,
+        writer: asyncio.StreamWriter,
+        session_id: str,
+        turn: Dict[str, Any],
+        keep_alive: bool,
+        persist: Callable[[], None]
+    ) -> int:
+        try:
+            reply, _ = await achat_with_concierge(**turn)
+        except UpstreamError as e:
+            self.stats["errors"] += 1
+            raise HTTPError(503, str(e), {"Retry-After": "5"})
+        except ValueError as e:
+            # 配置错误（例如没有 API Key）
+            self.stats["errors"] += 1
+            raise HTTPError(500, str(e))
+        self.stats["turns"] += 1
+        persist()
+        return await self._send_json(writer, 200, {"session_id": session_id, "reply": reply}, keep_alive=keep_alive)
+
+    async def _stream_turn(
+        self,
+        writer: asyncio.StreamWriter,
+        session_id: str,
+        turn: Dict[str, Any],
+        keep_alive: bool,
+        persist: Callable[[], None]
+    ) -> int:
+        """
+        以 Server-Sent Events 流式返回：event: delta（文本增量）… event: done（完整回复）；
+        出错时发送 event: error。客户端断开时关闭生成器，本轮历史随之回滚。
+        生成器结束后、发送 done / error 之前调用 persist 保存会话。
+        """
+        writer.write(self._head(200, {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked"
+        }, keep_alive))
+
+        parts: List[str] = []
+        try:
+            deltas = astream_concierge(**turn)
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    await self._send_event(writer, "delta", {"text": delta})
+            finally:
+                await deltas.aclose()
+            self.stats["turns"] += 1
+            persist()
+            await self._send_event(writer, "done", {"session_id": session_id, "reply": "".join(parts)})
+        except ConnectionError:
+            self.stats["disconnects"] += 1
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            persist()
+            await self._send_event(writer, "error", {"error": str(e), "type": type(e).__name__})
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return 200
+
+    def _session_lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        return lock
+
+    # ---------- 响应 ----------
+
+    @staticmethod
+    def _head(status: int, headers: Dict[str, str], keep_alive: bool) -> bytes:
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        data: bytes,
+        content_type: str = "application/json",
+        headers: Optional[Dict[str, str]] = None,
+        keep_alive: bool = True
+    ) -> int:
+        head = {"Content-Length": str(len(data)), **(headers or {})}
+        if data:
+            head["Content-Type"] = content_type
+        writer.write(self._head(status, head, keep_alive) + data)
+        await writer.drain()
+        return status
+
+    async def _send_json(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+        keep_alive: bool = True
+    ) -> int:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        return await self._send(writer, status, data, "application/json; charset=utf-8", headers, keep_alive)
+
+    @staticmethod
+    async def _send_event(writer: asyncio.StreamWriter, event: str, payload: Dict[str, Any]):
+        data = f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+        writer.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+
+def visible_messages(history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """会话中访客可见的消息（用户输入与助手的文本回复，不含工具调用与结果）"""
+    return [
+        {"role": m["role"], "content": m["content"]}
+        for m in history
+        if m["role"] in ("user", "assistant") and not m.get("tool_calls") and m.get("content")
+    ]
+
+
+# ==================== 启动 ====================
+
+async def _main():
+    server = await ConciergeServer().start()
+    print(f"🛎️ Concierge API 已启动: {server.base_url}（并发上限 {server.max_concurrency}）")
+    print(f"   curl -N -X POST {server.base_url}/sessions/kiosk-1/messages "
+          f"-d '{{\"message\": \"Where is Hermès?\", \"stream\": true}}'")
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main())
+    except KeyboardInterrupt:
+        print("\n👋 Concierge API 已停止")
+    finally:
+        shutdown_clients()
@@ -0,0 +1,368 @@
+"""
+迪拜商场互动服务 Agent - 会话存储
+对话历史不再只保存在某个 Streamlit / 服务器进程的内存里：
+内存层按 LRU 缓存最近活跃的会话，所有会话以压缩的紧凑 JSON 写入本地 SQLite，
+空闲会话从内存中换出、超过 TTL 后删除，任意工作进程都可以按会话 ID 恢复会话
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from tracing import METRICS
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_DB_FILE = os.environ.get("SESSION_DB", "sessions.db")
+# 内存层最多保留的会话数（超过时换出最久未使用的会话）
+DEFAULT_MEMORY_SIZE = int(os.environ.get("SESSION_MEMORY_SIZE", "256"))
+# 会话空闲多久后从内存层换出（秒，磁盘上的副本保留）
+DEFAULT_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", "300"))
+# 会话空闲多久后删除（秒）
+DEFAULT_TTL = float(os.environ.get("SESSION_TTL", "86400"))
+# 每个会话最多保存的历史消息数（超过时丢弃最早的完整轮次，0 表示不限）
+DEFAULT_MAX_MESSAGES = int(os.environ.get("SESSION_MAX_MESSAGES", "200"))
+
+# 清理空闲 / 过期会话的最小间隔（秒）
+SWEEP_INTERVAL = 30.0
+# zlib 压缩级别（对话历史中的键名、工具名和店铺信息大量重复）
+COMPRESS_LEVEL = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id  TEXT PRIMARY KEY,
+    data        BLOB NOT NULL,
+    updated_ns  INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_ns);
+"""
+
+
+# ==================== 序列化 ====================
+
+def compact_json(session: Dict[str, Any]) -> bytes:
+    """紧凑 JSON（无多余空白、保留非 ASCII 字符）"""
+    return json.dumps(session, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_session(data: bytes) -> Dict[str, Any]:
+    """解压并解析 put 写入的会话"""
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def trim_history(history: List[Dict[str, Any]], max_messages: int) -> int:
+    """
+    原地丢弃最早的完整轮次，使历史不超过 max_messages 条
+
+    只在用户消息处截断，工具调用与其结果不会被拆开。
+
+    Returns:
+        int: 丢弃的消息数
+    """
+    if max_messages <= 0 or len(history) <= max_messages:
+        return 0
+    earliest = len(history) - max_messages
+    cut = next((i for i in range(earliest, len(history)) if history[i].get("role") == "user"), None)
+    if cut is None:
+        return 0  # 最后一轮本身就超过上限，保留整轮
+    del history[:cut]
+    return cut
+
+
+# ==================== 会话存储 ====================
+
+class SessionStore:
+    """
+    两层会话存储（线程安全，可被多个进程同时打开）
+
+    会话是任意可 JSON 序列化的字典，约定 "history" 为 chat_history。
+    - 内存层：session_id → 已解码的会话（OrderedDict 实现 LRU），命中时无需解压和解析
+    - 磁盘层：SQLite（WAL 模式），每次 put 立即写入压缩后的会话，是所有进程共享的数据源
+
+    每次 get 都用主键查询磁盘上的版本号（写入时间），版本与内存层一致才直接返回内存中的会话，
+    因此其他进程写入或删除的会话不会读到旧副本；内存层只节省解压与解析。
+    """
+
+    def __init__(
+        self,
+        db_file: str = DEFAULT_DB_FILE,
+        memory_size: int = DEFAULT_MEMORY_SIZE,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+        ttl: float = DEFAULT_TTL,
+        max_messages: int = DEFAULT_MAX_MESSAGES
+    ):
+        """
+        Args:
+            db_file: SQLite 数据库文件（第一次读写时创建）
+            memory_size: 内存层最多保留的会话数
+            idle_seconds: 空闲多久后从内存层换出
+            ttl: 空闲多久后删除（0 表示永不过期）
+            max_messages: 每个会话最多保存的历史消息数
+        """
+        self.db_file = db_file
+        self.memory_size = memory_size
+        self.idle_seconds = idle_seconds
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_sweep = time.monotonic()
+        self.stats = {
+            "memory_hits": 0,
+            "disk_loads": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+            "spills": 0,
+            "expirations": 0,
+            "trimmed_messages": 0,
+            "raw_bytes": 0,
+            "stored_bytes": 0
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """关闭当前线程的连接（磁盘上的会话始终是最新的，无需额外保存）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _cutoff_ns(self) -> int:
+        return time.time_ns() - int(self.ttl * 1e9) if self.ttl > 0 else 0
+
+    def __len__(self):
+        """未过期的会话数"""
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM sessions WHERE updated_ns >= ?", (self._cutoff_ns(),)
+        ).fetchone()[0]
+
+    # ---------- 读写 ----------
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        按 ID 取会话（不存在或已过期时返回 None）
+
+        返回的字典可以原地修改（例如传给 chat_with_concierge 的 history），修改后调用 put 保存。
+        """
+        self._maybe_sweep()
+        conn = self._connect()
+        row = conn.execute("SELECT updated_ns FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None or row[0] < self._cutoff_ns():
+            with self._lock:
+                self._memory.pop(session_id, None)
+                self.stats["misses"] += 1
+            return None
+
+        version = row[0]
+        with self._lock:
+            entry = self._memory.get(session_id)
+            if entry is not None and entry["version"] == version:
+                self._memory.move_to_end(session_id)
+                entry["touched"] = time.monotonic()
+                self.stats["memory_hits"] += 1
+                return entry["session"]
+
+        # 内存中没有或已被其他进程更新：从磁盘加载
+        row = conn.execute("SELECT data, updated_ns FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        session = decode_session(row[0])
+        with self._lock:
+            self.stats["disk_loads"] += 1
+            self._remember_locked(session_id, session, row[1])
+        return session
+
+    def put(self, session_id: str, session: Dict[str, Any]):
+        """保存会话（立即写入磁盘，并放入内存层）"""
+        history = session.get("history")
+        trimmed = trim_history(history, self.max_messages) if isinstance(history, list) else 0
+
+        raw = compact_json(session)
+        data = zlib.compress(raw, COMPRESS_LEVEL)
+
+        with self._lock:
+            entry = self._memory.get(session_id)
+            # 版本号即写入时间（纳秒），同一进程内保证递增
+            version = max(time.time_ns(), entry["version"] + 1 if entry else 0)
+
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, data, updated_ns) VALUES (?, ?, ?)",
+                (session_id, data, version)
+            )
+
+        with self._lock:
+            self.stats["writes"] += 1
+            self.stats["trimmed_messages"] += trimmed
+            self.stats["raw_bytes"] += len(raw)
+            self.stats["stored_bytes"] += len(data)
+            self._remember_locked(session_id, session, version)
+        self._maybe_sweep()
+
+    def delete(self, session_id: str) -> bool:
+        """删除会话，返回会话是否存在"""
+        with self._lock:
+            self._memory.pop(session_id, None)
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return cursor.rowcount > 0
+
+    def _remember_locked(self, session_id: str, session: Dict[str, Any], version: int):
+        if self.memory_size <= 0:
+            return
+        self._memory[session_id] = {"session": session, "version": version, "touched": time.monotonic()}
+        self._memory.move_to_end(session_id)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    # ---------- 清理 ----------
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        self.sweep()
+
+    def sweep(self) -> Dict[str, int]:
+        """
+        换出内存中空闲超过 idle_seconds 的会话，删除磁盘上空闲超过 ttl 的会话
+
+        Returns:
+            dict: {"spilled": 换出数, "expired": 删除数}
+        """
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [session_id for session_id, entry in self._memory.items() if entry["touched"] < cutoff]
+            for session_id in idle:
+                del self._memory[session_id]
+            self.stats["spills"] += len(idle)
+
+        expired = 0
+        if self.ttl > 0:
+            conn = self._connect()
+            with conn:
+                expired = conn.execute("DELETE FROM sessions WHERE updated_ns < ?", (self._cutoff_ns(),)).rowcount
+            with self._lock:
+                self.stats["expirations"] += expired
+        return {"spilled": len(idle), "expired": expired}
+
+    # ---------- 统计 ----------
+
+    def snapshot(self) -> Dict[str, Any]:
+        """命中率、压缩率等统计"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_sessions"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_loads"]
+        stats["memory_hit_rate"] = round(stats["memory_hits"] / lookups, 4) if lookups else 0.0
+        stats["compression_ratio"] = (
+            round(stats["stored_bytes"] / stats["raw_bytes"], 4) if stats["raw_bytes"] else 0.0
+        )
+        return stats
+
+
+# 全局会话存储（见 SESSION_DB / SESSION_MEMORY_SIZE / SESSION_IDLE_SECONDS / SESSION_TTL）
+SESSION_STORE = SessionStore()
+
+
+def _collect_metrics() -> Dict[str, float]:
+    """会话存储的内存层命中率与压缩率（渲染 /metrics 时读取）"""
+    stats = SESSION_STORE.snapshot()
+    return {
+        "concierge_session_memory_sessions": stats["memory_sessions"],
+        "concierge_session_memory_hit_rate": stats["memory_hit_rate"],
+        "concierge_session_compression_ratio": stats["compression_ratio"]
+    }
+
+
+METRICS.collectors.append(_collect_metrics)
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import tempfile
+
+    print("会话存储测试\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "sessions.db")
+        store = SessionStore(db_file, memory_size=2, idle_seconds=0.2, ttl=0.5, max_messages=6)
+
+        history = []
+        for i in range(5):
+            history.append({"role": "user", "content": f"Where is shop number {i}?"})
+            history.append({"role": "assistant", "content": "", "tool_calls": [
+                {"id": f"call_{i}", "type": "function",
+                 "function": {"name": "get_shop_info", "arguments": json.dumps({"shop_name": f"Shop {i}"})}}
+            ]})
+            history.append({"role": "tool", "tool_call_id": f"call_{i}",
+                            "content": json.dumps({"success": True, "floor": "Ground Floor", "zone": "Zone A"})})
+            history.append({"role": "assistant", "content": f"Shop {i} is on the Ground Floor, Zone A. مرحبا!"})
+        session = {"history": history, "user_id": "kiosk_7"}
+        store.put("kiosk-7", session)
+
+        # 只在用户消息处截断
+        print(f"   截断后历史: {len(session['history'])} 条，首条角色 {session['history'][0]['role']}")
+        assert len(session["history"]) == 4 and session["history"][0]["role"] == "user"
+
+        # 内存命中返回同一个对象；另一个存储实例（模拟另一个进程）从磁盘恢复
+        assert store.get("kiosk-7") is session
+        other = SessionStore(db_file)
+        resumed = other.get("kiosk-7")
+        assert resumed == session and resumed is not session
+        print("   ✅ 另一个实例按 ID 恢复了会话")
+
+        # 另一个进程写入后，本进程读到新版本而不是内存中的旧副本
+        resumed["history"].append({"role": "user", "content": "thanks!"})
+        other.put("kiosk-7", resumed)
+        assert store.get("kiosk-7")["history"][-1]["content"] == "thanks!"
+        print("   ✅ 其他进程的更新使内存副本失效")
+
+        # LRU
+        store.put("a", {"history": []})
+        store.put("b", {"history": []})
+        assert "kiosk-7" not in store._memory and store.get("kiosk-7") is not None
+
+        # 空闲换出与 TTL 过期
+        time.sleep(0.3)
+        print(f"   空闲清理: {store.sweep()}")
+        assert not store._memory and store.get("a") is not None
+        time.sleep(0.6)
+        assert store.get("a") is None
+        print(f"   过期清理: {store.sweep()}，剩余 {len(store)} 个会话")
+
+        assert store.delete("b") is False
+        stats = store.snapshot()
+        print(f"\n   统计: {stats}")
+        print(f"   压缩后大小约为原始 JSON 的 {stats['compression_ratio']:.0%}")
+
+        other.close()
+        store.close()
+
+    print("\n✅ 会话存储测试通过")
@@ -0,0 +1,319 @@
+"""
+迪拜商场互动服务 Agent - 店铺搜索索引
+预先构建的三元组 / 前缀倒排索引：忽略大小写与重音、容忍拼写错误、按相关度排序返回 top-k；
+多语言别名（阿拉伯文、阿拉伯语转写、中文）通过归一化哈希表一次命中
+"""
+
+import heapq
+import math
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+# ==================== 召回参数 ====================
+
+# 三元组召回：店铺至少命中查询三元组的这一比例才参与拼写纠错打分
+MIN_TRIGRAM_OVERLAP = 0.4
+# 每次查询最多打分的候选数（前缀召回按名称长度、三元组召回按命中数取前若干个）
+MAX_CANDIDATES = 64
+# 不足该长度的查询只按前缀召回（一两个字符的三元组几乎不含信息）
+MIN_FUZZY_LENGTH = 3
+
+
+# ==================== 文本归一化 ====================
+
+# 阿拉伯文字母变体统一（NFKD 已去掉短元音符号 harakat）
+ARABIC_FOLDING = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه",
+    "ى": "ي",
+    "ؤ": "و",
+    "ئ": "ي",
+    "ـ": None,  # tatweel 连接线
+})
+
+
+def normalize(text: str) -> str:
+    """
+    归一化店铺名称/查询：NFKD 分解后去掉重音符号、统一小写，标点视为空格；
+    阿拉伯文统一 alef / ta marbuta / alef maqsura 等变体，全角字符转为半角
+
+    例如 "Hermès" → "hermes"，"% Arabica" → "arabica"，"هيرميس" 与 "هِيرْمِيس" 相同
+    """
+    decomposed = unicodedata.normalize("NFKD", text.translate(ARABIC_FOLDING))
+    chars = []
+    for ch in decomposed:
+        if unicodedata.combining(ch):
+            continue
+        chars.append(ch.casefold() if ch.isalnum() else " ")
+    return " ".join("".join(chars).split())
+
+
+def trigrams(text: str) -> Set[str]:
+    """按词生成带边界填充的三元组（"zara" → " za", "zar", "ara", "ra "）"""
+    grams = set()
+    for token in text.split():
+        padded = f" {token} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def edit_similarity(a: str, b: str) -> float:
+    """基于 OSA 编辑距离（相邻字符交换计 1 次）的相似度，范围 0~1"""
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cost = 0 if ca == cb else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+
+    return 1.0 - prev[-1] / max(len(a), len(b))
+
+
+# ==================== 搜索索引 ====================
+
+class ShopIndex:
+    """
+    店铺搜索索引
+
+    - 别名哈希表：归一化名称/别名 → 店铺 key，完全匹配时一次哈希查找直接返回
+    - 前缀倒排表：词前缀 → 店铺 key 集合；查询的每个词都是某个名称词的前缀时只从这里召回
+    - 三元组倒排表：trigram → 店铺 key 集合，用于子串和拼写纠错的候选召回，
+      按店铺统计命中的查询三元组数，低于 MIN_TRIGRAM_OVERLAP 的不参与打分
+    两种召回都最多取 MAX_CANDIDATES 个候选，打分开销与店铺总数无关。支持增量 add / remove。
+    """
+
+    # 相关度分档（同档内按相似度细分）
+    EXACT = 1.0
+    NAME_PREFIX = 0.95
+    TOKEN_PREFIX = 0.9
+    SUBSTRING = 0.85
+    FUZZY = 0.8
+
+    def __init__(
+        self,
+        shops: Optional[Dict[str, Dict[str, Any]]] = None,
+        aliases: Optional[Dict[str, List[str]]] = None,
+        min_score: float = 0.5
+    ):
+        """
+        Args:
+            shops: 店铺字典（key → 店铺信息），与 mock_data.SHOPS 结构相同
+            aliases: 店铺别名（key → 各语言/各写法的别名列表）
+            min_score: 低于该分数的结果不返回
+        """
+        self.min_score = min_score
+        self._names: Dict[str, List[str]] = {}
+        self._shortest: Dict[str, int] = {}
+        self._exact: Dict[str, Set[str]] = defaultdict(set)
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._prefixes: Dict[str, Set[str]] = defaultdict(set)
+
+        aliases = aliases or {}
+        for key, shop in (shops or {}).items():
+            self.add(key, shop, aliases.get(key))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def _index_terms(self, key: str, shop: Dict[str, Any], aliases: Optional[List[str]]) -> List[str]:
+        """店铺可被搜索的归一化名称（名称 + 全部别名）"""
+        names = {normalize(key), normalize(shop.get("name", key))}
+        names.update(normalize(alias) for alias in aliases or [])
+        return sorted(name for name in names if name)
+
+    def add(self, key: str, shop: Dict[str, Any], aliases: Optional[List[str]] = None):
+        """加入（或更新）一个店铺及其别名"""
+        if key in self._names:
+            self.remove(key)
+
+        names = self._index_terms(key, shop, aliases)
+        self._names[key] = names
+        self._shortest[key] = min((len(name) for name in names), default=0)
+        for name in names:
+            self._exact[name].add(key)
+            for gram in trigrams(name):
+                self._trigrams[gram].add(key)
+            for token in name.split():
+                for i in range(1, len(token) + 1):
+                    self._prefixes[token[:i]].add(key)
+
+    def remove(self, key: str):
+        """移除一个店铺（只清理该店铺涉及的倒排项）"""
+        names = self._names.pop(key, None)
+        if names is None:
+            return
+        del self._shortest[key]
+
+        for name in names:
+            self._discard(self._exact, name, key)
+            for gram in trigrams(name):
+                self._discard(self._trigrams, gram, key)
+            for token in name.split():
+                for i in range(1, len(token) + 1):
+                    self._discard(self._prefixes, token[:i], key)
+
+    @staticmethod
+    def _discard(postings: Dict[str, Set[str]], term: str, key: str):
+        keys = postings.get(term)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del postings[term]
+
+    def lookup(self, query: str) -> Optional[str]:
+        """
+        按名称或别名精确查找（一次哈希查找）
+
+        Returns:
+            str: 店铺 key；未命中或别名同时指向多家店铺时返回 None
+        """
+        keys = self._exact.get(normalize(query))
+        if keys and len(keys) == 1:
+            return next(iter(keys))
+        return None
+
+    def _prefix_candidates(self, query: str) -> Set[str]:
+        """每个查询词都是店铺某个名称词前缀的店铺（从最小的倒排集合开始求交集）"""
+        postings = sorted((self._prefixes.get(token, set()) for token in query.split()), key=len)
+        if not postings or not postings[0]:
+            return set()
+        candidates = set(postings[0])
+        for keys in postings[1:]:
+            candidates &= keys
+            if not candidates:
+                break
+        if len(candidates) > MAX_CANDIDATES:
+            # 前缀得分随 查询长度 / 名称长度 增大，保留名称最短的候选
+            shortest = self._shortest
+            candidates = set(heapq.nsmallest(MAX_CANDIDATES, candidates, key=lambda key: (shortest[key], key)))
+        return candidates
+
+    def _trigram_candidates(self, query: str) -> Set[str]:
+        """命中查询三元组最多的店铺（命中比例不低于 MIN_TRIGRAM_OVERLAP）"""
+        grams = trigrams(query)
+        hits: Counter = Counter()
+        for gram in grams:
+            hits.update(self._trigrams.get(gram, ()))
+        needed = max(1, math.ceil(len(grams) * MIN_TRIGRAM_OVERLAP))
+        qualified = [(-count, key) for key, count in hits.items() if count >= needed]
+        return {key for _, key in heapq.nsmallest(MAX_CANDIDATES, qualified)}
+
+    def _candidates(self, query: str, k: int) -> Set[str]:
+        """
+        召回候选：先按前缀；前缀候选不足 k 个时再按三元组补充子串和拼写纠错的候选
+        （前缀匹配的得分总是高于子串和拼写纠错，因此足够 k 个时无需再召回）
+        """
+        candidates = self._prefix_candidates(query)
+        if len(candidates) < k and len(query) >= MIN_FUZZY_LENGTH:
+            candidates |= self._trigram_candidates(query)
+        return candidates
+
+    def _score(self, query: str, name: str) -> float:
+        if query == name:
+            return self.EXACT
+
+        length_ratio = len(query) / len(name)
+        if name.startswith(query):
+            return self.NAME_PREFIX + 0.04 * length_ratio
+
+        query_tokens = query.split()
+        name_tokens = name.split()
+        if all(any(t.startswith(q) for t in name_tokens) for q in query_tokens):
+            return self.TOKEN_PREFIX + 0.04 * length_ratio
+
+        if query in name:
+            return self.SUBSTRING + 0.04 * length_ratio
+
+        # 拼写纠错：每个查询词取与店铺名中最相近词的相似度，再取平均
+        best = [max(edit_similarity(q, t) for t in name_tokens) for q in query_tokens]
+        similarity = max(sum(best) / len(best), edit_similarity(query, name))
+        return self.FUZZY * similarity
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[str, float]]:
+        """
+        搜索店铺
+
+        Args:
+            query: 用户输入的店铺名称
+            k: 最多返回的结果数
+
+        Returns:
+            list: [(店铺 key, 相关度)]，按相关度降序（同分按名称排序，结果稳定）
+        """
+        normalized = normalize(query)
+        if not normalized:
+            return []
+
+        # 名称/别名完全匹配：直接返回，无需召回和打分
+        exact = self._exact.get(normalized)
+        if exact and len(exact) == 1:
+            return [(next(iter(exact)), self.EXACT)]
+
+        scored: Iterable[Tuple[str, float]] = (
+            (key, max(self._score(normalized, name) for name in self._names[key]))
+            for key in self._candidates(normalized, k)
+        )
+        results = [(key, score) for key, score in scored if score >= self.min_score]
+        results.sort(key=lambda item: (-item[1], item[0]))
+        return results[:k]
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import time
+    from mock_data import SHOPS, SHOP_ALIASES
+
+    print("店铺搜索索引测试\n")
+
+    index = ShopIndex(SHOPS, SHOP_ALIASES)
+    for query in ["hermes", "HERMÈS", "Hermse", "arabica", "apple", "lv", "Luis Vuiton", "shack", "z", "xyz",
+                  "هيرميس", "هِيرْمِيس", "هرمس", "爱马仕", "香奈儿", "Ｚａｒａ", "مصلى", "祈祷室", "shanel"]:
+        print(f"   {query!r:16} → {index.search(query, k=3)}")
+
+    assert index.lookup("هِيرْمِيس") == "Hermès"
+    assert index.lookup("爱马仕") == "Hermès"
+    assert index.lookup("lv") == "Louis Vuitton"
+
+    assert index.search("hermes")[0][0] == "Hermès"
+    assert index.search("Luis Vuiton")[0][0] == "Louis Vuitton"
+    assert index.search("xyz") == []
+
+    # 增量更新
+    index.add("Hermès Home", {"name": "Hermès Home"})
+    assert [key for key, _ in index.search("hermes home")][0] == "Hermès Home"
+    index.remove("Hermès Home")
+    assert "Hermès Home" not in index
+
+    # 1200 家店铺规模
+    big = ShopIndex({f"Brand {i:04d} Boutique": {"name": f"Brand {i:04d} Boutique"} for i in range(1200)})
+    big.add("Hermès", SHOPS["Hermès"])
+    # 前缀查询与拼写纠错只对有限个候选打分
+    assert len(big._candidates("bra", 5)) <= MAX_CANDIDATES
+    assert len(big._candidates("brand 0042 boutqiue", 5)) <= MAX_CANDIDATES
+    assert big.search("Brand 0042 Boutqiue")[0][0] == "Brand 0042 Boutique"
+    assert big.search("Hermse")[0][0] == "Hermès"
+    assert len(big.search("bra")) == 5
+    print()
+    for label, query in [("完全匹配", "hermes"), ("前缀", "bra"), ("拼写纠错", "Brand 0042 Boutqiue")]:
+        start = time.perf_counter()
+        for _ in range(50):
+            big.search(query)
+        print(f"   1201 家店铺时单次{label}查询: {(time.perf_counter() - start) / 50 * 1e6:.1f} µs")
+
+    print("\n所有测试完成！")
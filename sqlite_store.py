@@ -0,0 +1,318 @@
+"""
+迪拜商场互动服务 Agent - SQLite 用户状态存储
+基于标准库 sqlite3（WAL 模式），支持多进程访问、行级更新和按券码快速查询
+"""
+
+import os
+import json
+import random
+import string
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+
+# ==================== 表结构 ====================
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id     TEXT PRIMARY KEY,
+    points      INTEGER NOT NULL DEFAULT 0,
+    created_at  TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS point_ledger (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id     TEXT NOT NULL REFERENCES users(user_id),
+    delta       INTEGER NOT NULL,
+    reason      TEXT,
+    created_at  TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS coupons (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id     TEXT NOT NULL REFERENCES users(user_id),
+    code        TEXT NOT NULL,
+    type        TEXT NOT NULL,
+    points_cost INTEGER NOT NULL DEFAULT 0,
+    created_at  TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_user ON point_ledger(user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_code ON coupons(code);
+CREATE INDEX IF NOT EXISTS idx_coupons_user ON coupons(user_id);
+"""
+
+
+# ==================== SQLite 用户状态 ====================
+
+class SqliteUserState:
+    """
+    SQLite 用户状态（接口与 mock_data.UserState 一致）
+
+    - users:        每个用户一行，points 为当前余额（读取 O(1)）
+    - point_ledger: 每次积分变动一条流水，便于对账
+    - coupons:      按 code（唯一）和 user_id 建索引
+
+    每个线程使用独立连接；数据库以 WAL 模式打开，多个读者与一个写者互不阻塞，
+    多个进程可同时打开同一数据库文件。
+    """
+
+    def __init__(self, db_file: str = "user_data.db", migrate_from: Optional[str] = None):
+        """
+        Args:
+            db_file: SQLite 数据库文件
+            migrate_from: 旧的 user_data.json 路径；数据库为空时自动导入
+        """
+        self.db_file = db_file
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+        self.load(migrate_from)
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def load(self, migrate_from: Optional[str] = None):
+        """打开数据库；如果数据库为空且存在旧 JSON 数据则自动迁移"""
+        conn = self._connect()
+        user_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+        if user_count == 0 and migrate_from and os.path.exists(migrate_from):
+            migrated = self.migrate_from_json(migrate_from)
+            print(f"✅ 已从 {migrate_from} 迁移 {migrated} 个用户到 {self.db_file}")
+        else:
+            print(f"✅ 已打开 SQLite 用户数据库 {self.db_file}（{user_count} 个用户）")
+
+    def save(self):
+        """兼容旧接口：每次变更都已在事务中提交，无需额外保存"""
+
+    def close(self):
+        """关闭当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ---------- 迁移 ----------
+
+    def migrate_from_json(self, json_file: str) -> int:
+        """
+        从 user_data.json 导入用户、积分和优惠券
+
+        Args:
+            json_file: 旧 JSON 数据文件
+
+        Returns:
+            int: 导入的用户数量
+        """
+        with open(json_file, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+
+        conn = self._connect()
+        with conn:
+            for user_id, user in users.items():
+                points = user.get("points", 0)
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, points) VALUES (?, ?)",
+                    (user_id, points)
+                )
+                if points:
+                    conn.execute(
+                        "INSERT INTO point_ledger (user_id, delta, reason) VALUES (?, ?, ?)",
+                        (user_id, points, f"migrated from {os.path.basename(json_file)}")
+                    )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO coupons (user_id, code, type, points_cost) VALUES (?, ?, ?, ?)",
+                    [
+                        (user_id, c["code"], c["type"], c.get("points_cost", 0))
+                        for c in user.get("coupons", [])
+                    ]
+                )
+        return len(users)
+
+    # ---------- UserState 接口 ----------
+
+    def _ensure_user(self, conn: sqlite3.Connection, user_id: str):
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+    def get_user(self, user_id):
+        """获取或创建用户（返回 {"points": ..., "coupons": [...]} 快照）"""
+        conn = self._connect()
+        with conn:
+            self._ensure_user(conn, user_id)
+        return {
+            "points": self.get_points(user_id),
+            "coupons": self.get_coupons(user_id)
+        }
+
+    def add_points(self, user_id, amount, reason=None):
+        """增加积分（同时写入流水）"""
+        conn = self._connect()
+        with conn:
+            self._ensure_user(conn, user_id)
+            conn.execute(
+                "UPDATE users SET points = points + ? WHERE user_id = ?",
+                (amount, user_id)
+            )
+            conn.execute(
+                "INSERT INTO point_ledger (user_id, delta, reason) VALUES (?, ?, ?)",
+                (user_id, amount, reason)
+            )
+            return conn.execute(
+                "SELECT points FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+
+    def deduct_points(self, user_id, amount, reason=None):
+        """扣除积分（余额不足时不修改并返回 False）"""
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE users SET points = points - ? WHERE user_id = ? AND points >= ?",
+                (amount, user_id, amount)
+            )
+            if cursor.rowcount == 0:
+                return False
+            conn.execute(
+                "INSERT INTO point_ledger (user_id, delta, reason) VALUES (?, ?, ?)",
+                (user_id, -amount, reason)
+            )
+            return True
+
+    def add_coupon(self, user_id, coupon):
+        """添加优惠券"""
+        conn = self._connect()
+        with conn:
+            self._ensure_user(conn, user_id)
+            conn.execute(
+                "INSERT INTO coupons (user_id, code, type, points_cost) VALUES (?, ?, ?, ?)",
+                (user_id, coupon["code"], coupon["type"], coupon.get("points_cost", 0))
+            )
+
+    def redeem(self, user_id, coupon_type, cost, code=None):
+        """
+        原子兑换优惠券：条件扣分、积分流水、发券在同一个事务中完成
+
+        扣分使用 "points >= cost" 条件更新，跨线程、跨进程都不会重复扣分。
+
+        Returns:
+            dict: 成功时 {"success": True, "coupon": {...}, "remaining_points": n}，
+                  积分不足时 {"success": False, "current_points": n}
+        """
+        conn = self._connect()
+        for _ in range(5):
+            coupon = {
+                "type": coupon_type,
+                "code": code or ''.join(random.choices(string.ascii_uppercase + string.digits, k=8)),
+                "points_cost": cost
+            }
+            try:
+                with conn:
+                    cursor = conn.execute(
+                        "UPDATE users SET points = points - ? WHERE user_id = ? AND points >= ?",
+                        (cost, user_id, cost)
+                    )
+                    if cursor.rowcount == 0:
+                        return {"success": False, "current_points": self.get_points(user_id)}
+
+                    conn.execute(
+                        "INSERT INTO point_ledger (user_id, delta, reason) VALUES (?, ?, ?)",
+                        (user_id, -cost, f"redeem {coupon_type}")
+                    )
+                    conn.execute(
+                        "INSERT INTO coupons (user_id, code, type, points_cost) VALUES (?, ?, ?, ?)",
+                        (user_id, coupon["code"], coupon_type, cost)
+                    )
+                    remaining = conn.execute(
+                        "SELECT points FROM users WHERE user_id = ?", (user_id,)
+                    ).fetchone()[0]
+                return {"success": True, "coupon": coupon, "remaining_points": remaining}
+            except sqlite3.IntegrityError:
+                # 券码冲突：整笔事务已回滚，换一个随机码重试
+                if code:
+                    raise
+        raise RuntimeError("无法生成唯一的优惠券代码")
+
+    def get_points(self, user_id):
+        """获取当前积分"""
+        row = self._connect().execute(
+            "SELECT points FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_coupons(self, user_id) -> List[Dict[str, Any]]:
+        """获取优惠券列表（按兑换顺序）"""
+        rows = self._connect().execute(
+            "SELECT type, code, points_cost FROM coupons WHERE user_id = ? ORDER BY id",
+            (user_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_coupon(self, code) -> Optional[Dict[str, Any]]:
+        """按券码查询优惠券（POS 核验用，走 code 唯一索引）"""
+        row = self._connect().execute(
+            "SELECT user_id, type, code, points_cost, created_at FROM coupons WHERE code = ?",
+            (code,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def reset_user(self, user_id):
+        """删除用户的全部状态（积分、流水、优惠券）"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM coupons WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM point_ledger WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    # 迁移命令：python sqlite_store.py migrate user_data.json user_data.db
+    if len(sys.argv) == 4 and sys.argv[1] == "migrate":
+        SqliteUserState(sys.argv[3]).migrate_from_json(sys.argv[2])
+        print(f"✅ 迁移完成: {sys.argv[2]} → {sys.argv[3]}")
+        sys.exit(0)
+
+    print("SQLite 用户状态存储测试\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_file = os.path.join(tmp, "user_data.json")
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "demo_user": {
+                    "points": 40,
+                    "coupons": [{"type": "咖啡券", "code": "OLDCODE1", "points_cost": 30}]
+                }
+            }, f, ensure_ascii=False)
+
+        state = SqliteUserState(os.path.join(tmp, "user_data.db"), migrate_from=json_file)
+        assert state.get_points("demo_user") == 40
+        assert state.find_coupon("OLDCODE1")["user_id"] == "demo_user"
+
+        print(f"   add_points: {state.add_points('demo_user', 10, '完成打卡任务')}")
+        print(f"   deduct_points(100): {state.deduct_points('demo_user', 100)}")
+        print(f"   deduct_points(30): {state.deduct_points('demo_user', 30)}")
+        state.add_coupon("demo_user", {"type": "餐饮券", "code": "NEWCODE1", "points_cost": 30})
+        print(f"   get_user: {state.get_user('demo_user')}")
+        print(f"   find_coupon: {state.find_coupon('NEWCODE1')}")
+
+        state.reset_user("demo_user")
+        assert state.get_points("demo_user") == 0
+        state.close()
+
+    print("\n所有测试完成！")
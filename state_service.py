@@ -0,0 +1,607 @@
+"""
+迪拜商场互动服务 Agent - 用户状态服务
+多个 Streamlit / server.py 工作进程共用一份积分与优惠券数据：
+状态服务进程独占底层存储（唯一写者），工作进程通过 Unix socket 以 JSON lines 协议访问，
+请求可流水线发送；每次变更后服务向所有连接推送失效通知，工作进程的读缓存随之失效
+
+    python state_service.py                            # 启动服务（默认 user_state.sock，wal 后端）
+    USER_STATE_BACKEND=remote streamlit run app.py     # 工作进程改用 RemoteUserState
+
+协议（每行一个 JSON 对象）：
+    请求  {"id": 1, "op": "redeem", "args": ["user_001", "Coffee voucher", 30]}
+    响应  {"id": 1, "result": {...}}  或  {"id": 1, "error": "...", "type": "ValueError"}
+    推送  {"event": "invalidate", "user_id": "user_001"}
+同一连接上的响应可能与请求顺序不同，按 id 对应。
+"""
+
+import os
+import json
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+# ==================== 默认配置 ====================
+
+DEFAULT_SOCKET = os.environ.get("USER_STATE_SOCKET", "user_state.sock")
+# 服务进程使用的底层存储（json / wal / sqlite，见 mock_data.create_user_state）；
+# 唯一写者下追加写日志最合适，json 后端每次变更都要重写整个文件
+DEFAULT_BACKEND = os.environ.get("STATE_SERVICE_BACKEND", "wal")
+# 工作进程读缓存最多保存的用户数
+DEFAULT_CACHE_SIZE = int(os.environ.get("USER_STATE_CACHE_SIZE", "10000"))
+# 等待服务响应的超时（秒）
+DEFAULT_TIMEOUT = float(os.environ.get("USER_STATE_TIMEOUT", "10"))
+
+# 只读操作与修改状态的操作（修改后推送失效通知）
+READ_OPS = {"get_user", "get_points", "get_coupons"}
+WRITE_OPS = {"add_points", "deduct_points", "add_coupon", "redeem", "reset_user"}
+
+# 每次从连接读取的字节数与单行请求的上限
+READ_CHUNK_BYTES = 64 * 1024
+MAX_LINE_BYTES = 1024 * 1024
+
+
+class StateServiceError(RuntimeError):
+    """状态服务执行请求时出错（错误类型与信息来自服务端）"""
+
+
+# ==================== 服务端 ====================
+
+class StateService:
+    """
+    用户状态服务（底层存储的唯一写者）
+
+    所有请求（包括读取）都在同一个写线程中按到达顺序执行，底层存储不会被并发修改，
+    事件循环只负责收发；一个连接可以连续发送多个请求而不必等待响应。
+    每批请求执行完后，先向所有连接推送被修改用户的失效通知，再返回响应，
+    因此发起修改的工作进程收到响应时，自己的缓存已经失效（读己之写）。
+    """
+
+    def __init__(self, state: Any, socket_path: str = DEFAULT_SOCKET):
+        """
+        Args:
+            state: 底层用户状态存储（接口与 mock_data.UserState 一致）
+            socket_path: Unix socket 路径
+        """
+        self.state = state
+        self.socket_path = socket_path
+        self.stats = {"requests": 0, "writes": 0, "errors": 0, "notifications": 0, "connections": 0}
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 生命周期 ----------
+
+    async def start(self) -> "StateService":
+        self._remove_stale_socket()
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_unix_server(self._handle_connection, self.socket_path)
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._executor.shutdown(wait=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def start_in_thread(self) -> "StateService":
+        """在后台线程的事件循环中启动（测试与基准测试用），stop() 停止"""
+        loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=loop.run_forever, name="state-service", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), loop).result()
+        return self
+
+    def stop(self):
+        loop = self._loop
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.close(), loop).result()
+        if self._thread is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            loop.close()
+            self._thread = None
+
+    def _remove_stale_socket(self):
+        """删除上次异常退出留下的 socket 文件；如果已有服务在监听则报错"""
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.unlink(self.socket_path)
+        else:
+            raise RuntimeError(f"状态服务已在运行: {self.socket_path}")
+        finally:
+            probe.close()
+
+    # ---------- 请求处理 ----------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        self.stats["connections"] += 1
+        partial = b""
+        try:
+            while True:
+                chunk = await reader.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                # 一次读到的所有完整请求作为一批交给写线程（流水线请求只需一次线程切换和一次写入）
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                if len(partial) > MAX_LINE_BYTES:
+                    break
+                if lines:
+                    future = self._loop.run_in_executor(self._executor, self._execute_batch, lines)
+                    future.add_done_callback(lambda f, w=writer: self._respond(w, f))
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _execute_batch(self, lines: List[bytes]) -> Tuple[bytes, List[str]]:
+        """
+        在写线程中按顺序执行一批请求，返回 (全部响应行, 被修改的用户 ID)
+
+        响应也在写线程中序列化，序列化时存储中的字典不会被其他请求修改。
+        """
+        responses = []
+        changed: List[str] = []
+        for line in lines:
+            if not line.strip():
+                continue
+            response, user_id = self._execute(line)
+            responses.append(response)
+            if user_id is not None:
+                changed.append(user_id)
+        return b"".join(responses), changed
+
+    def _execute(self, line: bytes) -> Tuple[bytes, Optional[str]]:
+        """执行一个请求，返回 (响应行, 被修改的用户 ID)"""
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            op = request["op"]
+            args = request.get("args", [])
+            if op == "ping":
+                result = "pong"
+            elif op in READ_OPS or op in WRITE_OPS:
+                result = getattr(self.state, op)(*args)
+            else:
+                raise ValueError(f"未知的操作: {op}")
+        except Exception as e:
+            self.stats["errors"] += 1
+            response = {"id": request_id, "error": str(e), "type": type(e).__name__}
+            return json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n", None
+
+        self.stats["requests"] += 1
+        changed = None
+        if op in WRITE_OPS:
+            self.stats["writes"] += 1
+            changed = args[0]
+        response = {"id": request_id, "result": result}
+        return json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n", changed
+
+    def _respond(self, writer: asyncio.StreamWriter, future: "asyncio.Future"):
+        responses, changed = future.result()
+        if changed:
+            notifications = b"".join(
+                json.dumps({"event": "invalidate", "user_id": user_id}, ensure_ascii=False).encode("utf-8") + b"\n"
+                for user_id in dict.fromkeys(changed)
+            )
+            for connection in self._connections:
+                if not connection.is_closing():
+                    connection.write(notifications)
+            self.stats["notifications"] += len(self._connections) * len(set(changed))
+        if not writer.is_closing():
+            writer.write(responses)
+
+
+# ==================== 客户端 ====================
+
+class RemoteUserState:
+    """
+    状态服务的客户端（接口与 mock_data.UserState 一致，线程安全）
+
+    - 所有线程共用一条连接：请求带 id 发送后不等待前一个响应，后台读线程按 id 分发响应
+    - 读缓存：get_user / get_points / get_coupons 命中时不访问服务；
+      收到失效通知时删除该用户，读取途中收到通知的结果不写入缓存（避免缓存旧值）
+    - 连接断开时清空缓存（断开期间的通知已丢失），下次调用时自动重连
+    第一次调用时才连接，导入 mock_data 时服务不必已经启动。
+    """
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        timeout: float = DEFAULT_TIMEOUT
+    ):
+        self.socket_path = socket_path
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._sock: Optional[socket.socket] = None
+        self._reader: Optional[threading.Thread] = None
+        self._connect_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._fetching: Dict[str, int] = {}
+        self._stale: Set[str] = set()
+        self.stats = {"requests": 0, "cache_hits": 0, "cache_misses": 0, "invalidations": 0, "reconnects": 0}
+
+    # ---------- 连接 ----------
+
+    def _connect(self) -> socket.socket:
+        with self._connect_lock:
+            if self._sock is not None:
+                return self._sock
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                sock.close()
+                raise ConnectionError(
+                    f"无法连接用户状态服务 {self.socket_path}（先运行 python state_service.py）: {e}"
+                ) from e
+            with self._cache_lock:
+                self._cache.clear()
+            self._sock = sock
+            self._reader = threading.Thread(target=self._read_loop, args=(sock,), name="state-client", daemon=True)
+            self._reader.start()
+            self.stats["reconnects"] += 1
+            return sock
+
+    def _read_loop(self, sock: socket.socket):
+        """后台读线程：分发响应、处理失效通知"""
+        error: Exception = ConnectionError("用户状态服务连接已断开")
+        try:
+            with sock.makefile("rb") as stream:
+                for line in stream:
+                    message = json.loads(line)
+                    if "event" in message:
+                        if message["event"] == "invalidate":
+                            self._invalidate(message["user_id"])
+                        continue
+                    future = self._pending.pop(message.get("id"), None)
+                    if future is None:
+                        continue
+                    if "error" in message:
+                        future.set_exception(StateServiceError(f"{message.get('type')}: {message['error']}"))
+                    else:
+                        future.set_result(message.get("result"))
+        except (OSError, ValueError) as e:
+            error = ConnectionError(f"用户状态服务连接已断开: {e}")
+        finally:
+            with self._connect_lock:
+                if self._sock is sock:
+                    self._sock = None
+            with self._cache_lock:
+                self._cache.clear()
+            for request_id in list(self._pending):
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(error)
+
+    def close(self):
+        """关闭连接（数据由服务端保存）"""
+        with self._connect_lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self._reader is not None:
+            self._reader.join(timeout=1)
+            self._reader = None
+
+    # ---------- 请求 ----------
+
+    def submit(self, op: str, *args) -> Future:
+        """
+        发送一个请求，不等待响应（多个请求可以连续发送，流水线执行）
+
+        Returns:
+            Future: 结果；服务端出错时为 StateServiceError，连接断开时为 ConnectionError
+        """
+        sock = self._connect()
+        request_id = next(self._ids)
+        future: Future = Future()
+        self._pending[request_id] = future
+        line = json.dumps({"id": request_id, "op": op, "args": list(args)}, ensure_ascii=False).encode("utf-8")
+        try:
+            with self._send_lock:
+                sock.sendall(line + b"\n")
+        except OSError as e:
+            self._pending.pop(request_id, None)
+            raise ConnectionError(f"发送到用户状态服务失败: {e}") from e
+        self.stats["requests"] += 1
+        return future
+
+    def call(self, op: str, *args) -> Any:
+        """发送请求并等待结果"""
+        return self.submit(op, *args).result(self.timeout)
+
+    def ping(self) -> float:
+        """往返延迟（秒）"""
+        started = time.perf_counter()
+        self.call("ping")
+        return time.perf_counter() - started
+
+    # ---------- 读缓存 ----------
+
+    def _invalidate(self, user_id: str):
+        with self._cache_lock:
+            self._cache.pop(user_id, None)
+            if user_id in self._fetching:
+                self._stale.add(user_id)
+            self.stats["invalidations"] += 1
+
+    def _cached_user(self, user_id: str) -> Dict[str, Any]:
+        with self._cache_lock:
+            user = self._cache.get(user_id)
+            if user is not None:
+                self._cache.move_to_end(user_id)
+                self.stats["cache_hits"] += 1
+                return user
+            self.stats["cache_misses"] += 1
+            self._fetching[user_id] = self._fetching.get(user_id, 0) + 1
+
+        user = None
+        try:
+            user = self.call("get_user", user_id)
+        finally:
+            # 失效检查、写入缓存和 _fetching 计数递减在同一临界区内完成，
+            # 否则两段锁之间到达的失效通知会被后写入的旧数据覆盖
+            with self._cache_lock:
+                if user is not None and user_id not in self._stale and self.cache_size > 0:
+                    self._cache[user_id] = user
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                self._fetching[user_id] -= 1
+                if not self._fetching[user_id]:
+                    del self._fetching[user_id]
+                    self._stale.discard(user_id)
+        return user
+
+    def snapshot(self) -> Dict[str, Any]:
+        """请求数、缓存命中率等统计"""
+        with self._cache_lock:
+            stats = dict(self.stats)
+            stats["cached_users"] = len(self._cache)
+        lookups = stats["cache_hits"] + stats["cache_misses"]
+        stats["cache_hit_rate"] = round(stats["cache_hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    # ---------- UserState 接口 ----------
+
+    def load(self):
+        """兼容旧接口：数据由服务端加载"""
+
+    def save(self):
+        """兼容旧接口：每次变更都由服务端保存"""
+
+    def get_user(self, user_id):
+        """获取或创建用户（返回缓存中的字典，只读）"""
+        return self._cached_user(user_id)
+
+    def add_points(self, user_id, amount):
+        return self.call("add_points", user_id, amount)
+
+    def deduct_points(self, user_id, amount):
+        return self.call("deduct_points", user_id, amount)
+
+    def add_coupon(self, user_id, coupon):
+        self.call("add_coupon", user_id, coupon)
+
+    def redeem(self, user_id, coupon_type, cost, code=None):
+        """原子兑换优惠券（在服务端的写线程中完成检查、扣分和发券）"""
+        return self.call("redeem", user_id, coupon_type, cost, code)
+
+    def get_points(self, user_id):
+        return self._cached_user(user_id)["points"]
+
+    def get_coupons(self, user_id) -> List[Dict[str, Any]]:
+        return self._cached_user(user_id)["coupons"]
+
+    def reset_user(self, user_id):
+        self.call("reset_user", user_id)
+
+
+# ==================== 启动 ====================
+
+def main(argv: Optional[List[str]] = None):
+    from mock_data import create_user_state
+
+    parser = argparse.ArgumentParser(description="Concierge 用户状态服务（唯一写者）")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket 路径")
+    parser.add_argument("--backend", default=DEFAULT_BACKEND, choices=("json", "wal", "sqlite"), help="底层存储")
+    parser.add_argument("--data-file", default="user_data.json", help="数据文件（sqlite 后端使用同名 .db 文件）")
+    args = parser.parse_args(argv)
+
+    state = create_user_state(args.backend, args.data_file)
+    service = StateService(state, args.socket)
+
+    async def serve():
+        # SIGTERM / Ctrl+C 时正常退出，底层存储在 finally 中落盘关闭
+        task = asyncio.current_task()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, task.cancel)
+        await service.start()
+        print(f"🗄️ 用户状态服务已启动: {args.socket}（{args.backend} 后端）")
+        try:
+            await service.serve_forever()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("\n👋 用户状态服务已停止")
+    finally:
+        if hasattr(state, "close"):
+            state.close()
+
+
+# ==================== 测试代码 ====================
+
+def _worker(socket_path: str, worker: int, rounds: int, results):
+    """多进程测试的工作进程：交替加分与兑换，每次变更后读取若干次（如侧边栏刷新）"""
+    state = RemoteUserState(socket_path)
+    redeemed = 0
+    for _ in range(rounds):
+        state.add_points("shared_user", 3)
+        if state.redeem("shared_user", f"worker {worker} voucher", 5)["success"]:
+            redeemed += 1
+        for _ in range(5):
+            state.get_points("shared_user")
+            state.get_coupons(f"worker_{worker}")
+    results.put((worker, redeemed, state.snapshot()))
+    state.close()
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+    import multiprocessing
+
+    if len(sys.argv) > 1:
+        main()
+        sys.exit()
+
+    import mock_data
+
+    print("用户状态服务测试\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, "state.sock")
+        data_file = os.path.join(tmp, "user_data.json")
+        backing = mock_data.create_user_state("wal", data_file)
+        service = StateService(backing, socket_path).start_in_thread()
+
+        # 读己之写、其他客户端的修改使缓存失效
+        a, b = RemoteUserState(socket_path), RemoteUserState(socket_path)
+        a.add_points("alice", 100)
+        assert a.get_points("alice") == 100 and b.get_points("alice") == 100
+        assert a.get_points("alice") == 100  # 命中缓存
+        b.redeem("alice", "Coffee voucher", 30)
+        deadline = time.time() + 1
+        while a.get_points("alice") != 70 and time.time() < deadline:
+            time.sleep(0.001)
+        assert a.get_points("alice") == 70 and len(a.get_coupons("alice")) == 1
+        print(f"   ✅ 失效通知: 另一个客户端兑换后积分 100 → {a.get_points('alice')}")
+
+        # 读取返回后、写入缓存前到达的失效通知：旧数据不能留在缓存中
+        class RacingLock:
+            """读取返回后第一次释放缓存锁时投递一条失效通知（模拟通知线程在两段锁之间抢到锁）"""
+
+            def __init__(self, lock):
+                self.lock, self.armed = lock, False
+
+            def __enter__(self):
+                self.lock.__enter__()
+
+            def __exit__(self, *exc):
+                self.lock.__exit__(*exc)
+                if self.armed:
+                    self.armed = False
+                    a._invalidate("alice")
+
+        call, lock = a.call, a._cache_lock
+        racing = RacingLock(lock)
+
+        def racing_call(op, *args):
+            result = call(op, *args)
+            racing.armed = op == "get_user"
+            return result
+
+        a._invalidate("alice")
+        a.call, a._cache_lock = racing_call, racing
+        a.get_points("alice")
+        a.call, a._cache_lock = call, lock
+        assert "alice" not in a._cache and not a._fetching and not a._stale
+        print("   ✅ 读取期间的失效通知不会被旧数据覆盖")
+
+        try:
+            a.call("drop_table", "users")
+        except StateServiceError as e:
+            print(f"   ✅ 未知操作被拒绝: {e}")
+        else:
+            raise AssertionError("未知操作应被拒绝")
+
+        # 延迟：缓存命中的读取、单次往返、流水线写入
+        started = time.perf_counter()
+        for _ in range(10000):
+            a.get_points("alice")
+        cached_us = (time.perf_counter() - started) / 10000 * 1e6
+        rtt_us = min(a.ping() for _ in range(200)) * 1e6
+        started = time.perf_counter()
+        futures = [a.submit("add_points", "bob", 1) for _ in range(2000)]
+        assert [f.result() for f in futures] == list(range(1, 2001)), "同一连接的写入应按发送顺序执行"
+        pipelined_us = (time.perf_counter() - started) / 2000 * 1e6
+        print(f"   缓存读取 {cached_us:.2f} µs，单次往返 {rtt_us:.0f} µs，流水线写入 {pipelined_us:.1f} µs/次")
+
+        # 多线程并发兑换（与 mock_data 中各后端相同的压力测试）
+        stats = mock_data.stress_test_redeem(lambda: RemoteUserState(socket_path))
+        print(f"   多线程: 成功兑换 {stats['redeemed']} 次，最终积分 {stats['final_points']} ✅")
+
+        # 多进程：积分与优惠券在所有进程间保持一致
+        workers, rounds = 4, 200
+        a.add_points("shared_user", 50)
+        # spawn：子进程不继承服务线程和底层存储（fork 会连同后者的 atexit 压缩一起复制）
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=_worker, args=(socket_path, i, rounds, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+        redeemed = sum(outcome[1] for outcome in outcomes)
+        expected = 50 + workers * rounds * 3 - redeemed * 5
+        points, coupons = b.get_points("shared_user"), len(b.get_coupons("shared_user"))
+        assert points == expected, f"积分不一致: {points} != {expected}"
+        assert coupons == redeemed, f"优惠券数量不一致: {coupons} != {redeemed}"
+        print(f"   多进程（{workers} 个）: 成功兑换 {redeemed} 次，最终积分 {points} ✅")
+        print(f"   工作进程缓存命中率: {[outcome[2]['cache_hit_rate'] for outcome in outcomes]}")
+
+        a.close()
+        b.close()
+        service.stop()
+        backing.close()
+
+        # 服务重启后数据仍在（底层存储已持久化）
+        backing = mock_data.create_user_state("wal", data_file)
+        assert backing.get_points("shared_user") == expected
+        backing.close()
+
+    print("\n✅ 用户状态服务测试通过")
@@ -0,0 +1,416 @@
+"""
+迪拜商场互动服务 Agent - 本地 OpenAI 兼容桩服务器
+用于在无网络、无 API Key 的情况下测试客户端连接池和 Agent 循环
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+
+
+# ==================== 响应构造 ====================
+
+def make_completion(
+    reply: Dict[str, Any],
+    model: str = "deepseek-chat",
+    usage: Optional[Dict[str, int]] = None
+) -> Dict[str, Any]:
+    """
+    根据脚本条目构造 chat.completion 响应
+
+    Args:
+        reply: {"content": "..."} 或 {"tool_calls": [{"name": ..., "arguments": {...}}]}
+        model: 回显的模型名称
+        usage: token 用量（默认全 0）
+
+    Returns:
+        dict: OpenAI 格式的 chat.completion 响应体
+    """
+    message: Dict[str, Any] = {"role": "assistant", "content": reply.get("content")}
+    finish_reason = "stop"
+
+    if reply.get("tool_calls"):
+        message["tool_calls"] = [
+            {
+                "id": tc.get("id", f"call_{i}"),
+                "type": "function",
+                "function": {
+                    "name": tc["name"],
+                    "arguments": json.dumps(tc.get("arguments", {}), ensure_ascii=False)
+                }
+            } for i, tc in enumerate(reply["tool_calls"])
+        ]
+        finish_reason = "tool_calls"
+
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+
+def make_stream_chunks(
+    reply: Dict[str, Any],
+    model: str = "deepseek-chat",
+    chunk_size: int = 4,
+    usage: Optional[Dict[str, int]] = None
+) -> List[Dict[str, Any]]:
+    """
+    将脚本条目拆分为 chat.completion.chunk 流式片段
+
+    文本按 chunk_size 个字符切分；工具调用的 arguments 也被切成多个片段，
+    以模拟真实 API 中 tool_calls 分片到达的情况。
+    给出 usage 时（请求带 stream_options.include_usage）末尾追加一个 choices 为空的用量片段。
+    """
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict[str, Any]:
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+
+    chunks = [chunk({"role": "assistant", "content": ""})]
+
+    content = reply.get("content") or ""
+    for start in range(0, len(content), chunk_size):
+        chunks.append(chunk({"content": content[start:start + chunk_size]}))
+
+    finish_reason = "stop"
+    for i, tc in enumerate(reply.get("tool_calls") or []):
+        arguments = json.dumps(tc.get("arguments", {}), ensure_ascii=False)
+        chunks.append(chunk({"tool_calls": [{
+            "index": i,
+            "id": tc.get("id", f"call_{i}"),
+            "type": "function",
+            "function": {"name": tc["name"], "arguments": ""}
+        }]}))
+        for start in range(0, len(arguments), chunk_size):
+            chunks.append(chunk({"tool_calls": [{
+                "index": i,
+                "function": {"arguments": arguments[start:start + chunk_size]}
+            }]}))
+        finish_reason = "tool_calls"
+
+    chunks.append(chunk({}, finish_reason))
+
+    if usage is not None:
+        usage_chunk = chunk({})
+        usage_chunk["choices"] = []
+        usage_chunk["usage"] = usage
+        chunks.append(usage_chunk)
+    return chunks
+
+
+def echo_reply(body: Dict[str, Any]) -> Dict[str, Any]:
+    """默认响应：回显最后一条用户消息"""
+    for message in reversed(body.get("messages", [])):
+        if message.get("role") == "user":
+            return {"content": f"echo: {message.get('content', '')}"}
+    return {"content": "echo"}
+
+
+class PrefixCacheSimulator:
+    """
+    模拟 DeepSeek 的前缀缓存（上下文硬盘缓存）
+
+    请求按 tools + messages 的序列化结果计算 token（约 4 字节 1 个 token）；
+    与最近 history_size 个请求的最长公共前缀按 unit 个 token 为单位计为缓存命中。
+    """
+
+    def __init__(self, unit: int = 64, history_size: int = 64):
+        self.unit = unit
+        self._prompts: deque = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def serialize(body: Dict[str, Any]) -> str:
+        # 保持客户端发送时的键顺序：键顺序不同即视为前缀不同
+        return json.dumps(body.get("tools") or [], ensure_ascii=False) + "".join(
+            json.dumps(m, ensure_ascii=False) for m in body.get("messages", [])
+        )
+
+    @staticmethod
+    def common_prefix(a: bytes, b: bytes) -> int:
+        """最长公共前缀的字节数（二分查找，切片比较在 C 层完成，比逐字节比较快得多）"""
+        low, high = 0, min(len(a), len(b))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if a[:mid] == b[:mid]:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def usage(self, body: Dict[str, Any], completion_tokens: int = 0) -> Dict[str, int]:
+        prompt = self.serialize(body).encode("utf-8")
+        with self._lock:
+            recent = list(self._prompts)
+            self._prompts.append(prompt)
+        # 在锁外比较，并发请求互不阻塞
+        common = max((self.common_prefix(prompt, p) for p in recent), default=0)
+
+        prompt_tokens = len(prompt) // 4 + 1
+        hit = min(common // 4 // self.unit * self.unit, prompt_tokens)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_cache_hit_tokens": hit,
+            "prompt_cache_miss_tokens": prompt_tokens - hit
+        }
+
+
+# ==================== 故障注入 ====================
+
+class FaultInjector:
+    """
+    为桩服务器注入故障（先按脚本依次注入，脚本用尽后按概率注入）
+
+    故障条目：
+        {"error": 503}                  - 返回该状态码（429/503 可附带 "retry_after": 秒）
+        {"drop": True}                  - 不返回响应直接断开连接
+        {"delay": 2.0}                  - 取回复之前等待（模拟上游变慢）
+        {"stall": 1.0}                  - 流式响应发出首个片段后停顿
+    """
+
+    def __init__(
+        self,
+        script: Optional[List[Dict[str, Any]]] = None,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        drop_rate: float = 0.0,
+        delay_rate: float = 0.0,
+        delay: float = 1.0,
+        seed: Optional[int] = None
+    ):
+        self.script = deque(script or [])
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.delay_rate = delay_rate
+        self.delay = delay
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next_fault(self) -> Optional[Dict[str, Any]]:
+        """本次请求要注入的故障（None 表示正常响应）"""
+        with self._lock:
+            if self.script:
+                return self.script.popleft() or None
+            roll = self._random.random()
+        if roll < self.error_rate:
+            return {"error": self.error_status}
+        roll -= self.error_rate
+        if roll < self.drop_rate:
+            return {"drop": True}
+        roll -= self.drop_rate
+        if roll < self.delay_rate:
+            return {"delay": self.delay}
+        return None
+
+
+# ==================== 桩服务器 ====================
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    """监听队列更长、且忽略客户端主动断开（取消请求）的 HTTP 服务器"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubLLMServer:
+    """
+    本地 OpenAI 兼容桩服务器（/chat/completions）
+
+    支持 HTTP/1.1 keep-alive，并统计请求数和 TCP 连接数，
+    便于验证客户端是否复用连接。可作为上下文管理器使用。
+    """
+
+    def __init__(
+        self,
+        script: Optional[List[Dict[str, Any]]] = None,
+        responder: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        latency: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        faults: Optional[FaultInjector] = None
+    ):
+        """
+        Args:
+            script: 依次返回的响应脚本，用尽后回落到 responder
+            responder: 根据请求体生成响应的函数（默认回显）
+            latency: 每个请求的人为延迟（秒，流式请求为首个片段前的延迟）
+            host: 监听地址
+            port: 监听端口（0 表示随机端口）
+            faults: 故障注入器（注入了错误/断开的请求不消耗脚本条目）
+        """
+        self.script = list(script or [])
+        self.responder = responder or echo_reply
+        self.latency = latency
+        self.faults = faults
+        self.fault_count = 0
+        self.requests: List[Dict[str, Any]] = []
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self._script_iter = iter(self.script)
+        self.prefix_cache = PrefixCacheSimulator()
+        self._httpd = _QuietHTTPServer((host, port), self._make_handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def request_count(self) -> int:
+        with self._lock:
+            return len(self.requests)
+
+    def next_reply(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """取下一条脚本响应（脚本用尽后调用 responder）"""
+        with self._lock:
+            self.requests.append(body)
+            reply = next(self._script_iter, None)
+        return reply if reply is not None else self.responder(body)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 响应头与响应体分两次写出：关闭 Nagle 算法，避免与客户端的延迟 ACK 叠加出约 40 ms 的停顿
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connection_count += 1
+
+            def log_message(self, format, *args):
+                pass  # 保持测试输出安静
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+                    return
+
+                fault = server.faults.next_fault() if server.faults is not None else None
+                if fault is not None:
+                    with server._lock:
+                        server.fault_count += 1
+                    if fault.get("drop"):
+                        self.close_connection = True
+                        return
+                    if fault.get("error"):
+                        headers = {"Retry-After": str(fault["retry_after"])} if "retry_after" in fault else {}
+                        self._send_json(fault["error"], {"error": {
+                            "message": "injected fault", "type": "server_error", "code": fault["error"]
+                        }}, headers)
+                        return
+                    if fault.get("delay"):
+                        time.sleep(fault["delay"])
+
+                reply = server.next_reply(body)
+                if server.latency:
+                    time.sleep(server.latency)
+
+                model = body.get("model", "deepseek-chat")
+                usage = server.prefix_cache.usage(body, len(reply.get("content") or "") // 4)
+                if body.get("stream"):
+                    include_usage = (body.get("stream_options") or {}).get("include_usage")
+                    self._send_stream(
+                        make_stream_chunks(reply, model, usage=usage if include_usage else None),
+                        stall=(fault or {}).get("stall", 0.0)
+                    )
+                else:
+                    self._send_json(200, make_completion(reply, model, usage))
+
+            def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, chunks: List[Dict[str, Any]], stall: float = 0.0):
+                # Server-Sent Events，使用 chunked 编码以保持连接可复用
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [f"data: {json.dumps(c, ensure_ascii=False)}\n\n" for c in chunks]
+                events.append("data: [DONE]\n\n")
+                for i, event in enumerate(events):
+                    data = event.encode("utf-8")
+                    self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                    if i == 0 and stall:
+                        time.sleep(stall)
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+    def start(self) -> "StubLLMServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "StubLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    # 可选的故障注入：STUB_ERROR_RATE / STUB_DROP_RATE / STUB_DELAY_RATE / STUB_DELAY
+    faults = None
+    if any(os.environ.get(name) for name in ("STUB_ERROR_RATE", "STUB_DROP_RATE", "STUB_DELAY_RATE")):
+        faults = FaultInjector(
+            error_rate=float(os.environ.get("STUB_ERROR_RATE", "0")),
+            drop_rate=float(os.environ.get("STUB_DROP_RATE", "0")),
+            delay_rate=float(os.environ.get("STUB_DELAY_RATE", "0")),
+            delay=float(os.environ.get("STUB_DELAY", "2"))
+        )
+    server = StubLLMServer(port=port, faults=faults).start()
+    print(f"🧪 桩服务器已启动: {server.base_url}")
+    print(f"   export DEEPSEEK_BASE_URL={server.base_url}")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        print("\n👋 桩服务器已停止")
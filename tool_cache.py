@@ -0,0 +1,198 @@
+"""
+迪拜商场互动服务 Agent - 工具结果缓存
+只读工具（店铺查询、车位查询等）按 (工具, 规范化参数) 缓存结果：每个工具各自的 TTL、
+总条目数上限（LRU），并提供显式失效接口（例如收到闸机事件时使对应车牌的结果失效）
+"""
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+# ==================== 默认配置 ====================
+
+# 缓存条目总数上限（0 表示关闭缓存）
+DEFAULT_MAX_ENTRIES = int(os.environ.get("TOOL_CACHE_SIZE", "4096"))
+
+
+# ==================== 参数规范化 ====================
+
+def _normalize_value(value: Any) -> Any:
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    if isinstance(value, dict):
+        return {k: _normalize_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize_value(v) for v in value]
+    return value
+
+
+def normalize_args(args: Dict[str, Any]) -> str:
+    """
+    默认的参数规范化：键排序、字符串忽略大小写与多余空白
+
+    例如 {"shop_name": "  hermès "} 与 {"shop_name": "Hermès"} 得到相同的键。
+    """
+    return json.dumps(_normalize_value(args), ensure_ascii=False, sort_keys=True)
+
+
+# ==================== 工具结果缓存 ====================
+
+class ToolResultCache:
+    """
+    工具结果缓存（线程安全）
+
+    - 键：(工具名, 规范化参数)，值为序列化后的工具结果（字符串，不会被调用方修改）
+    - 每条带过期时间（TTL 由调用方按工具给出），总条目数超过 max_entries 时淘汰最久未使用的
+    - invalidate(tool, key) 使单条失效，invalidate(tool) 使该工具全部失效
+
+    每个工具有一个失效代数：调用开始前取 generation(tool)，结果写入时代数已变化
+    （执行期间发生了失效）则丢弃，避免把失效前读到的旧结果写回缓存。
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[str, float]]" = OrderedDict()
+        self._by_tool: Dict[str, set] = defaultdict(set)
+        self._generations: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "stale_stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ---------- 查询 / 写入 ----------
+
+    def get(self, tool: str, key: Hashable) -> Optional[str]:
+        """查找缓存的结果（未命中或已过期时返回 None）"""
+        with self._lock:
+            entry = self._entries.get((tool, key))
+            if entry is not None and entry[1] <= time.monotonic():
+                self._remove_locked((tool, key))
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end((tool, key))
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def generation(self, tool: str) -> int:
+        """该工具当前的失效代数（在执行工具之前读取）"""
+        with self._lock:
+            return self._generations[tool]
+
+    def put(self, tool: str, key: Hashable, value: str, ttl: float, generation: Optional[int] = None):
+        """写入结果；generation 与当前代数不一致时丢弃"""
+        if not self.enabled or ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generations[tool]:
+                self.stats["stale_stores"] += 1
+                return
+            self._remove_locked((tool, key))
+            self._entries[(tool, key)] = (value, time.monotonic() + ttl)
+            self._by_tool[tool].add(key)
+            self.stats["stores"] += 1
+
+            while len(self._entries) > self.max_entries:
+                self._remove_locked(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def _remove_locked(self, full_key: Tuple[str, Hashable]):
+        if self._entries.pop(full_key, None) is None:
+            return
+        tool, key = full_key
+        keys = self._by_tool.get(tool)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_tool[tool]
+
+    # ---------- 失效 ----------
+
+    def invalidate(self, tool: str, key: Hashable = None):
+        """使某个工具的单条结果（给出 key）或全部结果（key 为 None）失效"""
+        with self._lock:
+            self._generations[tool] += 1
+            if key is None:
+                keys = list(self._by_tool.get(tool, ()))
+            else:
+                keys = [key] if key in self._by_tool.get(tool, ()) else []
+            for k in keys:
+                self._remove_locked((tool, k))
+            self.stats["invalidations"] += len(keys)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            for tool in list(self._generations):
+                self._generations[tool] += 1
+            self._entries.clear()
+            self._by_tool.clear()
+
+    # ---------- 统计 ----------
+
+    def snapshot(self) -> Dict[str, Any]:
+        """命中率等统计"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    print("工具结果缓存测试\n")
+
+    cache = ToolResultCache(max_entries=3)
+    key = normalize_args({"shop_name": "  Hermès "})
+    assert key == normalize_args({"shop_name": "hermès"})
+
+    cache.put("get_shop_info", key, '{"success": true}', ttl=0.3)
+    assert cache.get("get_shop_info", key) == '{"success": true}'
+    assert cache.get("find_parking", key) is None
+
+    # TTL
+    time.sleep(0.35)
+    assert cache.get("get_shop_info", key) is None
+
+    # LRU
+    for i in range(4):
+        cache.put("get_shop_info", i, str(i), ttl=60)
+    assert cache.get("get_shop_info", 0) is None and cache.get("get_shop_info", 3) == "3"
+
+    # 单条 / 整个工具失效
+    cache.put("find_parking", ("DXB", "1234"), "B2-A05", ttl=60)
+    cache.invalidate("find_parking", ("DXB", "1234"))
+    assert cache.get("find_parking", ("DXB", "1234")) is None
+    cache.invalidate("get_shop_info")
+    assert cache.get("get_shop_info", 3) is None
+
+    # 执行期间发生失效：旧结果不写回
+    generation = cache.generation("find_parking")
+    cache.invalidate("find_parking", ("DXB", "1234"))
+    cache.put("find_parking", ("DXB", "1234"), "B2-A05", ttl=60, generation=generation)
+    assert cache.get("find_parking", ("DXB", "1234")) is None
+
+    print(f"   统计: {cache.snapshot()}")
+    print("\n所有测试完成！")
@@ -0,0 +1,375 @@
+"""
+迪拜商场互动服务 Agent - 请求追踪与指标
+每轮对话、每次 LLM 调用、每次工具执行各记录一个结构化 span（耗时、token 用量、迭代次数等），
+导出到本地 JSONL 文件（后台线程写入，不阻塞请求）或进程内 Prometheus 文本格式的 /metrics 端点；
+并提供关闭热路径调试输出的开关
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import asyncio
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# ==================== 默认配置 ====================
+
+# 热路径调试输出（用户输入、工具参数与结果等）；AGENT_DEBUG=0 时全部关闭
+DEBUG = os.environ.get("AGENT_DEBUG", "1") != "0"
+
+# span 导出：JSONL 文件路径 / Prometheus 指标端口（为空表示不导出）
+TRACE_FILE = os.environ.get("TRACE_FILE", "")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0") or 0)
+
+# 耗时直方图的桶（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# ==================== 调试输出 ====================
+
+def set_debug(enabled: bool):
+    """运行时打开/关闭调试输出"""
+    global DEBUG
+    DEBUG = enabled
+
+
+def debug_enabled() -> bool:
+    """调试输出是否打开（格式化开销大的输出先检查这个）"""
+    return DEBUG
+
+
+def debug(*args: Any, **kwargs: Any):
+    """仅在调试输出打开时 print"""
+    if DEBUG:
+        print(*args, **kwargs)
+
+
+# ==================== Span ====================
+
+class Span:
+    """一次操作的结构化记录"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "_started", "duration",
+                 "status", "error", "attrs")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.attrs: Dict[str, Any] = dict(attrs or {})
+
+    def set(self, **attrs: Any) -> "Span":
+        """设置属性（例如 token 用量、finish_reason）"""
+        self.attrs.update(attrs)
+        return self
+
+    def elapsed_ms(self) -> float:
+        """从开始到现在的毫秒数（例如流式首个 token 的延迟）"""
+        return round((time.perf_counter() - self._started) * 1000, 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+            "error": self.error,
+            "attrs": self.attrs
+        }
+
+
+class Tracer:
+    """
+    span 的创建与导出
+
+    父子关系显式传入（parent=...），而不是依赖 contextvars：同步流式封装每一步都在新任务中运行，
+    隐式上下文无法跨步骤保持。没有导出器时 span 只做计时，开销很小。
+    """
+
+    def __init__(self, exporters: Optional[List[Any]] = None):
+        self.exporters: List[Any] = list(exporters or [])
+
+    def add_exporter(self, exporter: Any):
+        self.exporters.append(exporter)
+
+    def start(self, name: str, parent: Optional[Span] = None, **attrs: Any) -> Span:
+        return Span(name, parent, attrs)
+
+    def finish(self, span: Span, error: Optional[BaseException] = None):
+        """结束 span 并导出；error 为 CancelledError / GeneratorExit 时状态记为 cancelled"""
+        span.duration = time.perf_counter() - span._started
+        if error is not None:
+            if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+                span.status = "cancelled"
+            else:
+                span.status = "error"
+                span.error = f"{type(error).__name__}: {error}"
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                print(f"⚠️ span 导出失败: {e}")
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attrs: Any) -> Iterator[Span]:
+        """with TRACER.span("llm_call", parent=turn) as span: ..."""
+        span = self.start(name, parent, **attrs)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span, e)
+            raise
+        self.finish(span)
+
+
+# ==================== JSONL 导出 ====================
+
+class JsonlExporter:
+    """把 span 逐行写入 JSONL 文件（后台线程批量写入，请求线程只入队）"""
+
+    def __init__(self, path: str, flush_interval: float = 0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue: "queue.SimpleQueue[Optional[Dict[str, Any]]]" = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def export(self, span: Span):
+        self._queue.put(span.to_dict())
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self._queue.get()
+                batch = [record]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch if r is not None))
+                f.flush()
+                if stop:
+                    return
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """写完队列中剩余的 span"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+# ==================== Prometheus 指标 ====================
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class PrometheusExporter:
+    """
+    把 span 聚合为 Prometheus 指标（线程安全），render() 输出文本格式
+
+    - concierge_span_duration_seconds{span}       各类 span 的耗时直方图
+    - concierge_spans_total{span,status}           span 数（ok / error / cancelled）
+    - concierge_llm_tokens_total{model,type}       prompt / completion / cached token 数
+    - concierge_tool_calls_total{tool,cached}      工具调用数
+    - concierge_turns_total{path}                  对话轮数（llm / fast_path / response_cache）
+    - concierge_turn_iterations                    每轮 LLM 迭代次数直方图
+    - concierge_max_iterations_total               达到最大迭代次数的轮数
+    collectors 中的函数返回 {指标名: 数值}，在每次 render 时作为 gauge 输出（例如缓存命中率）。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self.collectors: List[Callable[[], Dict[str, float]]] = []
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def _observe_locked(self, name: str, labels: Tuple, value: float, buckets: Tuple[float, ...]):
+        # [各桶计数..., 总和, 总数]
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = [0.0] * (len(buckets) + 2)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def _inc_locked(self, name: str, labels: Tuple, value: float = 1):
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def export(self, span: Span):
+        attrs = span.attrs
+        with self._lock:
+            self._observe_locked("concierge_span_duration_seconds", (("span", span.name),),
+                                 span.duration or 0.0, self.buckets)
+            self._inc_locked("concierge_spans_total", (("span", span.name), ("status", span.status)))
+
+            if span.name == "llm_call":
+                model = attrs.get("model", "")
+                for kind in ("prompt", "completion", "cached"):
+                    tokens = attrs.get(f"{kind}_tokens")
+                    if tokens:
+                        self._inc_locked("concierge_llm_tokens_total", (("model", model), ("type", kind)), tokens)
+            elif span.name == "tool":
+                self._inc_locked("concierge_tool_calls_total",
+                                 (("tool", attrs.get("tool", "")), ("cached", str(bool(attrs.get("cached"))).lower())))
+            elif span.name == "turn":
+                self._inc_locked("concierge_turns_total", (("path", attrs.get("path", "llm")),))
+                if "iterations" in attrs:
+                    self._observe_locked("concierge_turn_iterations", (), attrs["iterations"], (1, 2, 3, 4, 5))
+                if attrs.get("max_iterations_hit"):
+                    self._inc_locked("concierge_max_iterations_total", ())
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        seen = set()
+        for (name, labels), values in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            buckets = self.buckets if name == "concierge_span_duration_seconds" else (1, 2, 3, 4, 5)
+            for bound, count in zip(buckets, values):
+                lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {count:g}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {values[-1]:g}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-2]:g}")
+            lines.append(f"{name}_count{_labels(labels)} {values[-1]:g}")
+
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+
+        for collector in self.collectors:
+            try:
+                for name, value in sorted(collector().items()):
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {float(value):g}")
+            except Exception as e:
+                print(f"⚠️ 指标收集失败: {e}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """在后台线程中提供 GET /metrics"""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                data = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        return self._server
+
+
+# ==================== 全局实例 ====================
+
+TRACER = Tracer()
+
+# 进程内指标（始终聚合；设置 METRICS_PORT 时对外提供 /metrics）
+METRICS = PrometheusExporter()
+TRACER.add_exporter(METRICS)
+
+if TRACE_FILE:
+    TRACER.add_exporter(JsonlExporter(TRACE_FILE))
+if METRICS_PORT:
+    METRICS.serve(METRICS_PORT)
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import tempfile
+    import urllib.request
+
+    print("请求追踪测试\n")
+
+    path = os.path.join(tempfile.mkdtemp(), "trace.jsonl")
+    metrics = PrometheusExporter()
+    jsonl = JsonlExporter(path, flush_interval=0.01)
+    tracer = Tracer([metrics, jsonl])
+
+    with tracer.span("turn", user_id="u1", path="llm") as turn:
+        with tracer.span("llm_call", parent=turn, model="deepseek-chat") as call:
+            call.set(prompt_tokens=1200, completion_tokens=40, cached_tokens=1024, finish_reason="tool_calls")
+        with tracer.span("tool", parent=turn, tool="find_parking", cached=True):
+            pass
+        try:
+            with tracer.span("tool", parent=turn, tool="redeem_coupon"):
+                raise ValueError("积分不足")
+        except ValueError:
+            pass
+        turn.set(iterations=2, max_iterations_hit=False)
+
+    jsonl.close()
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    print(f"   JSONL: {len(records)} 个 span")
+    for record in records:
+        print(f"      {record['name']:9} {record['status']:6} {record['duration_ms']:.3f} ms  {record['attrs']}")
+    assert len(records) == 4 and all(r["trace_id"] == records[-1]["trace_id"] for r in records)
+    assert records[2]["status"] == "error" and records[-1]["parent_id"] is None
+
+    server = metrics.serve(0)
+    body = urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics").read().decode()
+    print("\n" + "\n".join(line for line in body.splitlines() if "bucket" not in line))
+    assert 'concierge_llm_tokens_total{model="deepseek-chat",type="cached"} 1024' in body
+    server.shutdown()
+
+    # 调试开关与 span 开销
+    set_debug(False)
+    debug("不应输出")
+    start = time.perf_counter()
+    quiet = Tracer([PrometheusExporter()])
+    for _ in range(10000):
+        with quiet.span("tool", tool="get_shop_info"):
+            pass
+    print(f"\n   单个 span 开销: {(time.perf_counter() - start) / 10000 * 1e6:.1f} µs")
+
+    print("\n所有测试完成！")
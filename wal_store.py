@@ -0,0 +1,345 @@
+"""
+迪拜商场互动服务 Agent - 追加写日志（WAL）用户状态存储
+每次变更只追加一条记录，启动时回放；日志过大或过久时在后台压缩为快照
+"""
+
+import os
+import json
+import time
+import random
+import string
+import atexit
+import threading
+from typing import Any, Dict, List
+
+
+# ==================== 配置 ====================
+
+# fsync 策略：
+#   always - 每次写入后 fsync（最安全，最慢）
+#   batch  - 后台线程每 fsync_interval 秒 fsync 一次（最多丢失一个窗口的数据）
+#   os     - 只 flush 到操作系统缓冲区，由操作系统决定落盘时机
+FSYNC_POLICIES = ("always", "batch", "os")
+
+DEFAULT_FSYNC_POLICY = os.environ.get("USER_STATE_FSYNC", "batch")
+DEFAULT_COMPACT_BYTES = int(os.environ.get("USER_STATE_COMPACT_BYTES", str(4 * 1024 * 1024)))
+DEFAULT_COMPACT_INTERVAL = float(os.environ.get("USER_STATE_COMPACT_INTERVAL", "300"))
+
+
+# ==================== WAL 用户状态 ====================
+
+class WalUserState:
+    """
+    基于追加写日志的用户状态（接口与 mock_data.UserState 一致）
+
+    日志每行是一条 JSON 记录，保存单个用户变更后的完整状态：
+        {"u": "<user_id>", "s": {"points": 10, "coupons": [...]}}
+        {"u": "<user_id>", "s": null}          # 删除（重置）用户
+    记录是幂等的，回放顺序即写入顺序，重复回放不会出错。
+    快照文件沿用 user_data.json 的格式，可以与 JSON 后端互相迁移。
+    """
+
+    def __init__(
+        self,
+        data_file: str = "user_data.json",
+        fsync_policy: str = DEFAULT_FSYNC_POLICY,
+        fsync_interval: float = 0.05,
+        compact_bytes: int = DEFAULT_COMPACT_BYTES,
+        compact_interval: float = DEFAULT_COMPACT_INTERVAL
+    ):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"未知的 fsync 策略: {fsync_policy}（可选: {', '.join(FSYNC_POLICIES)}）")
+
+        self.data_file = data_file
+        self.log_file = os.path.splitext(data_file)[0] + ".wal"
+        self.rotated_log_file = self.log_file + ".1"
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+
+        self.users: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+        self._log = None
+        self._log_bytes = 0
+        self._dirty = False
+        self._last_compaction = time.monotonic()
+        self._compacting = threading.Lock()
+        self._stop = threading.Event()
+
+        self.load()
+
+        self._worker = threading.Thread(target=self._background_loop, name="wal-user-state", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    # ---------- 加载与回放 ----------
+
+    def load(self):
+        """加载快照并按顺序回放日志（包括压缩中断时遗留的旧日志）"""
+        with self._lock:
+            self.users = {}
+
+            if os.path.exists(self.data_file):
+                try:
+                    with open(self.data_file, 'r', encoding='utf-8') as f:
+                        self.users = json.load(f)
+                except Exception as e:
+                    print(f"⚠️ 加载用户快照失败: {e}")
+                    self.users = {}
+
+            replayed = 0
+            for path in (self.rotated_log_file, self.log_file):
+                replayed += self._replay(path)
+
+            print(f"✅ 已从 {self.data_file} 加载 {len(self.users)} 个用户，回放 {replayed} 条日志")
+
+            self._open_log()
+
+        # 上次压缩未完成：立即补做
+        if os.path.exists(self.rotated_log_file):
+            self.compact()
+
+    def _replay(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+
+        count = 0
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时写了一半的最后一行，忽略
+                    continue
+                self._apply(record)
+                count += 1
+        return count
+
+    def _apply(self, record: Dict[str, Any]):
+        if record["s"] is None:
+            self.users.pop(record["u"], None)
+        else:
+            self.users[record["u"]] = record["s"]
+
+    def _open_log(self):
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_file, 'a', encoding='utf-8')
+        self._log_bytes = self._log.tell()
+
+    # ---------- 写入 ----------
+
+    def _append(self, user_id: str):
+        """追加一条该用户当前状态的记录（调用方需持有锁）"""
+        record = {"u": user_id, "s": self.users.get(user_id)}
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self._log.write(line)
+        self._log.flush()
+        self._log_bytes += len(line.encode("utf-8"))
+
+        if self.fsync_policy == "always":
+            os.fsync(self._log.fileno())
+        else:
+            self._dirty = True
+
+    def save(self):
+        """兼容旧接口：确保已写入的日志落盘"""
+        with self._lock:
+            if self._log is not None:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._dirty = False
+
+    # ---------- 后台维护 ----------
+
+    def _background_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                if self.fsync_policy == "batch" and self._dirty:
+                    self.save()
+
+                if self._should_compact():
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ WAL 后台维护失败: {e}")
+
+    def _should_compact(self) -> bool:
+        if self._log_bytes == 0:
+            return False
+        if self._log_bytes >= self.compact_bytes:
+            return True
+        return time.monotonic() - self._last_compaction >= self.compact_interval
+
+    def compact(self):
+        """
+        将当前状态压缩为快照并截断日志
+
+        持锁期间只做序列化和日志轮转；写快照文件在锁外完成，不阻塞新的写入。
+        """
+        with self._compacting:
+            with self._lock:
+                if self._log is not None and self._log_bytes > 0:
+                    self._log.flush()
+                    os.fsync(self._log.fileno())
+                    self._log.close()
+                    self._log = None
+                    if os.path.exists(self.rotated_log_file):
+                        # 上一次轮转的日志尚未并入快照：合并后再轮转
+                        with open(self.rotated_log_file, 'a', encoding='utf-8') as rotated, \
+                                open(self.log_file, 'r', encoding='utf-8') as current:
+                            rotated.write(current.read())
+                        os.remove(self.log_file)
+                    else:
+                        os.replace(self.log_file, self.rotated_log_file)
+                    self._open_log()
+                    self._dirty = False
+                snapshot = json.dumps(self.users, ensure_ascii=False, separators=(",", ":"))
+                self._last_compaction = time.monotonic()
+
+            if not os.path.exists(self.rotated_log_file):
+                return
+
+            tmp_file = self.data_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.data_file)
+            os.remove(self.rotated_log_file)
+            print(f"🗜️ 用户数据已压缩为快照 {self.data_file}")
+
+    def close(self):
+        """停止后台线程，落盘并关闭日志"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._worker.join()
+        with self._lock:
+            if self._log is not None:
+                self.save()
+                self._log.close()
+                self._log = None
+
+    # ---------- UserState 接口 ----------
+
+    def get_user(self, user_id):
+        """获取或创建用户（仅在内存中创建，首次变更时才写日志）"""
+        with self._lock:
+            if user_id not in self.users:
+                self.users[user_id] = {
+                    "points": 0,
+                    "coupons": []
+                }
+            return self.users[user_id]
+
+    def add_points(self, user_id, amount):
+        """增加积分"""
+        with self._lock:
+            user = self.get_user(user_id)
+            user["points"] += amount
+            self._append(user_id)
+            return user["points"]
+
+    def deduct_points(self, user_id, amount):
+        """扣除积分"""
+        with self._lock:
+            user = self.get_user(user_id)
+            if user["points"] >= amount:
+                user["points"] -= amount
+                self._append(user_id)
+                return True
+            return False
+
+    def add_coupon(self, user_id, coupon):
+        """添加优惠券"""
+        with self._lock:
+            user = self.get_user(user_id)
+            user["coupons"].append(coupon)
+            self._append(user_id)
+
+    def redeem(self, user_id, coupon_type, cost, code=None):
+        """
+        原子兑换优惠券：检查、扣分、发券在同一临界区内完成，只追加一条日志
+
+        临界区只包含内存修改和一次缓冲写入（O(1)），不同用户之间的等待可以忽略。
+
+        Returns:
+            dict: 成功时 {"success": True, "coupon": {...}, "remaining_points": n}，
+                  积分不足时 {"success": False, "current_points": n}
+        """
+        with self._lock:
+            user = self.get_user(user_id)
+            if user["points"] < cost:
+                return {"success": False, "current_points": user["points"]}
+
+            coupon = {
+                "type": coupon_type,
+                "code": code or ''.join(random.choices(string.ascii_uppercase + string.digits, k=8)),
+                "points_cost": cost
+            }
+            user["points"] -= cost
+            user["coupons"].append(coupon)
+            self._append(user_id)
+            return {"success": True, "coupon": coupon, "remaining_points": user["points"]}
+
+    def get_points(self, user_id):
+        """获取当前积分"""
+        return self.get_user(user_id)["points"]
+
+    def get_coupons(self, user_id) -> List[Dict[str, Any]]:
+        """获取优惠券列表"""
+        return self.get_user(user_id)["coupons"]
+
+    def reset_user(self, user_id):
+        """删除用户的全部状态"""
+        with self._lock:
+            if user_id in self.users:
+                del self.users[user_id]
+                self._append(user_id)
+
+
+# ==================== 测试代码 ====================
+
+if __name__ == "__main__":
+    import tempfile
+
+    print("WAL 用户状态存储测试\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, "user_data.json")
+
+        state = WalUserState(data_file, fsync_policy="os", compact_bytes=1 << 30)
+        for i in range(1000):
+            state.add_points(f"user_{i % 100}", 1)
+        state.add_coupon("user_1", {"type": "咖啡券", "code": "TEST0001", "points_cost": 5})
+        state.deduct_points("user_1", 5)
+        state.close()
+
+        # 重启后回放日志
+        state = WalUserState(data_file, fsync_policy="os", compact_bytes=1 << 30)
+        assert state.get_points("user_1") == 5
+        assert state.get_points("user_2") == 10
+        assert len(state.get_coupons("user_1")) == 1
+        print(f"   回放后用户数: {len(state.users)}")
+
+        # 压缩后快照与日志一致
+        state.compact()
+        assert os.path.getsize(state.log_file) == 0
+        state.close()
+
+        with open(data_file, 'r', encoding='utf-8') as f:
+            assert json.load(f)["user_1"]["points"] == 5
+
+        # 写入耗时与用户数量无关
+        state = WalUserState(data_file, fsync_policy="os", compact_bytes=1 << 30)
+        for i in range(100000):
+            state.get_user(f"bulk_{i}")
+        start = time.perf_counter()
+        for i in range(1000):
+            state.add_points("user_1", 1)
+        elapsed = (time.perf_counter() - start) / 1000
+        print(f"   {len(state.users)} 个用户时单次 add_points: {elapsed * 1e6:.1f} µs")
+        state.close()
+
+    print("\n所有测试完成！")